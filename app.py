@@ -1,12 +1,39 @@
+import time
+_INICIO_IMPORTS = time.perf_counter()
 import streamlit as st
-import google.generativeai as genai
-from PIL import Image
-import io
 import os
-import time
 from pathlib import Path
-import zipfile
 import re
+import threading
+import itertools
+import tempfile
+import shutil
+import uuid
+import weakref
+import json
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+import nucleo
+from nucleo import (
+    SISTEMA_DE_CONDUCTA, PROMPT_ASESORIA_RAPIDA, TEXTO_MAX_CARACTERES, MIME_DOCX,
+    SUBIDA_TIMEOUT_ACTIVO_SEGUNDOS, GEMINI_FILES_MARGEN_SEGUNDOS, HISTORIAL_PRESUPUESTO_TOKENS,
+    CONTEXTO_CACHE_ACTIVO, CORPUS_DIR, INDICE_SQLITE,
+    genai, Image, ImageOps,
+    obtener_metricas, registrar_generacion, obtener_perfil_arranque,
+    configurar_genai, obtener_modelo, obtener_cache_respuestas, clave_respuesta,
+    obtener_cache_archivos_gemini, expiracion_archivo_gemini, delete_file_from_gemini,
+    calcular_hash_contenido, es_blob_imagen, generar_miniatura, process_uploaded_file,
+    SubidaEnSegundoPlano, esperar_subida, obtener_contexto_cacheado,
+    turnos_conversacion, construir_historial, resumir_turnos,
+    preparar_contenidos, extraer_texto_de_chunk, get_gemini_response,
+    catalogo_plantillas, firma_plantillas, esqueletos_plantillas, analizar_brechas,
+    informe_brechas_markdown, generar_borrador, rehacer_seccion, construir_docx,
+    indice_corpus, pasajes_de_referencia,
+)
+_SEGUNDOS_IMPORTS = time.perf_counter() - _INICIO_IMPORTS
+_INICIO_EJECUCION = time.perf_counter()
 
 # --- Configuración de la Página ---
 st.set_page_config(
@@ -15,302 +42,1170 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- SISTEMA DE CONDUCTA (TU GEM) ---
-# 🚨 PEGA TU PROMPT COMPLETO DE CONDUCTA AQUÍ 🚨
-SISTEMA_DE_CONDUCTA = os.environ.get("GEM_PROMPT", 'Actúa como un asistente experto en creación de documentos institucionales.')
 
+class AvisosStreamlit(nucleo.Avisos):
+    """Muestra los avisos del núcleo en la página cuando hay un script en curso."""
+
+    @staticmethod
+    def _en_script():
+        return get_script_run_ctx(suppress_warning=True) is not None
+
+    def error(self, texto):
+        if not self._en_script():
+            return super().error(texto)
+        st.error(texto)
+
+    def notificar(self, texto):
+        if self._en_script():
+            st.toast(texto)
+
+    def informar(self, texto):
+        if self._en_script():
+            st.info(texto)
+
+    def progreso(self, texto):
+        if not self._en_script():
+            return super().progreso(texto)
+        return st.spinner(texto)
+
+
+nucleo.avisos = AvisosStreamlit()
+
+# Si se define, se expone /metrics en formato de texto de Prometheus en este puerto
+METRICAS_PUERTO = int(os.environ.get("METRICAS_PUERTO", "0"))
+METRICAS_HOST = os.environ.get("METRICAS_HOST", "127.0.0.1")
+# Muestra el panel de métricas en la barra lateral
+ADMIN_METRICAS = os.environ.get("ADMIN_METRICAS", "").lower() in ("1", "true", "si", "sí")
+
+
+@st.cache_resource
+def iniciar_servidor_metricas(puerto: int):
+    """Arranca (una vez por proceso) un servidor HTTP local que sirve /metrics."""
+    metricas = obtener_metricas()
+
+    class ManejadorMetricas(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            cuerpo = metricas.texto_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
 
-# === Helpers para descargas de documentos del repositorio ===
+        def log_message(self, *args):
+            pass
 
-REPO_ROOT = Path(__file__).parent  # Carpeta donde está este archivo .py
+    servidor = ThreadingHTTPServer((METRICAS_HOST, puerto), ManejadorMetricas)
+    threading.Thread(target=servidor.serve_forever, daemon=True, name="aliadodoc-metricas").start()
+    return servidor
 
-@st.cache_data
-def cargar_bytes_archivo(ruta_relativa: str) -> bytes:
+
+if METRICAS_PUERTO:
+    try:
+        iniciar_servidor_metricas(METRICAS_PUERTO)
+    except OSError as e:
+        print(f"Advertencia: No se pudo iniciar el servidor de métricas en el puerto {METRICAS_PUERTO}: {e}")
+
+
+# === Arranque en frío: imports diferidos, precalentamiento y perfil de arranque ===
+
+# Precalienta en segundo plano plantillas, índice, cliente y modelos tras la primera ejecución del script
+PRECALENTAR = os.environ.get("PRECALENTAR", "1") == "1"
+# Modelo sobre el que se hace la llamada de metadatos que abre la conexión con la API
+MODELO_PRECALENTAMIENTO = "gemini-2.5-flash"
+
+
+# Los imports del script solo cuestan de verdad en la primera ejecución del proceso (se anota esa)
+obtener_perfil_arranque().registrar("imports del script", _SEGUNDOS_IMPORTS)
+
+
+def _precalentar(api_key):
+    """Cada fase por separado: si una falla, las demás siguen y el primer usuario la paga como antes."""
+    perfil = obtener_perfil_arranque()
+    inicio = time.perf_counter()
+    fases = [
+        ("imports diferidos", lambda: (genai.configure, Image.open, ImageOps.exif_transpose)),
+        ("cliente de Gemini", lambda: api_key and configurar_genai(api_key)),
+        ("modelos", lambda: [obtener_modelo(api_key, m, SISTEMA_DE_CONDUCTA) for m in ("gemini-2.5-flash", "gemini-2.5-pro")]),
+        # Llamada barata que resuelve DNS y abre la conexión TLS que reutilizará la primera petición
+        ("metadatos del modelo", lambda: api_key and genai.get_model(f"models/{MODELO_PRECALENTAMIENTO}")),
+        ("plantillas", lambda: esqueletos_plantillas(firma_plantillas())),
+        ("índice de referencia", indice_corpus),
+    ]
+    for fase, accion in fases:
+        try:
+            with perfil.medir(f"precalentamiento: {fase}"):
+                accion()
+        except Exception as e:
+            print(f"Advertencia: Falló el precalentamiento ({fase}): {e}")
+    perfil.registrar("precalentamiento: total", time.perf_counter() - inicio)
+    obtener_metricas().evento("arranque", fases=perfil.informe())
+
+
+@st.cache_resource
+def iniciar_precalentamiento(api_key):
     """
-    Lee un archivo binario del repositorio y devuelve sus bytes.
-    ruta_relativa es relativa al archivo actual (ej: 'docs/Plantilla_Guia.docx').
+    Lanza el precalentamiento una sola vez por proceso, en un hilo aparte y al final
+    de la primera ejecución del script: la primera página se pinta sin esperar ni
+    competir con los imports pesados o la conexión con la API.
     """
-    file_path = REPO_ROOT / ruta_relativa
-    with open(file_path, "rb") as f:
-        return f.read()
+    hilo = threading.Thread(target=_precalentar, args=(api_key,), daemon=True, name="aliadodoc-precalentamiento")
+    hilo.start()
+    return hilo
+
+
+@st.fragment(run_every=1.0)
+def mostrar_estado_subida(subida):
+    """Progreso de la subida en la barra lateral; al terminar refresca la app completa."""
+    if subida.terminada():
+        st.rerun()
+    st.markdown(f"**Archivo Binario:** {subida.fase} ({subida.segundos():.0f} s)...")
+    st.caption("Puedes seguir escribiendo; el mensaje esperará a que termine la subida.")
 
-def crear_zip_documentos(archivos: dict) -> io.BytesIO:
+# === Archivos de la sesión (varios adjuntos por conversación) ===
+
+MAX_HILOS_PROCESAMIENTO = 4
+
+
+def procesar_archivos_en_paralelo(api_key, archivos) -> list:
     """
-    Crea un ZIP en memoria con varios archivos.
-    archivos: dict {nombre_en_zip: bytes}
+    Procesa varios archivos a la vez con process_uploaded_file, de modo que el tiempo
+    total sea el del archivo más lento. Los hilos comparten el contexto de la
+    ejecución actual para que sus st.error / st.toast se muestren.
+    Devuelve [(archivo, contenido procesado o None)] en el orden recibido.
     """
-    buffer = io.BytesIO()
-    with zipfile.ZipFile(buffer, "w") as zf:
-        for nombre_zip, contenido in archivos.items():
-            zf.writestr(nombre_zip, contenido)
-    buffer.seek(0)
-    return buffer
+    if not archivos:
+        return []
+    ctx = get_script_run_ctx()
+
+    def procesar(archivo):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return process_uploaded_file(api_key, archivo)
 
+    with ThreadPoolExecutor(max_workers=min(MAX_HILOS_PROCESAMIENTO, len(archivos))) as executor:
+        return list(zip(archivos, executor.map(procesar, archivos)))
 
-# --- Funciones Auxiliares para Archivos (Mantenidas) ---
 
-def upload_file_to_gemini(api_key, uploaded_file):
+def _liberar_entrada(api_key, entrada, avisar=True, conservar_remoto=False):
     """
-    Sube el archivo a la API de Archivos de Gemini usando google-generativeai.
+    Cancela la subida en curso, borra la copia en disco o libera el archivo de Gemini
+    de una entrada del registro. Con `conservar_remoto` el archivo solo deja de contar
+    como usado y sigue en Gemini hasta que expire (conversaciones que se pueden retomar).
     """
-    if not api_key:
-        st.error("Error: La clave API no está configurada. No se puede subir el archivo binario.")
-        return None
+    if isinstance(entrada["contenido"], SubidaEnSegundoPlano):
+        entrada["contenido"].cancelar()
+    elif isinstance(entrada["contenido"], AdjuntoEnDisco):
+        entrada["contenido"].eliminar()
+    if entrada["file_obj"] and conservar_remoto:
+        obtener_cache_archivos_gemini().liberar(entrada["file_obj"])
+    elif entrada["file_obj"]:
+        delete_file_from_gemini(api_key, entrada["file_obj"], avisar=avisar)
 
-    try:
-        genai.configure(api_key=api_key)
-
-        # Guardamos el archivo de Streamlit en un path temporal
-        tmp_dir = "/tmp"
-        os.makedirs(tmp_dir, exist_ok=True)
-        tmp_path = os.path.join(tmp_dir, uploaded_file.name)
-
-        uploaded_file.seek(0)
-        with open(tmp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-
-        with st.spinner(f"Subiendo '{uploaded_file.name}' a Gemini para análisis..."):
-            # SDK viejo: usa upload_file(path=...)
-            file_obj = genai.upload_file(
-                path=tmp_path,
-                display_name=uploaded_file.name,
-            )
 
-        st.toast("Archivo binario subido con éxito a la API de Archivos.")
-        return file_obj
+def registrar_archivo_en_sesion(api_key, nombre, contenido):
+    """
+    Guarda el contenido procesado en el registro de la sesión. Si ya había un archivo
+    con el mismo nombre, se libera después, así volver a guardar el mismo archivo
+    reutiliza el que ya está en Gemini.
+    """
+    es_file = hasattr(contenido, "name") and not isinstance(contenido, (str, dict))
+    informe = analizar_brechas(contenido) if isinstance(contenido, str) else None
+    if tamano_en_memoria(contenido) > ADJUNTO_MAX_EN_MEMORIA_BYTES:
+        # Los textos e imágenes grandes esperan en disco hasta que se envían al modelo
+        contenido = AdjuntoEnDisco.guardar(directorio_sesion(), contenido)
+    anterior = st.session_state.archivos_sesion.get(nombre)
+    st.session_state.archivos_sesion[nombre] = {
+        "contenido": contenido,                     # blob de imagen, str, AdjuntoEnDisco, File o SubidaEnSegundoPlano
+        "file_obj": contenido if es_file else None,  # File de Gemini para limpieza
+        "brechas": informe_brechas_markdown(informe) if informe else None,  # Revisión local de estructura
+    }
+    if anterior is not None:
+        _liberar_entrada(api_key, anterior)
+
+
+def eliminar_archivo_de_sesion(api_key, nombre):
+    """Quita un archivo de la sesión y lo libera en Gemini."""
+    entrada = st.session_state.archivos_sesion.pop(nombre, None)
+    if entrada is not None:
+        _liberar_entrada(api_key, entrada)
+
+
+def resolver_subidas_pendientes(esperar=False):
+    """
+    Sustituye en el registro las subidas en segundo plano terminadas (o todas, si
+    `esperar` es True) por su File; las que fallaron se quitan de la sesión.
+    Devuelve True si cambió algún archivo del registro.
+    """
+    cambios = False
+    for nombre, entrada in list(st.session_state.archivos_sesion.items()):
+        subida = entrada["contenido"]
+        if not isinstance(subida, SubidaEnSegundoPlano) or not (esperar or subida.terminada()):
+            continue
+        file_obj = esperar_subida(subida)
+        if file_obj is None:
+            del st.session_state.archivos_sesion[nombre]
+        else:
+            entrada["contenido"] = entrada["file_obj"] = file_obj
+        cambios = True
+    return cambios
 
-    except AttributeError as e:
-        # Aquí llegarías si tu versión es TAN vieja que ni siquiera tiene upload_file
-        error_msg = (
-            "❌ ERROR DE COMPATIBILIDAD DE LIBRERÍA: La funcionalidad de subida de "
-            "archivos binarios (PDF, DOCX, XLSX) **no está soportada** en la versión "
-            "de la biblioteca `google-generativeai` instalada. "
-            "Actualiza el paquete `google-generativeai` a una versión reciente."
-        )
-        st.error(error_msg)
-        print(f"DEBUG: Error completo de subida a Gemini (Incompatibilidad de Librería): {e}")
-        return None
 
-    except Exception as e:
-        error_msg = f"❌ Error general al subir archivo binario: {e}. "
-        if "API key not valid" in str(e) or "authentication" in str(e):
-            error_msg += (
-                "Por favor, **REVISA TU CLAVE API (GEMINI_API_KEY)**, la subida falló por autenticación."
-            )
-        elif "Unsupported" in str(e) or "format" in str(e):
-            error_msg += "El formato del archivo podría no estar soportado por la API de Archivos."
-        st.error(error_msg)
-        print(f"DEBUG: Error completo de subida a Gemini (General): {e}")
-        return None
+# === Memoria de las sesiones: historial acotado, adjuntos en disco y expulsión ===
+
+# Mensajes que cada sesión mantiene en memoria; los más antiguos pasan a disco
+MENSAJES_EN_MEMORIA = int(os.environ.get("MENSAJES_EN_MEMORIA", "40"))
+# Mensajes que se pintan en cada rerun; los anteriores se cargan por páginas a petición
+MENSAJES_POR_PAGINA = int(os.environ.get("MENSAJES_POR_PAGINA", "20"))
+# Los adjuntos de texto o imagen por encima de este tamaño se guardan en disco
+ADJUNTO_MAX_EN_MEMORIA_BYTES = int(os.environ.get("ADJUNTO_MAX_EN_MEMORIA_KB", "256")) * 1024
+# Sesiones sin actividad durante este tiempo se liberan (memoria, disco y archivos de Gemini)
+SESION_INACTIVA_SEGUNDOS = int(os.environ.get("SESION_INACTIVA_SEGUNDOS", "3600"))
+# Si la memoria estimada de todas las sesiones supera este límite, se liberan las menos recientes
+SESIONES_MEMORIA_MAX_BYTES = int(os.environ.get("SESIONES_MEMORIA_MAX_MB", "512")) * 1024 * 1024
+SESIONES_REVISION_SEGUNDOS = 60
+SESIONES_DIR = Path(os.environ.get("SESIONES_DIR", Path(tempfile.gettempdir()) / "aliadodoc_sesiones"))
+# Claves de session_state que se borran al liberar una sesión
+CLAVES_SESION = ("messages", "archivos_sesion", "resumen_historial", "resumen_archivado",
+                 "mensajes_archivados", "mensajes_visibles", "mensajes_guardados", "conversacion_id",
+                 "borrador_plantilla")
+
+
+def id_sesion_actual() -> str:
+    """Id de la sesión de Streamlit en curso ("local" fuera de una ejecución de la app)."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "local"
+
 
+def directorio_sesion(session_id=None) -> Path:
+    return SESIONES_DIR / (session_id or id_sesion_actual())
 
-def delete_file_from_gemini(api_key, file_obj):
-    """Elimina el archivo de la API de Archivos de Gemini (limpieza)."""
-    if not api_key or not file_obj:
+
+class AdjuntoEnDisco:
+    """
+    Adjunto grande (texto o imagen) guardado en el directorio de la sesión. En memoria
+    solo queda una vista previa; el contenido se lee al enviarlo al modelo.
+    """
+
+    def __init__(self, ruta: Path, tipo: str, tamano: int, vista_previa, mime_type=None):
+        self.ruta = ruta
+        self.tipo = tipo                  # "texto" o "imagen"
+        self.tamano = tamano              # Bytes en disco
+        self.vista_previa = vista_previa  # Primeros caracteres o miniatura JPEG
+        self.mime_type = mime_type
+
+    @classmethod
+    def guardar(cls, directorio: Path, contenido):
+        directorio.mkdir(parents=True, exist_ok=True)
+        # Nombre único: el mismo archivo guardado dos veces no comparte ruta con la entrada que reemplaza
+        ruta = directorio / f"adjunto_{uuid.uuid4().hex}"
+        if es_blob_imagen(contenido):
+            ruta.write_bytes(contenido["data"])
+            return cls(ruta, "imagen", len(contenido["data"]), generar_miniatura(contenido["data"]),
+                       contenido["mime_type"])
+        datos = contenido.encode("utf-8")
+        ruta.write_bytes(datos)
+        return cls(ruta, "texto", len(datos), contenido[:500])
+
+    def cargar(self):
+        datos = self.ruta.read_bytes()
+        if self.tipo == "imagen":
+            return {"mime_type": self.mime_type, "data": datos}
+        return datos.decode("utf-8")
+
+    def eliminar(self):
+        self.ruta.unlink(missing_ok=True)
+
+
+def tamano_en_memoria(contenido) -> int:
+    """Bytes aproximados que ocupa en memoria el contenido procesado de un adjunto."""
+    if isinstance(contenido, str):
+        return len(contenido)
+    if es_blob_imagen(contenido):
+        return len(contenido["data"])
+    if isinstance(contenido, AdjuntoEnDisco):
+        return len(contenido.vista_previa)
+    return 0
+
+
+def contenido_para_modelo(entrada):
+    """Contenido de una entrada del registro listo para enviar (lee de disco si hace falta)."""
+    contenido = entrada["contenido"]
+    return contenido.cargar() if isinstance(contenido, AdjuntoEnDisco) else contenido
+
+
+def archivar_mensajes_antiguos(api_key, presupuesto_tokens):
+    """
+    Mantiene en memoria unos MENSAJES_EN_MEMORIA mensajes. Cuando el exceso llega a
+    una página (MENSAJES_POR_PAGINA), los más antiguos se añaden de una vez a la
+    transcripción en disco de la sesión y, si hay memoria de conversación, se condensan
+    en `resumen_archivado` para que el modelo no pierda su contexto. Así el resumen
+    se pide una vez por página y no en cada turno.
+    """
+    mensajes = st.session_state.messages
+    corte = len(mensajes) - MENSAJES_EN_MEMORIA
+    if corte <= 0 or corte < max(1, MENSAJES_POR_PAGINA):
         return
-    try:
-        genai.configure(api_key=api_key)
-        # SDK viejo: delete_file(name=...)
-        genai.delete_file(name=file_obj.name)
-        st.toast(f"Archivo de Gemini '{getattr(file_obj, 'display_name', file_obj.name)}' eliminado.")
-    except AttributeError:
-        # Si tampoco existe delete_file, ignoramos silenciosamente
-        pass
-    except Exception as e:
-        print(f"Advertencia: No se pudo eliminar el archivo de Gemini: {e}")
-        pass
-
-def get_gemini_response(api_key, model_name, user_prompt, system_instruction, content_files=None):
-    """
-    Función para interactuar con la API de Gemini con:
-    - Manejo de cuota (429) + temporizador de reintento sugerido
-    - Fallback automático de gemini-2.5-pro -> gemini-2.5-flash (una vez)
+    # Se corta antes de un turno del usuario para no separar pregunta y respuesta
+    while corte < len(mensajes) and mensajes[corte]["role"] != "user":
+        corte += 1
+    if corte >= len(mensajes):
+        return
+    archivados, restantes = mensajes[:corte], mensajes[corte:]
+
+    # Con conversaciones persistentes los mensajes ya están en el almacén
+    almacen = obtener_almacen_conversaciones()
+    conversacion = conversacion_actual()
+    if almacen is None or conversacion is None:
+        directorio = directorio_sesion()
+        directorio.mkdir(parents=True, exist_ok=True)
+        with open(directorio / "transcripcion.jsonl", "a", encoding="utf-8") as f:
+            for mensaje in archivados:
+                f.write(json.dumps(mensaje, ensure_ascii=False) + "\n")
+
+    turnos_archivados = turnos_conversacion(archivados)
+    if presupuesto_tokens > 0 and turnos_archivados:
+        st.session_state.resumen_archivado = resumir_turnos(
+            api_key, turnos_archivados, st.session_state.get("resumen_archivado") or "", presupuesto_tokens
+        )
+        if almacen is not None and conversacion is not None:
+            almacen.guardar_resumen(conversacion, st.session_state.resumen_archivado)
+    # El resumen de turnos en memoria cuenta turnos desde el inicio de la lista: se
+    # desplaza en los turnos archivados y solo se descarta si ya no cubre ninguno restante
+    resumen_historial = st.session_state.get("resumen_historial")
+    if resumen_historial:
+        desplazamiento = len(turnos_conversacion(mensajes)) - len(turnos_conversacion(restantes))
+        turnos_restantes = resumen_historial["turnos"] - desplazamiento
+        st.session_state.resumen_historial = (
+            dict(resumen_historial, turnos=turnos_restantes) if turnos_restantes > 0 else None
+        )
+    st.session_state.messages = restantes
+    st.session_state.mensajes_archivados = st.session_state.get("mensajes_archivados", 0) + len(archivados)
+
+
+def leer_mensajes_archivados(desde: int, hasta: int) -> list:
+    """Mensajes archivados de la sesión en el rango [desde, hasta)."""
+    almacen = obtener_almacen_conversaciones()
+    if almacen is not None and conversacion_actual() is not None:
+        return almacen.leer_mensajes(conversacion_actual(), desde, hasta)
+    ruta = directorio_sesion() / "transcripcion.jsonl"
+    if hasta <= desde or not ruta.exists():
+        return []
+    with open(ruta, encoding="utf-8") as f:
+        return [json.loads(linea) for linea in itertools.islice(f, desde, hasta)]
+
+
+def mensajes_a_mostrar() -> tuple:
     """
-    try:
-        if api_key:
-            genai.configure(api_key=api_key)
-        
-        model = genai.GenerativeModel(
-            model_name=model_name,
-            system_instruction=system_instruction
+    Devuelve (mensajes, ocultos): la última página visible de la conversación, incluidos
+    los archivados si el usuario pidió verlos, y cuántos quedan sin mostrar.
+    """
+    en_memoria = st.session_state.messages
+    archivados = st.session_state.get("mensajes_archivados", 0)
+    visibles = min(st.session_state.get("mensajes_visibles", MENSAJES_POR_PAGINA), archivados + len(en_memoria))
+    if visibles <= len(en_memoria):
+        return en_memoria[len(en_memoria) - visibles:], archivados + len(en_memoria) - visibles
+    desde = archivados - (visibles - len(en_memoria))
+    return leer_mensajes_archivados(desde, archivados) + en_memoria, desde
+
+
+def estimar_memoria_sesion(estado) -> dict:
+    """Uso de memoria aproximado (bytes) de una sesión a partir de su session_state."""
+    mensajes = estado["messages"] if "messages" in estado else []
+    archivos = estado["archivos_sesion"] if "archivos_sesion" in estado else {}
+    return {
+        "mensajes": len(mensajes),
+        "mensajes_archivados": estado["mensajes_archivados"] if "mensajes_archivados" in estado else 0,
+        "bytes_mensajes": sum(len(m.get("content") or "") for m in mensajes),
+        "adjuntos": len(archivos),
+        "bytes_adjuntos": sum(tamano_en_memoria(e["contenido"]) for e in archivos.values()),
+    }
+
+
+def _bytes_en_disco(directorio: Path) -> int:
+    if not directorio.exists():
+        return 0
+    return sum(f.stat().st_size for f in directorio.iterdir() if f.is_file())
+
+
+class MemoriaSesiones:
+    """
+    Registro de las sesiones del proceso: último uso y referencia débil a su
+    session_state (no las mantiene vivas). Libera las inactivas y, si la memoria
+    total estimada supera el límite, las menos recientes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sesiones = {}  # session_id -> {"estado": weakref, "ultimo_uso": float, "api_key": str}
+        self._ultima_revision = 0.0
+
+    def registrar(self, session_id, estado, api_key):
+        with self._lock:
+            sesion = self._sesiones.get(session_id)
+            if sesion is None or sesion["estado"]() is not estado:
+                sesion = self._sesiones[session_id] = {"estado": weakref.ref(estado)}
+            sesion["ultimo_uso"] = time.time()
+            sesion["api_key"] = api_key
+
+    def informe(self) -> list:
+        """Una fila por sesión viva con su memoria estimada y lo que tiene en disco."""
+        ahora = time.time()
+        with self._lock:
+            sesiones = list(self._sesiones.items())
+        filas = []
+        for session_id, sesion in sesiones:
+            estado = sesion["estado"]()
+            if estado is None:
+                continue
+            filas.append({
+                "sesion": session_id[:8],
+                "inactiva_s": round(ahora - sesion["ultimo_uso"]),
+                **estimar_memoria_sesion(estado),
+                "bytes_disco": _bytes_en_disco(directorio_sesion(session_id)),
+            })
+        return filas
+
+    def revisar(self, session_id_actual):
+        """Libera sesiones inactivas o por encima del presupuesto (como mucho una vez por minuto)."""
+        ahora = time.time()
+        with self._lock:
+            if ahora - self._ultima_revision < SESIONES_REVISION_SEGUNDOS:
+                return
+            self._ultima_revision = ahora
+            sesiones = sorted(self._sesiones.items(), key=lambda s: s[1]["ultimo_uso"])
+
+        vivas = []
+        for session_id, sesion in sesiones:
+            estado = sesion["estado"]()
+            if estado is None or ahora - sesion["ultimo_uso"] > SESION_INACTIVA_SEGUNDOS:
+                self.liberar(session_id)
+            else:
+                vivas.append((session_id, estado))
+        self._limpiar_directorios_huerfanos(ahora, {sid for sid, _ in vivas})
+
+        memoria = {sid: estimar_memoria_sesion(estado) for sid, estado in vivas}
+        total = sum(m["bytes_mensajes"] + m["bytes_adjuntos"] for m in memoria.values())
+        for session_id, _ in vivas:
+            if total <= SESIONES_MEMORIA_MAX_BYTES:
+                break
+            # Nunca se libera la sesión que está ejecutando esta revisión
+            if session_id == session_id_actual:
+                continue
+            total -= memoria[session_id]["bytes_mensajes"] + memoria[session_id]["bytes_adjuntos"]
+            self.liberar(session_id)
+
+    def _limpiar_directorios_huerfanos(self, ahora, vivas):
+        """Borra directorios de sesiones que ya no existen (p.ej. de un proceso anterior)."""
+        if not SESIONES_DIR.exists():
+            return
+        for directorio in SESIONES_DIR.iterdir():
+            try:
+                if directorio.name not in vivas and ahora - directorio.stat().st_mtime > SESION_INACTIVA_SEGUNDOS:
+                    shutil.rmtree(directorio, ignore_errors=True)
+            except OSError:
+                pass
+
+    def liberar(self, session_id):
+        """Borra el estado de la sesión, sus archivos en disco y sus archivos de Gemini."""
+        with self._lock:
+            sesion = self._sesiones.pop(session_id, None)
+        if sesion is None:
+            return
+        estado = sesion["estado"]()
+        if estado is not None:
+            if "archivos_sesion" in estado:
+                for entrada in estado["archivos_sesion"].values():
+                    _liberar_entrada(sesion["api_key"], entrada, avisar=False,
+                                     conservar_remoto=obtener_almacen_conversaciones() is not None)
+            for clave in CLAVES_SESION:
+                if clave in estado:
+                    del estado[clave]
+            # La sesión verá un aviso si vuelve
+            estado["sesion_liberada"] = True
+        shutil.rmtree(directorio_sesion(session_id), ignore_errors=True)
+        obtener_metricas().incrementar("aliadodoc_sesiones_liberadas_total")
+
+
+@st.cache_resource
+def obtener_memoria_sesiones() -> MemoriaSesiones:
+    return MemoriaSesiones()
+
+
+# === Conversaciones persistentes (SQLite) y reanudación ===
+
+# Ruta de la base de conversaciones; sin definir (o vacía) no se guardan conversaciones
+CONVERSACIONES_SQLITE = os.environ.get("CONVERSACIONES_SQLITE", "")
+USUARIO_ANONIMO = "anonimo"
+CONVERSACIONES_RECIENTES = 10
+
+
+class AlmacenConversaciones:
+    """
+    Conversaciones guardadas en SQLite: mensajes (solo se añaden), adjuntos con el hash
+    de su contenido o el File remoto de Gemini, e índice por usuario. El contenido de
+    los adjuntos de texto e imagen se guarda una vez por hash.
+    """
+
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS conversaciones (
+                id TEXT PRIMARY KEY, usuario TEXT, titulo TEXT, creada REAL, actualizada REAL, resumen TEXT
+            );
+            CREATE INDEX IF NOT EXISTS conversaciones_por_usuario ON conversaciones (usuario, actualizada);
+            CREATE TABLE IF NOT EXISTS mensajes (
+                conversacion TEXT, orden INTEGER, rol TEXT, contenido TEXT, PRIMARY KEY (conversacion, orden)
+            );
+            CREATE TABLE IF NOT EXISTS adjuntos (
+                conversacion TEXT, nombre TEXT, tipo TEXT, hash TEXT, mime TEXT, archivo TEXT, expira REAL,
+                PRIMARY KEY (conversacion, nombre)
+            );
+            CREATE TABLE IF NOT EXISTS contenidos (hash TEXT PRIMARY KEY, datos BLOB);
+        """)
+        self._db.commit()
+
+    def _asegurar_conversacion(self, conversacion, usuario, titulo=""):
+        ahora = time.time()
+        self._db.execute(
+            "INSERT INTO conversaciones (id, usuario, titulo, creada, actualizada) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET actualizada = excluded.actualizada, "
+            "titulo = COALESCE(NULLIF(conversaciones.titulo, ''), excluded.titulo)",
+            (conversacion, usuario, titulo, ahora, ahora),
         )
-        
-        generation_parts = [user_prompt]
-        if content_files:
-            valid_content = [c for c in content_files if c is not None]
-            generation_parts.extend(valid_content)
-
-        with st.spinner("Generando respuesta..."):
-            response = model.generate_content(generation_parts, stream=True)
-        return response
-
-    except Exception as e:
-        msg = str(e)
-
-        # ==========================
-        # 1) Manejo de cuota / 429
-        # ==========================
-        if ("429" in msg or 
-            "exceeded your current quota" in msg.lower() or
-            "quota exceeded" in msg.lower()):
-            
-            # Intentar extraer el tiempo recomendado de reintento
-            retry_seconds = None
-
-            # Caso A: "Please retry in 31.830795196s"
-            m = re.search(r"retry in ([0-9\.]+)s", msg)
-            if m:
-                try:
-                    retry_seconds = float(m.group(1))
-                except ValueError:
-                    retry_seconds = None
-
-            # Caso B: "retry_delay { seconds: 31 }"
-            if retry_seconds is None:
-                m2 = re.search(r"retry_delay\s*\{\s*seconds:\s*([0-9]+)", msg)
-                if m2:
-                    try:
-                        retry_seconds = float(m2.group(1))
-                    except ValueError:
-                        retry_seconds = None
-
-            # Armamos texto de tiempo amigable
-            tiempo_str = None
-            if retry_seconds is not None:
-                minutos = int(retry_seconds // 60)
-                segundos = int(round(retry_seconds % 60))
-                if minutos > 0:
-                    tiempo_str = f"**{minutos} min {segundos} s**"
-                else:
-                    tiempo_str = f"**{segundos} s**"
-
-            # Si el modelo actual es PRO, intentamos un fallback automático a FLASH una sola vez
-            if model_name == "gemini-2.5-pro":
-                try:
-                    st.info(
-                        "⚠️ Se alcanzó la cuota de `gemini-2.5-pro`. "
-                        "Intentando continuar automáticamente con `gemini-2.5-flash`..."
-                    )
-                    fallback_model = genai.GenerativeModel(
-                        model_name="gemini-2.5-flash",
-                        system_instruction=system_instruction
-                    )
-                    generation_parts = [user_prompt]
-                    if content_files:
-                        valid_content = [c for c in content_files if c is not None]
-                        generation_parts.extend(valid_content)
-
-                    with st.spinner("Generando respuesta con gemini-2.5-flash..."):
-                        response = fallback_model.generate_content(generation_parts, stream=True)
-                    return response
-
-                except Exception as e2:
-                    # Si también falla flash, mostramos mensaje bonito
-                    msg2 = str(e2)
-                    base_msg = (
-                        "⚠️ **Has alcanzado el límite de uso de la API para este modelo "
-                        "y no fue posible usar el modelo de respaldo (`gemini-2.5-flash`).**\n\n"
-                        f"Modelo actual: `{model_name}`.\n"
-                    )
-                    if tiempo_str:
-                        base_msg += f"\n⏱️ La API indica que podrás volver a intentar aproximadamente en {tiempo_str}.\n"
-                    base_msg += (
-                        "\n💡 Recomendaciones:\n"
-                        "- Cambia manualmente al modelo `gemini-2.5-flash` en la barra lateral.\n"
-                        "- Revisa tu plan y facturación si necesitas más capacidad con `pro`.\n"
-                        f"\nDetalles técnicos del error original:\n```text\n{msg}\n```\n"
-                        f"Error del fallback:\n```text\n{msg2}\n```"
-                    )
-                    return base_msg
 
-            # Si NO es pro, solo mostramos el mensaje de cuota
-            base_msg = (
-                "⚠️ **Has alcanzado el límite de uso de la API para este modelo.**\n\n"
-                f"Modelo: `{model_name}`.\n"
+    def agregar_mensajes(self, conversacion, usuario, desde, mensajes):
+        """Añade los mensajes a partir de la posición `desde` de la conversación."""
+        titulo = next((m["content"].strip()[:80] for m in mensajes if m["role"] == "user"), "")
+        with self._lock:
+            self._asegurar_conversacion(conversacion, usuario, titulo)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO mensajes (conversacion, orden, rol, contenido) VALUES (?, ?, ?, ?)",
+                [(conversacion, desde + i, m["role"], m["content"]) for i, m in enumerate(mensajes)],
+            )
+            self._db.commit()
+
+    def sincronizar_adjuntos(self, conversacion, usuario, filas, contenidos):
+        """
+        Sustituye los adjuntos de la conversación por `filas` y guarda los `contenidos`
+        (hash -> bytes) nuevos; los contenidos que nadie usa se borran.
+        """
+        with self._lock:
+            self._asegurar_conversacion(conversacion, usuario)
+            self._db.executemany(
+                "INSERT OR IGNORE INTO contenidos (hash, datos) VALUES (?, ?)", list(contenidos.items())
             )
-            if tiempo_str:
-                base_msg += f"\n⏱️ La API indica que podrás volver a intentar aproximadamente en {tiempo_str}.\n"
-            base_msg += (
-                "\n💡 Recomendaciones:\n"
-                "- Si estás en el plan gratuito, reduce la frecuencia de las solicitudes.\n"
-                "- Considera cambiar temporalmente a `gemini-2.5-flash` si aplica.\n"
-                "- Revisa tu plan y facturación en la consola de Google si necesitas más cuota.\n"
-                f"\nDetalles técnicos:\n```text\n{msg}\n```"
+            self._db.execute("DELETE FROM adjuntos WHERE conversacion = ?", (conversacion,))
+            self._db.executemany(
+                "INSERT INTO adjuntos (conversacion, nombre, tipo, hash, mime, archivo, expira) "
+                "VALUES (:conversacion, :nombre, :tipo, :hash, :mime, :archivo, :expira)",
+                [dict(fila, conversacion=conversacion) for fila in filas],
             )
-            return base_msg
-
-        # ==========================
-        # 2) Manejo de clave API inválida
-        # ==========================
-        if "API key not valid" in msg:
-            return (
-                "⚠️ **Error de Clave API**: La clave proporcionada (GEMINI_API_KEY) "
-                "no es válida o no tiene permisos. Revisa tu configuración."
+            self._db.execute("DELETE FROM contenidos WHERE hash NOT IN (SELECT hash FROM adjuntos WHERE hash IS NOT NULL)")
+            self._db.commit()
+
+    def guardar_resumen(self, conversacion, resumen):
+        with self._lock:
+            self._db.execute("UPDATE conversaciones SET resumen = ? WHERE id = ?", (resumen, conversacion))
+            self._db.commit()
+
+    def obtener(self, conversacion):
+        """Datos de la conversación con su número de mensajes, o None si no existe."""
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT usuario, titulo, resumen, (SELECT COUNT(*) FROM mensajes WHERE conversacion = id) "
+                "FROM conversaciones WHERE id = ?", (conversacion,)
+            ).fetchone()
+        if fila is None:
+            return None
+        return {"usuario": fila[0], "titulo": fila[1], "resumen": fila[2], "mensajes": fila[3]}
+
+    def leer_mensajes(self, conversacion, desde, hasta) -> list:
+        """Mensajes de la conversación en el rango [desde, hasta)."""
+        with self._lock:
+            filas = self._db.execute(
+                "SELECT rol, contenido FROM mensajes WHERE conversacion = ? AND orden >= ? AND orden < ? ORDER BY orden",
+                (conversacion, desde, hasta),
+            ).fetchall()
+        return [{"role": rol, "content": contenido} for rol, contenido in filas]
+
+    def leer_adjuntos(self, conversacion) -> list:
+        with self._lock:
+            cursor = self._db.execute(
+                "SELECT nombre, tipo, hash, mime, archivo, expira FROM adjuntos WHERE conversacion = ?", (conversacion,)
             )
+            columnas = [c[0] for c in cursor.description]
+            return [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+
+    def leer_contenido(self, hash_contenido):
+        with self._lock:
+            fila = self._db.execute("SELECT datos FROM contenidos WHERE hash = ?", (hash_contenido,)).fetchone()
+        return fila[0] if fila else None
+
+    def conversaciones_de_usuario(self, usuario, limite=CONVERSACIONES_RECIENTES) -> list:
+        with self._lock:
+            filas = self._db.execute(
+                "SELECT id, titulo, actualizada FROM conversaciones WHERE usuario = ? ORDER BY actualizada DESC LIMIT ?",
+                (usuario, limite),
+            ).fetchall()
+        return [{"id": i, "titulo": t, "actualizada": a} for i, t, a in filas]
+
+
+@st.cache_resource
+def obtener_almacen_conversaciones():
+    """Almacén único del servidor, o None si la persistencia está desactivada o no hay acceso a la ruta."""
+    if not CONVERSACIONES_SQLITE:
+        return None
+    try:
+        return AlmacenConversaciones(CONVERSACIONES_SQLITE)
+    except sqlite3.Error as e:
+        print(f"Advertencia: No se pudo abrir la base de conversaciones '{CONVERSACIONES_SQLITE}': {e}")
+        return None
 
-        # ==========================
-        # 3) Otros errores genéricos
-        # ==========================
-        return f"❌ Error: {msg}"
 
+def usuario_actual() -> str:
+    """Correo del usuario identificado con st.login o USUARIO_ANONIMO."""
+    if st.user.get("is_logged_in"):
+        return st.user.get("email") or USUARIO_ANONIMO
+    return USUARIO_ANONIMO
 
-def process_uploaded_file(api_key, uploaded_file):
-    """Procesa el archivo subido: lo convierte a PIL.Image, texto (str) o lo sube a Gemini (File object)."""
-    if uploaded_file is None: return None
-    mime_type = uploaded_file.type
-    
-    # 1. Archivos de imagen (PIL.Image)
-    if mime_type.startswith('image'):
-        try:
-            uploaded_file.seek(0)
-            return Image.open(io.BytesIO(uploaded_file.read()))
-        except Exception as e: 
-            st.error(f"Error al procesar la imagen: {e}")
+
+def login_configurado() -> bool:
+    """True si el servidor tiene st.login configurado (sección [auth] de secrets.toml)."""
+    try:
+        return "auth" in st.secrets
+    except FileNotFoundError:
+        return False
+
+
+def puede_reanudar(usuario_conversacion: str) -> bool:
+    """
+    Con login configurado solo el usuario identificado que creó la conversación puede
+    retomarla; sin login, las conversaciones anónimas se retoman con el enlace.
+    """
+    if login_configurado():
+        return usuario_actual() != USUARIO_ANONIMO and usuario_conversacion == usuario_actual()
+    return usuario_conversacion in (USUARIO_ANONIMO, usuario_actual())
+
+
+def conversacion_actual(crear=False):
+    """Id de la conversación de la sesión; con `crear` se asigna uno nuevo y se añade a la URL."""
+    conversacion = st.session_state.get("conversacion_id")
+    if conversacion is None and crear:
+        conversacion = st.session_state.conversacion_id = uuid.uuid4().hex
+        st.query_params["conversacion"] = conversacion
+    return conversacion
+
+
+def guardar_mensajes_nuevos():
+    """Añade al almacén los mensajes de la sesión que aún no estaban guardados."""
+    almacen = obtener_almacen_conversaciones()
+    if almacen is None:
+        return
+    archivados = st.session_state.get("mensajes_archivados", 0)
+    guardados = st.session_state.get("mensajes_guardados", 0)
+    nuevos = st.session_state.messages[max(0, guardados - archivados):]
+    if not nuevos:
+        return
+    almacen.agregar_mensajes(conversacion_actual(crear=True), usuario_actual(), guardados, nuevos)
+    st.session_state.mensajes_guardados = archivados + len(st.session_state.messages)
+
+
+def _fila_adjunto(nombre, entrada, contenidos):
+    """Fila del almacén para una entrada del registro de archivos (None si aún se está subiendo)."""
+    contenido = entrada["contenido"]
+    if isinstance(contenido, SubidaEnSegundoPlano):
+        return None
+    if entrada["file_obj"]:
+        file_obj = entrada["file_obj"]
+        return {"nombre": nombre, "tipo": "archivo", "hash": obtener_cache_archivos_gemini().clave_de(file_obj),
+                "mime": getattr(file_obj, "mime_type", None), "archivo": file_obj.name,
+                "expira": expiracion_archivo_gemini(file_obj)}
+    if isinstance(contenido, AdjuntoEnDisco):
+        tipo, mime, datos = contenido.tipo, contenido.mime_type, contenido.ruta.read_bytes()
+    elif es_blob_imagen(contenido):
+        tipo, mime, datos = "imagen", contenido["mime_type"], contenido["data"]
+    else:
+        tipo, mime, datos = "texto", None, str(contenido).encode("utf-8")
+    hash_contenido = calcular_hash_contenido(datos)
+    contenidos[hash_contenido] = datos
+    return {"nombre": nombre, "tipo": tipo, "hash": hash_contenido, "mime": mime, "archivo": None, "expira": None}
+
+
+def guardar_adjuntos():
+    """Guarda en el almacén los adjuntos actuales de la sesión (contenido o File remoto)."""
+    almacen = obtener_almacen_conversaciones()
+    if almacen is None or (not st.session_state.archivos_sesion and conversacion_actual() is None):
+        return
+    contenidos = {}
+    filas = [_fila_adjunto(nombre, entrada, contenidos) for nombre, entrada in st.session_state.archivos_sesion.items()]
+    almacen.sincronizar_adjuntos(conversacion_actual(crear=True), usuario_actual(), [f for f in filas if f], contenidos)
+
+
+def _restaurar_adjunto(api_key, almacen, fila):
+    """Contenido procesado de un adjunto guardado, o None si ya no se puede recuperar."""
+    if fila["tipo"] == "archivo":
+        if fila["expira"] <= time.time() + GEMINI_FILES_MARGEN_SEGUNDOS:
             return None
-            
-    # Lista de extensiones que Gemini requiere subir a su API de Archivos (Binarios)
-    binary_extensions = ('.doc', '.docx', '.pdf', '.xls', '.xlsx')
-    
-    # 2. Archivos Binarios (PDF, Word, Excel)
-    if uploaded_file.name.lower().endswith(binary_extensions) or mime_type in [
-        'application/pdf', 
-        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', # XLSX
-        'application/vnd.openxmlformats-officedocument.wordprocessingml.document', # DOCX
-        'application/msword', # DOC
-        'application/vnd.ms-excel' # XLS
-        ]:
-        
-        # Subir el archivo binario a la API de Archivos de Gemini
-        return upload_file_to_gemini(api_key, uploaded_file)
-            
-    # 3. Archivos de Texto (String) - (txt, py, md, csv, json, etc.)
-    elif mime_type.startswith('text') or uploaded_file.name.endswith(('.py', '.md', '.csv', '.txt', '.json')):
+        cache_archivos = obtener_cache_archivos_gemini()
+        file_obj = cache_archivos.obtener(fila["hash"]) if fila["hash"] else None
+        if file_obj is None:
+            try:
+                configurar_genai(api_key)
+                file_obj = genai.get_file(fila["archivo"])
+            except Exception as e:
+                print(f"Advertencia: No se pudo recuperar el archivo de Gemini '{fila['archivo']}': {e}")
+                return None
+            if file_obj.state.name != "ACTIVE":
+                return None
+            if fila["hash"]:
+                file_obj = cache_archivos.registrar(fila["hash"], file_obj)
+        return file_obj
+    datos = almacen.leer_contenido(fila["hash"])
+    if datos is None:
+        return None
+    if fila["tipo"] == "imagen":
+        return {"mime_type": fila["mime"], "data": datos}
+    return datos.decode("utf-8")
+
+
+def reanudar_conversacion(api_key, conversacion):
+    """
+    Carga la conversación indicada: solo los últimos MENSAJES_EN_MEMORIA mensajes (los
+    anteriores se leen del almacén al paginar) y sus adjuntos. Si no existe o el usuario
+    no puede retomarla (ver puede_reanudar), la sesión empieza una conversación nueva.
+    """
+    st.session_state.conversacion_id = None
+    almacen = obtener_almacen_conversaciones()
+    datos = almacen.obtener(conversacion) if almacen is not None and conversacion else None
+    if datos is None or not puede_reanudar(datos["usuario"]):
+        if conversacion:
+            del st.query_params["conversacion"]
+        return
+
+    st.session_state.conversacion_id = conversacion
+    total = datos["mensajes"]
+    desde = max(0, total - MENSAJES_EN_MEMORIA)
+    if total:
+        st.session_state.messages = almacen.leer_mensajes(conversacion, desde, total)
+    st.session_state.mensajes_archivados = desde
+    st.session_state.mensajes_guardados = total
+    st.session_state.resumen_archivado = datos["resumen"]
+
+    perdidos = []
+    for fila in almacen.leer_adjuntos(conversacion):
+        contenido = _restaurar_adjunto(api_key, almacen, fila)
+        if contenido is None:
+            perdidos.append(fila["nombre"])
+        else:
+            registrar_archivo_en_sesion(api_key, fila["nombre"], contenido)
+    if perdidos:
+        st.warning(f"Estos archivos ya no están disponibles y debes volver a cargarlos: {', '.join(perdidos)}")
+        guardar_adjuntos()
+
+
+def cambiar_de_conversacion(api_key, conversacion=None):
+    """
+    Deja la conversación actual (sus archivos siguen en Gemini hasta que expiren, para
+    poder retomarla) y pasa a `conversacion` o, si es None, a una nueva.
+    """
+    cancelar_preanalisis()
+    for entrada in st.session_state.archivos_sesion.values():
+        _liberar_entrada(api_key, entrada, conservar_remoto=True)
+    for clave in CLAVES_SESION:
+        st.session_state.pop(clave, None)
+    shutil.rmtree(directorio_sesion(), ignore_errors=True)
+    if conversacion:
+        st.query_params["conversacion"] = conversacion
+    else:
+        st.query_params.pop("conversacion", None)
+
+
+# === Generaciones en segundo plano y pre-análisis de documentos ===
+
+# Pre-análisis al guardar archivos: valor por defecto del interruptor de la barra lateral
+PREANALISIS_ACTIVO = os.environ.get("PREANALISIS", "0") == "1"
+MAX_HILOS_GENERACION = int(os.environ.get("MAX_HILOS_GENERACION", "4"))
+
+
+
+
+@st.cache_resource
+def obtener_executor_generaciones() -> ThreadPoolExecutor:
+    """Hilos compartidos para las generaciones que corren fuera de la ejecución de la app."""
+    return ThreadPoolExecutor(max_workers=MAX_HILOS_GENERACION, thread_name_prefix="generacion")
+
+
+class GeneracionEnCurso:
+    """
+    Generación que acumula los trozos de texto a medida que llegan, ya sea en un hilo
+    propio (iniciar) o desde la ejecución que la consume (publicar y terminar).
+    Cualquier número de lectores puede seguirla con suscribir(): reciben lo ya
+    generado y después los trozos nuevos. No usa Streamlit. Una generación cancelada
+    termina con error, para que quien la siga no la tome por una respuesta completa.
+    """
+
+    MENSAJE_CANCELADA = "⚠️ La generación que se estaba siguiendo se canceló antes de terminar."
+
+    def __init__(self, origen="preanalisis"):
+        self._cond = threading.Condition()
+        self.trozos = []
+        self.terminada = False
+        self.cancelada = False
+        self.error = None
+        self.uso = None      # usage_metadata del último chunk que la trajo
+        self.clave = None    # Clave de respuesta, cuando ya se conoce
+        self.futuro = None
+        self.origen = origen  # "preanalisis" o "chat": quién la inició
+
+    def iniciar(self, producir, al_terminar=None):
+        """Consume `producir()` (iterable de textos) en segundo plano; `al_terminar(self)` se llama siempre."""
+        self.futuro = obtener_executor_generaciones().submit(self._ejecutar, producir, al_terminar)
+        return self
+
+    def _ejecutar(self, producir, al_terminar):
+        textos = producir()
+        try:
+            for texto in textos:
+                if not self.publicar(texto):
+                    break
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            # Cerrar el generador corta también el stream de Gemini si se canceló
+            getattr(textos, "close", lambda: None)()
+            try:
+                if al_terminar:
+                    al_terminar(self)
+            finally:
+                self.terminar(self.MENSAJE_CANCELADA if self.cancelada else None)
+
+    def publicar(self, texto) -> bool:
+        """Añade un trozo y avisa a los suscriptores; devuelve False si la generación se canceló."""
+        with self._cond:
+            if self.cancelada:
+                return False
+            if texto:
+                self.trozos.append(texto)
+                self._cond.notify_all()
+            return True
+
+    def terminar(self, error=None):
+        """Marca la generación como terminada (con `error` si falló) y despierta a los suscriptores."""
+        with self._cond:
+            if error is not None and self.error is None:
+                self.error = error
+            self.terminada = True
+            self._cond.notify_all()
+
+    def suscribir(self):
+        """Itera los trozos desde el principio hasta que la generación termina."""
+        leidos = 0
+        while True:
+            with self._cond:
+                while leidos >= len(self.trozos) and not self.terminada:
+                    self._cond.wait()
+                nuevos = self.trozos[leidos:]
+                leidos = len(self.trozos)
+                fin = self.terminada
+            yield from nuevos
+            if fin and leidos >= len(self.trozos):
+                return
+
+    def texto(self) -> str:
+        with self._cond:
+            return "".join(self.trozos)
+
+    def cancelar(self):
+        """Corta la generación; sus suscriptores la ven terminar con MENSAJE_CANCELADA."""
+        with self._cond:
+            self.cancelada = True
+        if self.futuro is not None and self.futuro.cancel():
+            # No llegó a empezar, así que _ejecutar no la terminará
+            self.terminar(self.MENSAJE_CANCELADA)
+
+
+class RegistroGeneraciones:
+    """Generaciones en curso del proceso, por clave de respuesta (ver clave_respuesta)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_curso = {}
+
+    def obtener(self, clave):
+        with self._lock:
+            return self._en_curso.get(clave)
+
+    def registrar(self, clave, generacion) -> bool:
+        """Registra la generación; devuelve False si ya había otra en curso con la misma clave."""
+        return self.registrar_o_seguir(clave, generacion) is None
+
+    def registrar_o_seguir(self, clave, generacion):
+        """Registra la generación y devuelve None, o devuelve la que ya estaba en curso con la misma clave."""
+        with self._lock:
+            existente = self._en_curso.get(clave)
+            if existente is None:
+                self._en_curso[clave] = generacion
+            return existente
+
+    def quitar(self, clave, generacion):
+        with self._lock:
+            if self._en_curso.get(clave) is generacion:
+                del self._en_curso[clave]
+
+
+@st.cache_resource
+def obtener_registro_generaciones() -> RegistroGeneraciones:
+    return RegistroGeneraciones()
+
+
+def liberar_generacion(generacion):
+    """
+    Guarda en la caché la respuesta completa de una generación registrada y la quita
+    del registro, en ese orden: quien no la encuentre en curso la encuentra guardada.
+    """
+    if generacion.clave is None:
+        return
+    if not generacion.cancelada and generacion.error is None and generacion.texto().strip():
+        obtener_cache_respuestas().guardar(generacion.clave, generacion.texto())
+    obtener_registro_generaciones().quitar(generacion.clave, generacion)
+
+
+def _contenido_listo(contenido):
+    """Contenido de un adjunto para el hilo de pre-análisis: espera la subida o lee de disco."""
+    if isinstance(contenido, SubidaEnSegundoPlano):
         try:
-            uploaded_file.seek(0)
-            return uploaded_file.read().decode("utf-8")
-        except Exception as e: 
-            st.error(f"Error al leer el archivo de texto: {e}. Asegúrese de que es texto plano.")
+            return contenido.futuro.result(timeout=SUBIDA_TIMEOUT_ACTIVO_SEGUNDOS * 2)
+        except Exception:
             return None
-            
-    st.error(f"Tipo de archivo no soportado o formato inválido: {mime_type}")
-    return None
+    if isinstance(contenido, AdjuntoEnDisco):
+        return contenido.cargar()
+    return contenido
+
+
+def iniciar_preanalisis(api_key, model_name, historial):
+    """
+    Lanza en segundo plano la Asesoría Rápida sobre los archivos actuales de la sesión.
+    Si después se pide esa misma consulta, el chat sigue esta generación (o lee su
+    resultado de la caché de respuestas) en lugar de empezar otra.
+    """
+    cancelar_preanalisis()
+    entradas = [(nombre, entrada["contenido"]) for nombre, entrada in st.session_state.archivos_sesion.items()]
+    if not entradas:
+        return
+    registro = obtener_registro_generaciones()
+    cache_respuestas = obtener_cache_respuestas()
+    metricas = obtener_metricas()
+    generacion = GeneracionEnCurso()
+
+    def producir():
+        adjuntos = [(nombre, _contenido_listo(contenido)) for nombre, contenido in entradas]
+        if generacion.cancelada or any(contenido is None for _, contenido in adjuntos):
+            return
+        clave = clave_respuesta(
+            model_name, SISTEMA_DE_CONDUCTA, PROMPT_ASESORIA_RAPIDA,
+            [c for adjunto in adjuntos for c in adjunto], historial,
+        )
+        # Si la respuesta ya existe o alguien la está generando, no se repite
+        if cache_respuestas.obtener(clave) is not None or not registro.registrar(clave, generacion):
+            return
+        generacion.clave = clave
+        respuesta = get_gemini_response(
+            api_key, model_name, PROMPT_ASESORIA_RAPIDA, SISTEMA_DE_CONDUCTA,
+            preparar_contenidos(api_key, PROMPT_ASESORIA_RAPIDA, adjuntos), history=historial,
+        )
+        if isinstance(respuesta, str):
+            raise RuntimeError(respuesta)
+        inicio, primer_chunk, n_chunks = time.monotonic(), None, 0
+        for chunk in respuesta:
+            texto = extraer_texto_de_chunk(chunk)
+            if texto and primer_chunk is None:
+                primer_chunk = time.monotonic()
+            n_chunks += 1
+            generacion.uso = getattr(chunk, "usage_metadata", None) or generacion.uso
+            yield texto
+        registrar_generacion(metricas, model_name, inicio, primer_chunk, time.monotonic(), n_chunks,
+                             generacion.uso, origen="preanalisis")
+
+    def al_terminar(generacion):
+        if generacion.clave is None:
+            return
+        liberar_generacion(generacion)
+        metricas.incrementar("aliadodoc_preanalisis_total",
+                             resultado="cancelado" if generacion.cancelada else "error" if generacion.error else "completo")
+
+    st.session_state.preanalisis = generacion.iniciar(producir, al_terminar)
+    metricas.incrementar("aliadodoc_preanalisis_total", resultado="iniciado")
+
+
+def cancelar_preanalisis():
+    """Cancela el pre-análisis de la sesión (p.ej. al eliminar un archivo)."""
+    generacion = st.session_state.pop("preanalisis", None)
+    if generacion is not None and not generacion.terminada:
+        generacion.cancelar()
+        # Las consultas idénticas que lleguen desde ahora no siguen la generación cancelada
+        if generacion.clave is not None:
+            obtener_registro_generaciones().quitar(generacion.clave, generacion)
+
+
+# === Renderizado incremental de respuestas en streaming ===
+
+# Inicio de un elemento de lista markdown ("- ", "* ", "+ ", "1. ", "1) ")
+PATRON_ITEM_LISTA = re.compile(r" {0,3}(?:[-*+]|\d{1,9}[.)])(?:[ \t]|$)")
+
+
+class RenderizadorStream:
+    """
+    Pinta una respuesta en streaming sin volver a enviar todo el texto en cada chunk.
+    Los bloques markdown ya cerrados (separados por una línea en blanco fuera de
+    bloques de código, y sin que la línea siguiente continúe una lista, una cita o
+    un texto sangrado) se pintan una sola vez; solo se actualiza el bloque abierto
+    del final, y como mucho cada `intervalo_segundos` o cada `max_pendiente` caracteres.
+    """
+
+    def __init__(self, placeholder, intervalo_segundos=0.15, max_pendiente=2000, cursor="▌"):
+        self._contenedor = placeholder.container()
+        self._bloque_abierto = self._contenedor.empty()
+        self._intervalo = intervalo_segundos
+        self._max_pendiente = max_pendiente
+        self._cursor = cursor
+        self._partes = []           # Todos los chunks recibidos
+        self._abierto = []          # Chunks del bloque markdown aún abierto
+        self._pendiente = 0         # Caracteres recibidos desde el último refresco
+        self._ultimo_refresco = 0.0
+
+    def agregar(self, texto: str):
+        """Añade un chunk de texto y refresca la UI si toca."""
+        if not texto:
+            return
+        self._partes.append(texto)
+        self._abierto.append(texto)
+        self._pendiente += len(texto)
+        if (time.monotonic() - self._ultimo_refresco >= self._intervalo
+                or self._pendiente >= self._max_pendiente):
+            self._refrescar(final=False)
+
+    def _cerrar_bloques(self, texto: str) -> str:
+        """
+        Pinta de forma definitiva la parte de `texto` que ya forma bloques completos
+        y devuelve el resto (el bloque abierto). Una línea en blanco solo cierra el
+        bloque cuando ya llegó la línea siguiente y esta no lo continúa: una lista
+        suelta ("1. Paso\n\n   Detalle"), una cita o una línea sangrada siguen en él.
+        """
+        en_codigo = False  # El bloque abierto siempre empieza fuera de un bloque de código
+        en_lista = False   # El bloque abierto tiene elementos de lista
+        en_cita = False    # La última línea con contenido es una cita ("> ...")
+        tras_blanco = False
+        corte = 0
+        posicion = 0
+        for linea in texto.splitlines(keepends=True):
+            inicio = posicion
+            posicion += len(linea)
+            if not linea.endswith("\n"):
+                break  # Línea a medias: aún no se sabe si continúa el bloque
+            contenido = linea.strip()
+            if en_codigo:
+                en_codigo = not contenido.startswith(("```", "~~~"))
+                continue
+            if not contenido:
+                tras_blanco = True
+                continue
+            if tras_blanco:
+                continua = (linea[0] in " \t"
+                            or (en_lista and PATRON_ITEM_LISTA.match(linea))
+                            or (en_cita and contenido.startswith(">")))
+                if not continua:
+                    corte = inicio
+                    en_lista = False
+                tras_blanco = False
+            en_codigo = contenido.startswith(("```", "~~~"))
+            en_lista = en_lista or bool(PATRON_ITEM_LISTA.match(linea))
+            en_cita = contenido.startswith(">")
+        if corte == 0:
+            return texto
+        self._bloque_abierto.markdown(texto[:corte])
+        self._bloque_abierto = self._contenedor.empty()
+        return texto[corte:]
+
+    def _refrescar(self, final: bool):
+        resto = self._cerrar_bloques("".join(self._abierto))
+        self._abierto = [resto] if resto else []
+        if resto or not final:
+            self._bloque_abierto.markdown(resto + ("" if final else self._cursor))
+        self._pendiente = 0
+        self._ultimo_refresco = time.monotonic()
+
+    def texto(self) -> str:
+        """Texto completo recibido hasta el momento."""
+        return "".join(self._partes)
+
+    def finalizar(self) -> str:
+        """Pinta lo que quede sin cursor y devuelve el texto completo."""
+        self._refrescar(final=True)
+        return self.texto()
+
+
+def seguir_generacion(placeholder, generacion) -> tuple:
+    """
+    Pinta una generación en curso hasta que termina. Devuelve (texto, completa): si se
+    canceló o falló, lo recibido está incompleto y el texto es solo el aviso de error,
+    que reemplaza en pantalla a la respuesta a medias.
+    """
+    renderizador = RenderizadorStream(placeholder)
+    for texto in generacion.suscribir():
+        renderizador.agregar(texto)
+    texto = renderizador.finalizar()
+    if generacion.cancelada or generacion.error:
+        aviso = generacion.error or GeneracionEnCurso.MENSAJE_CANCELADA
+        placeholder.markdown(aviso)
+        return aviso, False
+    return texto, True
+
+
+def reproducir_respuesta(placeholder, texto, tamano_trozo=400) -> str:
+    """Vuelve a pintar una respuesta guardada usando el mismo renderizador del streaming."""
+    renderizador = RenderizadorStream(placeholder)
+    for i in range(0, len(texto), tamano_trozo):
+        renderizador.agregar(texto[i:i + tamano_trozo])
+    return renderizador.finalizar()
 
 
 # Inicializar sesión para gestión de archivos (Necesario antes de usar en el sidebar)
-if 'uploaded_file_data' not in st.session_state:
-    st.session_state.uploaded_file_data = None # Contenido procesado (Image, str o Gemini File object)
-if 'uploaded_file_name' not in st.session_state:
-    st.session_state.uploaded_file_name = None # Nombre del archivo
-if 'gemini_file_obj' not in st.session_state:
-    st.session_state.gemini_file_obj = None # Objeto File de Gemini para limpieza
+if 'archivos_sesion' not in st.session_state:
+    st.session_state.archivos_sesion = {} # nombre -> {"contenido": procesado, "file_obj": File de Gemini o None}
 if 'prompt_from_button' not in st.session_state:
     st.session_state.prompt_from_button = None
+if 'resumen_historial' not in st.session_state:
+    st.session_state.resumen_historial = None # Resumen de los turnos que ya no caben en el historial
+
+# Registrar la sesión (último uso) y liberar las inactivas de otros usuarios
+memoria_sesiones = obtener_memoria_sesiones()
+ctx_sesion = get_script_run_ctx()
+if ctx_sesion is not None:
+    memoria_sesiones.registrar(ctx_sesion.session_id, ctx_sesion.session_state, os.environ.get("GEMINI_API_KEY", ''))
+    memoria_sesiones.revisar(ctx_sesion.session_id)
+sesion_liberada = st.session_state.pop("sesion_liberada", False)
+
+# Reanudar la conversación guardada que indique la URL (?conversacion=...)
+if "conversacion_id" not in st.session_state:
+    reanudar_conversacion(os.environ.get("GEMINI_API_KEY", ''), st.query_params.get("conversacion"))
+if sesion_liberada:
+    if st.session_state.conversacion_id:
+        st.info("Tu sesión se liberó por inactividad; se recuperó la conversación guardada.")
+    else:
+        st.info("Tu sesión anterior se cerró por inactividad. Vuelve a cargar tus archivos para continuar.")
+
+# Recoger las subidas en segundo plano que hayan terminado desde el último rerun
+if resolver_subidas_pendientes():
+    guardar_adjuntos()
 
 # --- Obtener contenido de la sesión para usar y mostrar ---
-processed_content = st.session_state.uploaded_file_data
-file_name_to_display = st.session_state.uploaded_file_name
-gemini_file_obj = st.session_state.gemini_file_obj
-
+archivos_sesion = st.session_state.archivos_sesion
 
 # --- Barra Lateral para Configuración, Acciones Rápidas y Carga de Archivos ---
 with st.sidebar:
@@ -326,6 +1221,34 @@ with st.sidebar:
         "Selecciona el Modelo",
         ("gemini-2.5-flash", "gemini-2.5-pro")
     )
+
+    usar_cache_contexto = st.toggle(
+        "Caché de contexto",
+        value=CONTEXTO_CACHE_ACTIVO,
+        help="Guarda en Gemini la instrucción de sistema y los archivos de la sesión para no reenviarlos en cada turno.",
+    )
+
+    usar_referencias = st.toggle(
+        "Documentos de referencia",
+        value=bool(INDICE_SQLITE),
+        disabled=not INDICE_SQLITE,
+        help="Añade a cada consulta los pasajes más relevantes de las plantillas y los documentos aprobados.",
+    )
+
+    preanalisis_activo = st.toggle(
+        "Pre-análisis al guardar",
+        value=PREANALISIS_ACTIVO,
+        help="Al guardar archivos, prepara en segundo plano la Asesoría Rápida para que responda al instante.",
+    )
+
+    presupuesto_historial = st.slider(
+        "Memoria de conversación (tokens)",
+        min_value=0,
+        max_value=32000,
+        value=HISTORIAL_PRESUPUESTO_TOKENS,
+        step=1000,
+        help="Cuántos tokens de la conversación previa se reenvían al modelo. 0 la desactiva.",
+    )
     
     # --- BOTONES DE ACCIONES RÁPIDAS ---
     st.markdown("---")
@@ -333,15 +1256,32 @@ with st.sidebar:
 
     # Botón 1: Asesoría Rápida (Iniciar Proyecto)
     if st.button("Asesoría Rápida", use_container_width=True, key="quick_start_btn"):
-        st.session_state.prompt_from_button = """
-        Cordial Saludo, deseo que me apoyes con los siguientes temas:
-        - Qué información falta según los campos obligatorios y cual de la informacion disponible podria ayudarme a completarla.
-        - Cómo completarla, con sugerencias, usuando el documento suministrado y apoyar con el orden del documento.
-        - hay algun estandar documental que podria tener en cuenta para mejorar el documento?
-        - Si no tengo nada o hay algo faltante, dame un ejemplo básico para orientarme en el tema faltante.
-        """
+        st.session_state.prompt_from_button = PROMPT_ASESORIA_RAPIDA
         st.rerun() 
 
+    # Conversaciones guardadas: empezar una nueva o retomar una reciente
+    almacen_conversaciones = obtener_almacen_conversaciones()
+    if almacen_conversaciones is not None:
+        with st.expander("💬 Conversaciones"):
+            if st.button("➕ Nueva conversación", use_container_width=True, key="nueva_conversacion_btn"):
+                cambiar_de_conversacion(api_key)
+                st.rerun()
+            if usuario_actual() == USUARIO_ANONIMO:
+                if login_configurado():
+                    st.caption("Inicia sesión para retomar tus conversaciones más tarde.")
+                else:
+                    st.caption("Guarda el enlace de esta página para retomar la conversación más tarde.")
+            else:
+                for i, conversacion in enumerate(almacen_conversaciones.conversaciones_de_usuario(usuario_actual())):
+                    if st.button(
+                        conversacion["titulo"] or "(sin título)",
+                        use_container_width=True,
+                        key=f"conversacion_btn_{i}",
+                        disabled=conversacion["id"] == st.session_state.conversacion_id,
+                    ):
+                        cambiar_de_conversacion(api_key, conversacion["id"])
+                        st.rerun()
+
     # if st.button("Generar Formatos", use_container_width=True, key="fast_format_btn"):
     #     st.session_state.prompt_from_button = "Me podrias dar un formato en blanco de cada tipo de documento (Instructivo, Guia y Procedimiento) en MD?."
     #     st.rerun() 
@@ -352,52 +1292,26 @@ with st.sidebar:
     
     with st.expander("📑 Descarga de Plantillas"):
         try:
-            # Cargar bytes de las tres plantillas desde el repositorio
-            guia_bytes = cargar_bytes_archivo("docs/Plantilla_Guia.docx")
-            instructivo_bytes = cargar_bytes_archivo("docs/Plantilla_Instructivo.docx")
-            procedimiento_bytes = cargar_bytes_archivo("docs/Plantilla_Procedimiento.docx")
-    
-            # Botón para la Plantilla Guía
-            st.download_button(
-                label="Guía",
-                data=guia_bytes,
-                file_name="Plantilla_Guia.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                use_container_width=True,
-                key="dl_guia"
-            )
-    
-            # Botón para la Plantilla Instructivo
-            st.download_button(
-                label="Instructivo",
-                data=instructivo_bytes,
-                file_name="Plantilla_Instructivo.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                use_container_width=True,
-                key="dl_instructivo"
-            )
-    
-            # Botón para la Plantilla Procedimiento
-            st.download_button(
-                label="Procedimiento",
-                data=procedimiento_bytes,
-                file_name="Plantilla_Procedimiento.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                use_container_width=True,
-                key="dl_procedimiento"
-            )
+            # Plantillas precargadas (se releen solo si cambia algún archivo de docs/)
+            catalogo = catalogo_plantillas(firma_plantillas())
+            if not catalogo["archivos"]:
+                raise FileNotFoundError("docs/")
+
+            # Un botón por plantilla; los datos se entregan de forma diferida al pulsar
+            for plantilla in catalogo["archivos"]:
+                st.download_button(
+                    label=plantilla["etiqueta"],
+                    data=lambda datos=plantilla["bytes"]: datos,
+                    file_name=plantilla["nombre"],
+                    mime=plantilla["mime"],
+                    use_container_width=True,
+                    key=plantilla["clave"]
+                )
     
             # Botón para descargar todas en un ZIP
-            archivos_zip = {
-                "Plantilla_Guia.docx": guia_bytes,
-                "Plantilla_Instructivo.docx": instructivo_bytes,
-                "Plantilla_Procedimiento.docx": procedimiento_bytes,
-            }
-            zip_buffer = crear_zip_documentos(archivos_zip)
-    
             st.download_button(
                 label="🗂️ Todas",
-                data=zip_buffer,
+                data=lambda: catalogo["zip"],
                 file_name="Plantillas_AliadoDoc.zip",
                 mime="application/zip",
                 use_container_width=True,
@@ -413,37 +1327,119 @@ with st.sidebar:
                 "- docs/Plantilla_Procedimiento.docx"
             )
 
+    # Borrador de una plantilla: se llena con la última respuesta y se ajusta sección por sección
+    esqueletos = esqueletos_plantillas(firma_plantillas())
+    if esqueletos:
+        with st.expander("📝 Llenar plantilla"):
+            plantilla_llenar = st.selectbox(
+                "Plantilla", list(esqueletos), format_func=lambda n: esqueletos[n]["tipo"], key="plantilla_llenar"
+            )
+            ultima_respuesta = next(
+                (m["content"] for m in reversed(st.session_state.get("messages", [])[1:]) if m["role"] == "assistant"), ""
+            )
+            # Sin `disabled`: la barra lateral se pinta antes de que llegue la respuesta del chat
+            if st.button("Llenar con la última respuesta", use_container_width=True, key="llenar_plantilla_btn"):
+                borrador_nuevo, error = (None, "Primero pide en el chat el contenido del documento.") if not ultima_respuesta \
+                    else generar_borrador(api_key, model_option, esqueletos[plantilla_llenar], ultima_respuesta)
+                if error:
+                    st.error(error)
+                else:
+                    st.session_state.borrador_plantilla = borrador_nuevo
+                    for clave_widget in [k for k in st.session_state if str(k).startswith("borrador_")]:
+                        if clave_widget != "borrador_plantilla":
+                            del st.session_state[clave_widget]
+
+            borrador = st.session_state.get("borrador_plantilla")
+            if borrador and borrador["plantilla"] in esqueletos:
+                esqueleto = esqueletos[borrador["plantilla"]]
+                st.caption(f"Borrador de {esqueleto['tipo']}: "
+                           f"{sum(1 for t in borrador['secciones'].values() if t.strip())} de {len(esqueleto['secciones'])} secciones con contenido.")
+                for campo in ["Título"] + esqueleto["campos"]:
+                    clave_widget = f"borrador_campo_{campo}"
+                    st.session_state.setdefault(clave_widget, borrador["campos"].get(campo, ""))
+                    borrador["campos"][campo] = st.text_input(campo, key=clave_widget)
+
+                seccion = st.selectbox(
+                    "Sección", esqueleto["secciones"], key="borrador_seccion",
+                    format_func=lambda s: ("✅ " if borrador["secciones"].get(s["clave"]) else "⬜ ") + s["nombre"],
+                )
+                clave_widget = f"borrador_texto_{seccion['clave']}"
+                st.session_state.setdefault(clave_widget, borrador["secciones"].get(seccion["clave"], ""))
+                # Lo que se edita aquí solo vuelve a convertir esta sección al descargar
+                borrador["secciones"][seccion["clave"]] = st.text_area("Contenido (markdown)", key=clave_widget, height=200)
+
+                instruccion = st.text_input("Pedir un cambio en esta sección", key="borrador_instruccion",
+                                            placeholder="p.ej. agrega los responsables de cada paso")
+                if st.button("✏️ Rehacer solo esta sección", use_container_width=True, key="rehacer_seccion_btn",
+                             disabled=not instruccion):
+                    texto, error = rehacer_seccion(api_key, model_option, esqueleto, borrador, seccion["clave"], instruccion)
+                    if error:
+                        st.error(error)
+                    else:
+                        borrador["secciones"][seccion["clave"]] = texto
+                        del st.session_state[clave_widget]
+                        st.rerun()
+
+                titulo_archivo = re.sub(r"[^\w\- ]+", "", borrador["campos"].get("Título") or "").strip().replace(" ", "_")
+                # El DOCX se arma en el hilo de la descarga: recibe una copia, no el dict de la sesión
+                copia_borrador = {"campos": dict(borrador["campos"]), "secciones": dict(borrador["secciones"])}
+                st.download_button(
+                    label="⬇️ Descargar DOCX",
+                    data=lambda: construir_docx(esqueleto, copia_borrador),
+                    file_name=f"{Path(esqueleto['plantilla']).stem.replace('Plantilla_', '')}_{titulo_archivo or 'borrador'}.docx",
+                    mime=MIME_DOCX,
+                    use_container_width=True,
+                    key="dl_borrador_plantilla",
+                )
+
 
     # =================================================================
     # BLOQUE DE CARGA Y PREVIEW DE ARCHIVOS (MOVIMIENTO AL SIDEBAR)
     # =================================================================
 
     # 1. PREVISUALIZACIÓN Y ELIMINACIÓN
-    # Mostrar la previsualización del contenido guardado en la sesión
-    if processed_content:
-        st.subheader(f"Archivo en Sesión: {file_name_to_display}")
+    # Mostrar la previsualización de cada archivo guardado en la sesión
+    if archivos_sesion:
+        st.subheader(f"Archivos en Sesión ({len(archivos_sesion)})")
         
-        # Mostrar preview según el tipo de contenido
-        if isinstance(processed_content, Image.Image):
-            st.image(processed_content, caption="Imagen cargada", use_column_width=True)
-        elif gemini_file_obj:
-            st.markdown(f"**Archivo Binario:** Subido con éxito a Gemini (ID: `{gemini_file_obj.name.split('/')[-1]}`).")
-            st.info("Nota: Los archivos binarios (PDF, DOCX, XLSX) no se previsualizan directamente aquí.")
-        elif processed_content is not None:
-            # Contenido de texto
-            # Usamos un key para evitar posibles conflictos de rerender en el sidebar
-            st.text_area("Previsualización:", value=str(processed_content)[:500], height=100, help="Mostrando los primeros 500 caracteres.", key="sidebar_preview")
+        for i, (nombre, entrada) in enumerate(list(archivos_sesion.items())):
+            contenido = entrada["contenido"]
+            with st.expander(nombre, expanded=len(archivos_sesion) == 1):
+                # Mostrar preview según el tipo de contenido
+                if es_blob_imagen(contenido):
+                    st.image(generar_miniatura(contenido["data"]), caption="Imagen cargada")
+                elif isinstance(contenido, AdjuntoEnDisco):
+                    st.caption(f"Guardado en disco hasta enviarlo ({contenido.tamano / 1024:.0f} KB).")
+                    if contenido.tipo == "imagen":
+                        st.image(contenido.vista_previa, caption="Imagen cargada")
+                    else:
+                        st.text_area("Previsualización:", value=contenido.vista_previa, height=100, help="Mostrando los primeros 500 caracteres.", key=f"sidebar_preview_{i}")
+                elif isinstance(contenido, SubidaEnSegundoPlano):
+                    mostrar_estado_subida(contenido)
+                elif entrada["file_obj"]:
+                    st.markdown(f"**Archivo Binario:** Subido con éxito a Gemini (ID: `{entrada['file_obj'].name.split('/')[-1]}`).")
+                    st.info("Nota: Los archivos binarios (PDF, DOC, XLS) no se previsualizan directamente aquí.")
+                else:
+                    # Contenido de texto
+                    # Usamos un key para evitar posibles conflictos de rerender en el sidebar
+                    st.text_area("Previsualización:", value=str(contenido)[:500], height=100, help="Mostrando los primeros 500 caracteres.", key=f"sidebar_preview_{i}")
+
+                if entrada.get("brechas"):
+                    st.caption("🔎 **Revisión local**  \n" + entrada["brechas"].replace("\n", "  \n"))
+
+                if st.button("🗑️ Eliminar", use_container_width=True, key=f"delete_file_btn_{i}"):
+                    cancelar_preanalisis()
+                    eliminar_archivo_de_sesion(api_key, nombre)
+                    guardar_adjuntos()
+                    st.toast(f"Archivo '{nombre}' eliminado de la sesión.")
+                    st.rerun()
         
-        # Botón para limpiar la subida de sesión
-        if st.button("🗑️ Eliminar archivo de la sesión y de Gemini", use_container_width=True, key="delete_sidebar_btn"):
-            # 1. Eliminar de la API de Gemini si existe
-            if gemini_file_obj:
-                delete_file_from_gemini(api_key, gemini_file_obj)
-            
-            # 2. Limpiar el estado de sesión
-            st.session_state.uploaded_file_data = None
-            st.session_state.uploaded_file_name = None
-            st.session_state.gemini_file_obj = None
+        # Botón para limpiar todos los archivos de la sesión
+        if st.button("🗑️ Eliminar archivos de la sesión y de Gemini", use_container_width=True, key="delete_sidebar_btn"):
+            cancelar_preanalisis()
+            for nombre in list(archivos_sesion):
+                eliminar_archivo_de_sesion(api_key, nombre)
+            guardar_adjuntos()
             st.toast("Archivos eliminados. La sesión está limpia.")
             st.rerun() 
             
@@ -451,45 +1447,67 @@ with st.sidebar:
 
     # 2. UPLOADER 
     with st.expander("📂 Cargar Archivos"):
-        current_uploaded_file = st.file_uploader(
-            "Arrastra tu archivo aquí (Pulsa 'Guardar' para enviarlo a la sesión de chat)", 
+        current_uploaded_files = st.file_uploader(
+            "Arrastra tus archivos aquí (Pulsa 'Guardar' para enviarlos a la sesión de chat)", 
             type=["jpg", "png", "txt", "csv", "py", "json", "md", "pdf", "doc", "docx", "xls", "xlsx"], 
+            accept_multiple_files=True,
             key="file_uploader_widget"
         )
         
-        if current_uploaded_file is not None:
-            if st.button("💾 Guardar Archivo en Sesión", key="save_file_btn", use_container_width=True):
-                
-                # Limpiar cualquier archivo binario anterior antes de procesar el nuevo
-                if st.session_state.gemini_file_obj:
-                    delete_file_from_gemini(api_key, st.session_state.gemini_file_obj)
-                    st.session_state.gemini_file_obj = None 
-
-                st.session_state.uploaded_file_name = current_uploaded_file.name
+        if current_uploaded_files:
+            if st.button("💾 Guardar Archivos en Sesión", key="save_file_btn", use_container_width=True):
                 
-                # --- PROCESAR EL ARCHIVO ---
-                processed_data = process_uploaded_file(api_key, current_uploaded_file)
-                st.session_state.uploaded_file_data = processed_data
-                
-                # Si el resultado es un objeto File de Gemini, guárdalo para la limpieza
-                if processed_data and hasattr(processed_data, 'name'):
-                    st.session_state.gemini_file_obj = processed_data
-                # Si la subida falló (devuelve None), asegurarnos de que no hay objeto de archivo en sesión
-                elif processed_data is None:
-                    st.session_state.uploaded_file_name = None
-                    
+                # --- PROCESAR LOS ARCHIVOS EN PARALELO ---
+                resultados = procesar_archivos_en_paralelo(api_key, current_uploaded_files)
+                guardados = [archivo.name for archivo, contenido in resultados if contenido is not None]
+                for archivo, contenido in resultados:
+                    # Si el procesamiento falló (devuelve None), el archivo no entra en la sesión
+                    if contenido is not None:
+                        registrar_archivo_en_sesion(api_key, archivo.name, contenido)
+                guardar_adjuntos()
+                if preanalisis_activo and guardados:
+                    # Mismo historial que tendrá el próximo mensaje, para que la consulta coincida
+                    historial_actual, st.session_state.resumen_historial = construir_historial(
+                        api_key,
+                        st.session_state.messages,
+                        presupuesto_historial,
+                        st.session_state.resumen_historial,
+                        st.session_state.get("resumen_archivado"),
+                    )
+                    iniciar_preanalisis(api_key, model_option, historial_actual)
                 # --- FIN PROCESAMIENTO ---
                 
-                if st.session_state.uploaded_file_data is not None:
-                    st.toast(f"Archivo '{current_uploaded_file.name}' cargado a la sesión. ¡Listo para chatear!", icon='💾')
+                if len(guardados) == len(resultados):
+                    st.toast(f"{len(guardados)} archivo(s) cargado(s) a la sesión. ¡Listo para chatear!", icon='💾')
+                elif guardados:
+                    st.toast(f"Se cargaron {len(guardados)} de {len(resultados)} archivos. Revisa los errores arriba.", icon='⚠️')
                 else:
-                    st.toast("El archivo no pudo ser cargado. Revisa los errores arriba.", icon='❌')
+                    st.toast("Los archivos no pudieron ser cargados. Revisa los errores arriba.", icon='❌')
                     
                 st.rerun()
     # =================================================================
     # FIN DEL BLOQUE DE CARGA Y PREVIEW DE ARCHIVOS
     # =================================================================
 
+    # Panel de métricas (solo si ADMIN_METRICAS está activo)
+    if ADMIN_METRICAS:
+        with st.expander("📊 Métricas (admin)"):
+            metricas_admin = obtener_metricas()
+            st.caption("Tiempos en segundos, acumulados desde el arranque del servidor.")
+            st.table(metricas_admin.tabla_resumenes())
+            st.table(metricas_admin.tabla_contadores())
+            st.caption("Memoria estimada por sesión (bytes).")
+            st.table(memoria_sesiones.informe())
+            st.caption("Arranque del proceso (segundos por fase).")
+            st.table(obtener_perfil_arranque().informe())
+            # Los cambios en CORPUS_DIR se notan al cabo de CORPUS_REVISION_SEGUNDOS, o al pulsar aquí
+            revisar_corpus = st.button("🔄 Revisar documentos de referencia", key="revisar_corpus_btn",
+                                       disabled=not INDICE_SQLITE)
+            indice_admin = indice_corpus(forzar=revisar_corpus)
+            if indice_admin is not None:
+                st.caption(f"Índice de referencia: {indice_admin.informe()} (CORPUS_DIR: {CORPUS_DIR or 'sin configurar'}).")
+            st.json(metricas_admin.eventos_recientes()[-20:], expanded=False)
+
 # --- Interfaz Principal (Resto del código) ---
 
 # El bloque de previsualización y el bloque de carga de archivos han sido eliminados de aquí.
@@ -529,8 +1547,13 @@ if "messages" not in st.session_state:
         """
     }]
 
-# Mostrar mensajes anteriores
-for message in st.session_state.messages:
+# Mostrar mensajes anteriores: solo la última página; las anteriores se cargan a petición
+mensajes_visibles, mensajes_ocultos = mensajes_a_mostrar()
+if mensajes_ocultos:
+    if st.button(f"⬆️ Ver mensajes anteriores ({mensajes_ocultos})", key="mas_mensajes_btn"):
+        st.session_state.mensajes_visibles = st.session_state.get("mensajes_visibles", MENSAJES_POR_PAGINA) + MENSAJES_POR_PAGINA
+        st.rerun()
+for message in mensajes_visibles:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
@@ -541,58 +1564,115 @@ prompt_from_chat = st.chat_input("Escribe tu mensaje...")
 user_prompt = prompt_from_button or prompt_from_chat
 
 if user_prompt:
+    # Un mensaje enviado durante una subida espera a que termine en lugar de fallar
+    if resolver_subidas_pendientes(esperar=True):
+        guardar_adjuntos()
+    adjuntos = [(nombre, contenido_para_modelo(entrada)) for nombre, entrada in archivos_sesion.items()]
+    # Al escribir se vuelve a la última página de la conversación
+    st.session_state.pop("mensajes_visibles", None)
+
     st.session_state.messages.append({"role": "user", "content": user_prompt})
     with st.chat_message("user"):
         attachment_msg = ""
-        # Solo muestra el adjunto si el contenido no es None (es decir, la subida tuvo éxito o es una imagen/texto)
-        if file_name_to_display and processed_content is not None: 
-            attachment_msg = f" (Archivo Adjunto: **{file_name_to_display}**)"
+        # Solo muestra los adjuntos que se procesaron con éxito (imagen, texto o archivo subido)
+        if adjuntos:
+            nombres = ", ".join(f"**{nombre}**" for nombre, _ in adjuntos)
+            attachment_msg = f" (Archivo{'s' if len(adjuntos) > 1 else ''} Adjunto{'s' if len(adjuntos) > 1 else ''}: {nombres})"
         st.markdown(user_prompt + attachment_msg)
 
     with st.chat_message("assistant"):
         msg_placeholder = st.empty()
         full_response = ""
         
-        # OBTENER LISTA DE CONTENIDO: Se adjunta el contenido procesado si existe.
-        content_list = []
-        if processed_content: 
-            content_list.append(processed_content) 
-        
-        # Llamada a la API
-        response_stream = get_gemini_response(api_key, model_option, user_prompt, SISTEMA_DE_CONDUCTA, content_list)
-        
-        def extraer_texto_de_chunk(chunk) -> str:
-            """
-            Extrae texto de un chunk de respuesta de Gemini de forma segura,
-            sin usar chunk.text para evitar errores cuando no hay Parts válidos.
-            """
-            try:
-                candidates = getattr(chunk, "candidates", None)
-                if not candidates:
-                    return ""
-                
-                cand = candidates[0]
-                content = getattr(cand, "content", None)
-                if not content:
-                    return ""
-                
-                parts = getattr(content, "parts", None)
-                if not parts:
-                    return ""
-                
-                textos = []
-                for part in parts:
-                    t = getattr(part, "text", None)
-                    if t:
-                        textos.append(t)
-                
-                return "".join(textos)
-            except Exception:
-                # Si la estructura no es la esperada, devolvemos vacío y ya
-                return ""
-        
+        # Historial de turnos previos (sin el mensaje actual), dentro del presupuesto de tokens
+        historial, st.session_state.resumen_historial = construir_historial(
+            api_key,
+            st.session_state.messages[:-1],
+            presupuesto_historial,
+            st.session_state.resumen_historial,
+            st.session_state.get("resumen_archivado"),
+        )
 
-        if isinstance(response_stream, str):
+        # Pasajes del corpus institucional relevantes para la consulta. La Asesoría Rápida
+        # ya compara el documento con su plantilla (analizar_brechas) y no los necesita.
+        referencias, fuentes_referencia = "", []
+        if usar_referencias and user_prompt != PROMPT_ASESORIA_RAPIDA:
+            referencias, fuentes_referencia = pasajes_de_referencia(user_prompt)
+
+        # Las peticiones idénticas (mismo modelo, prompt, historial, adjuntos y referencias) se sirven de la caché
+        cache_respuestas = obtener_cache_respuestas()
+        clave_cache = clave_respuesta(
+            model_option, SISTEMA_DE_CONDUCTA, user_prompt,
+            [c for adjunto in adjuntos for c in adjunto] + ([referencias] if referencias else []), historial,
+        )
+        # Una generación idéntica en curso (el pre-análisis u otra sesión) se sigue en lugar de
+        # repetirla; si no hay ninguna, esta se registra para que las idénticas que lleguen la sigan
+        registro_generaciones = obtener_registro_generaciones()
+        generacion_propia = GeneracionEnCurso(origen="chat")
+        generacion_propia.clave = clave_cache
+        generacion_en_curso = registro_generaciones.registrar_o_seguir(clave_cache, generacion_propia)
+        respuesta_en_cache = None
+        if generacion_en_curso is not None:
+            generacion_propia = None
+        else:
+            respuesta_en_cache = cache_respuestas.obtener(clave_cache)
+            if respuesta_en_cache is not None:
+                # Quien se haya unido mientras tanto recibe la respuesta guardada
+                generacion_propia.publicar(respuesta_en_cache)
+                generacion_propia.terminar()
+                registro_generaciones.quitar(clave_cache, generacion_propia)
+                generacion_propia = None
+
+        metricas = obtener_metricas()
+        inicio_peticion = time.monotonic()
+        response_stream = None
+        if generacion_propia is not None:
+            try:
+                # OBTENER LISTA DE CONTENIDO: cada adjunto va precedido de su nombre
+                content_list = preparar_contenidos(
+                    api_key, user_prompt, adjuntos,
+                    progreso=lambda nombre, hechos, total: msg_placeholder.markdown(
+                        f"⏳ Analizando '{nombre}' por partes: {hechos} de {total} fragmentos..."
+                    ),
+                )
+
+                # Con la caché de contexto activa, instrucción y adjuntos se fijan una vez en Gemini.
+                # Los textos analizados por fragmentos dependen del prompt y no se pueden fijar.
+                contexto_cacheado = None
+                fragmentados = any(isinstance(c, str) and len(c) > TEXTO_MAX_CARACTERES for _, c in adjuntos)
+                if usar_cache_contexto and not fragmentados:
+                    contexto_cacheado = obtener_contexto_cacheado(api_key, model_option, SISTEMA_DE_CONDUCTA, content_list)
+
+                # Llamada a la API
+                response_stream = get_gemini_response(
+                    api_key, model_option, user_prompt, SISTEMA_DE_CONDUCTA, content_list, history=historial,
+                    contexto_cacheado=contexto_cacheado, referencias=referencias,
+                )
+            except BaseException:
+                # También si la ejecución se interrumpe (rerun o stop): nadie debe quedarse esperando
+                generacion_propia.terminar("⚠️ La consulta idéntica que se estaba siguiendo se interrumpió.")
+                liberar_generacion(generacion_propia)
+                raise
+            if isinstance(response_stream, str):
+                generacion_propia.terminar(response_stream)
+                liberar_generacion(generacion_propia)
+
+        if generacion_en_curso is not None:
+            full_response, completa = seguir_generacion(msg_placeholder, generacion_en_curso)
+            if completa and generacion_en_curso.origen == "preanalisis":
+                st.caption("⚡ Respuesta preparada en segundo plano al guardar los archivos.")
+                metricas.incrementar("aliadodoc_preanalisis_total", resultado="usado")
+            elif completa:
+                st.caption("⚡ Respuesta compartida con una consulta idéntica que ya estaba en curso.")
+                metricas.incrementar("aliadodoc_generaciones_compartidas_total", modelo=model_option)
+
+        elif respuesta_en_cache is not None:
+            full_response = reproducir_respuesta(msg_placeholder, respuesta_en_cache)
+            st.caption("⚡ Respuesta recuperada de la caché.")
+            fin = time.monotonic()
+            registrar_generacion(metricas, model_option, inicio_peticion, fin, fin, 0, origen="cache")
+
+        elif isinstance(response_stream, str):
             msg_placeholder.markdown(response_stream)
             full_response = response_stream
             if "Error de Clave API" in full_response:
@@ -601,26 +1681,45 @@ if user_prompt:
                 st.rerun()
 
         else:
+            renderizador = RenderizadorStream(msg_placeholder)
+            primer_chunk, n_chunks, uso = None, 0, None
+            error_stream = "⚠️ La consulta idéntica que se estaba siguiendo se interrumpió."
             try:
                 for chunk in response_stream:
                     # Extraer texto de forma segura, sin usar chunk.text
                     chunk_text = extraer_texto_de_chunk(chunk)
-                    if chunk_text:
-                        full_response += chunk_text
-                        msg_placeholder.markdown(full_response + "▌")
-
-                if full_response.strip():
-                    # Sí hubo texto en la respuesta
-                    msg_placeholder.markdown(full_response)
-                else:
+                    if chunk_text and primer_chunk is None:
+                        primer_chunk = time.monotonic()
+                    n_chunks += 1
+                    uso = getattr(chunk, "usage_metadata", None) or uso
+                    renderizador.agregar(chunk_text)
+                    # Las sesiones que siguen esta consulta reciben cada trozo al mismo tiempo
+                    generacion_propia.publicar(chunk_text)
+
+                # Pintar el último bloque sin cursor
+                full_response = renderizador.finalizar()
+                registrar_generacion(metricas, model_option, inicio_peticion, primer_chunk, time.monotonic(), n_chunks, uso)
+                error_stream = None
+                if not full_response.strip():
                     # No hubo texto en ningún chunk: probablemente bloqueo de seguridad o respuesta vacía
-                    msg_placeholder.markdown(
+                    error_stream = (
                         "⚠️ El modelo no pudo devolver texto. "
                         "Es posible que la respuesta haya sido bloqueada por las políticas "
                         "de seguridad de Gemini o que la petición no haya generado contenido."
                     )
+                    msg_placeholder.markdown(error_stream)
             except Exception as e:
-                st.error(f"Error al procesar la respuesta del modelo: {e}")
+                error_stream = f"Error al procesar la respuesta del modelo: {e}"
+                # El texto recibido hasta el fallo queda en pantalla, pero en el historial va solo el error
+                full_response = error_stream
+                st.error(error_stream)
+            finally:
+                # Con la respuesta completa se guarda en la caché y deja de estar en curso
+                generacion_propia.terminar(error_stream)
+                liberar_generacion(generacion_propia)
+
+        if fuentes_referencia and not isinstance(response_stream, str):
+            st.caption("📚 Referencias consultadas: " + "; ".join(fuentes_referencia))
 
 
         # --- LIMPIEZA POST-RESPUESTA ---
@@ -628,4 +1727,15 @@ if user_prompt:
         st.session_state.messages.append({
             "role": "assistant",
             "content": full_response
-        })
\ No newline at end of file
+        })
+        # Se guarda el turno y los mensajes que superan el límite de la sesión salen de memoria
+        guardar_mensajes_nuevos()
+        archivar_mensajes_antiguos(api_key, presupuesto_historial)
+
+# Duración de la primera ejecución completa del script en este proceso
+obtener_perfil_arranque().registrar("primera ejecución del script", time.perf_counter() - _INICIO_EJECUCION)
+
+# Con la primera página ya pintada, el precalentamiento no compite con ella; importando
+# la app sin Streamlit (modo bare) no hay ejecución del script y no se lanza
+if PRECALENTAR and get_script_run_ctx(suppress_warning=True) is not None:
+    iniciar_precalentamiento(os.environ.get("GEMINI_API_KEY", ""))
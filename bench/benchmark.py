@@ -0,0 +1,242 @@
+"""
+Benchmark sin conexión de app.py con un backend falso de Gemini (ver fake_genai.py).
+
+Recorre los caminos reales de la app: el chat completo con su bucle de streaming
+(vía streamlit.testing AppTest), process_uploaded_file y get_gemini_response (de
+nucleo.py), y
+reporta por escenario: operaciones/s, latencia p50/p99 y pico de memoria.
+
+Uso:
+    python bench/benchmark.py                 # todos los escenarios
+    python bench/benchmark.py -n 5 -e chat_corto respuesta_larga
+    python bench/benchmark.py --json bench_output.txt
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_genai  # noqa: E402
+
+fake_genai.instalar()
+
+# Sin límites de cuota locales salvo en los escenarios que los prueban
+os.environ.setdefault("GEMINI_API_KEY", "clave-falsa-benchmark")
+os.environ.setdefault("GEMINI_RPM_FLASH", "100000")
+os.environ.setdefault("GEMINI_RPM_PRO", "100000")
+# Los eventos de métricas no se mezclan con la tabla de resultados
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+# Las conversaciones del benchmark no se guardan junto a la app
+os.environ.setdefault("CONVERSACIONES_SQLITE", os.path.join(tempfile.mkdtemp(prefix="aliadodoc_bench_"), "conversaciones.db"))
+os.environ.setdefault("INDICE_SQLITE", os.path.join(tempfile.gettempdir(), f"aliadodoc_bench_indice_{os.getpid()}.db"))
+
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+RUTA_APP = str(RAIZ / "app.py")
+MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+class ArchivoSubido(io.BytesIO):
+    """Imita el UploadedFile de Streamlit (BytesIO con name, type y size)."""
+
+    def __init__(self, datos, nombre, mime):
+        super().__init__(datos)
+        self.name = nombre
+        self.type = mime
+        self.size = len(datos)
+
+
+def _nucleo():
+    """Importa nucleo.py (una vez) para llamar a sus funciones directamente."""
+    import nucleo
+    return nucleo
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+# --- Escenarios: cada uno devuelve una función que ejecuta una iteración ---
+
+def _chat(prompt_fijo=None, modelo=None, timeout=60):
+    """
+    Cada iteración abre una sesión nueva (historial vacío) y mide solo el envío del
+    mensaje: la petición, el bucle de streaming y el renderizado de la respuesta.
+    """
+    def preparar():
+        def iteracion():
+            at = AppTest.from_file(RUTA_APP, default_timeout=timeout)
+            at.run()
+            if modelo:
+                at.sidebar.selectbox[0].select(modelo).run()
+            t0 = time.perf_counter()
+            at.chat_input[0].set_value(prompt_fijo or f"Revisa el documento {uuid.uuid4()}").run()
+            transcurrido = time.perf_counter() - t0
+            if at.exception:
+                raise RuntimeError(at.exception[0].value)
+            return transcurrido
+        return iteracion
+    return preparar
+
+
+def escenario_chat_corto():
+    """Chat completo (AppTest) con una respuesta de 2.000 caracteres."""
+    fake_genai.CONFIG.longitud_respuesta = 2000
+    return _chat()
+
+
+def escenario_respuesta_larga():
+    """Borrador largo: 20.000 caracteres en chunks de 20 (estresa el renderizado)."""
+    fake_genai.CONFIG.longitud_respuesta = 20000
+    fake_genai.CONFIG.tamano_chunk = 20
+    fake_genai.CONFIG.latencia_entre_chunks = 0.0005
+    return _chat()
+
+
+def escenario_fallback_429():
+    """gemini-2.5-pro sin cuota: reintentos, aprendizaje del limitador y fallback a flash."""
+    fake_genai.CONFIG.modelos_sin_cuota = {"gemini-2.5-pro"}
+    return _chat(modelo="gemini-2.5-pro")
+
+
+def escenario_cache_respuesta():
+    """El mismo prompt en sesiones nuevas: a partir de la segunda se sirve de la caché."""
+    return _chat(prompt_fijo=f"Asesoría rápida {uuid.uuid4()}")
+
+
+def escenario_adjunto_docx():
+    """process_uploaded_file sobre una plantilla DOCX (extracción local)."""
+    datos = (RAIZ / "docs" / "Plantilla_Procedimiento.docx").read_bytes()
+
+    def preparar():
+        nucleo = _nucleo()
+
+        def iteracion():
+            resultado = nucleo.process_uploaded_file("clave", ArchivoSubido(datos, "Procedimiento.docx", MIME_DOCX))
+            if not resultado:
+                raise RuntimeError("La extracción no devolvió contenido")
+        return iteracion
+    return preparar
+
+
+def escenario_adjunto_pdf():
+    """
+    process_uploaded_file sobre PDFs distintos: subida en segundo plano a la API de
+    Archivos falsa y espera hasta el estado ACTIVE.
+    """
+    fake_genai.CONFIG.latencia_subida = 0.05
+    fake_genai.CONFIG.segundos_hasta_activo = 0.0
+
+    def preparar():
+        nucleo = _nucleo()
+
+        def iteracion():
+            datos = b"%PDF-1.4\n" + uuid.uuid4().bytes * 4096
+            resultado = nucleo.process_uploaded_file("clave", ArchivoSubido(datos, "escaneado.pdf", "application/pdf"))
+            if isinstance(resultado, nucleo.SubidaEnSegundoPlano):
+                resultado = resultado.futuro.result()
+            if resultado is None:
+                raise RuntimeError("La subida falló")
+        return iteracion
+    return preparar
+
+
+def escenario_get_gemini_response():
+    """get_gemini_response + consumo del stream, sin interfaz."""
+    fake_genai.CONFIG.longitud_respuesta = 4000
+
+    def preparar():
+        nucleo = _nucleo()
+
+        def iteracion():
+            respuesta = nucleo.get_gemini_response(
+                "clave", "gemini-2.5-flash", f"Hola {uuid.uuid4()}", nucleo.SISTEMA_DE_CONDUCTA, []
+            )
+            if isinstance(respuesta, str):
+                raise RuntimeError(respuesta)
+            for _ in respuesta:
+                pass
+        return iteracion
+    return preparar
+
+
+ESCENARIOS = {
+    "chat_corto": escenario_chat_corto,
+    "respuesta_larga": escenario_respuesta_larga,
+    "fallback_429": escenario_fallback_429,
+    "cache_respuesta": escenario_cache_respuesta,
+    "adjunto_docx": escenario_adjunto_docx,
+    "adjunto_pdf": escenario_adjunto_pdf,
+    "get_gemini_response": escenario_get_gemini_response,
+}
+
+
+def ejecutar(nombre, iteraciones):
+    """Ejecuta un escenario: mide latencias sin trazar memoria y luego una iteración con tracemalloc."""
+    fake_genai.reiniciar()
+    preparar = ESCENARIOS[nombre]()
+    iteracion = preparar()
+
+    latencias = []
+    for _ in range(iteraciones):
+        t0 = time.perf_counter()
+        # Una iteración puede devolver su propia medida si excluye su preparación
+        medida = iteracion()
+        latencias.append(medida if medida is not None else time.perf_counter() - t0)
+    total = sum(latencias)
+
+    tracemalloc.start()
+    iteracion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "escenario": nombre,
+        "iteraciones": iteraciones,
+        "ops_por_s": round(iteraciones / total, 2) if total else 0.0,
+        "p50_ms": round(_percentil(latencias, 50) * 1000, 1),
+        "p99_ms": round(_percentil(latencias, 99) * 1000, 1),
+        "media_ms": round(statistics.mean(latencias) * 1000, 1),
+        "pico_memoria_kib": round(pico / 1024, 1),
+        "llamadas_backend": dict(fake_genai.ESTADISTICAS),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--iteraciones", type=int, default=10)
+    parser.add_argument("-e", "--escenarios", nargs="*", choices=sorted(ESCENARIOS), default=list(ESCENARIOS))
+    parser.add_argument("--json", help="Ruta donde guardar los resultados en JSON")
+    args = parser.parse_args(argv)
+
+    resultados = []
+    print(f"{'escenario':<22}{'ops/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'mem KiB':>11}")
+    for nombre in args.escenarios:
+        r = ejecutar(nombre, args.iteraciones)
+        resultados.append(r)
+        print(f"{nombre:<22}{r['ops_por_s']:>9}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['pico_memoria_kib']:>11}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+    return resultados
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Sustituto local de `google.generativeai` para medir app.py sin red ni clave API.
+
+Imita lo que usa la app: configure, GenerativeModel.generate_content (con y sin
+stream), caching.CachedContent, upload_file, get_file, get_model y delete_file, con
+latencias, tamaños de chunk y errores 429 configurables mediante CONFIG.
+
+Uso:
+    import fake_genai
+    fake_genai.instalar()          # antes de importar/ejecutar app.py
+    fake_genai.CONFIG.longitud_respuesta = 20000
+"""
+
+import hashlib
+import importlib.util
+import os
+import sys
+import threading
+import time
+import types
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+
+@dataclass
+class ConfiguracionFalsa:
+    latencia_primer_chunk: float = 0.05   # Segundos hasta el primer chunk (o hasta la respuesta sin stream)
+    latencia_entre_chunks: float = 0.002  # Segundos entre chunks consecutivos
+    tamano_chunk: int = 40                # Caracteres por chunk
+    longitud_respuesta: int = 2000        # Caracteres totales de cada respuesta
+    latencia_subida: float = 0.2          # Segundos que tarda upload_file
+    segundos_hasta_activo: float = 0.0    # Tiempo en estado PROCESSING tras la subida
+    errores_429: int = 0                  # Próximas N llamadas que fallarán con 429
+    modelos_sin_cuota: set = field(default_factory=set)  # Modelos que siempre responden 429
+    retry_delay: float = 0.2              # Valor de "Please retry in Xs" en los 429
+
+
+CONFIG = ConfiguracionFalsa()
+ESTADISTICAS = {"generate_content": 0, "upload_file": 0, "delete_file": 0, "errores_429": 0, "cached_content_create": 0}
+_lock = threading.Lock()
+_archivos = {}
+_contextos = {}
+
+# Bloque de markdown repetido para construir respuestas con títulos, listas y párrafos
+_TEXTO_BASE = (
+    "## Revisión del documento\n\n"
+    "El documento presenta **objetivo** y **alcance**, pero faltan responsables.\n\n"
+    "- Actividad 1: definir el procedimiento.\n"
+    "- Actividad 2: registrar evidencias.\n\n"
+)
+
+
+def _contar(clave):
+    with _lock:
+        ESTADISTICAS[clave] += 1
+
+
+def reiniciar():
+    """Restablece la configuración y los contadores."""
+    global CONFIG
+    CONFIG = ConfiguracionFalsa()
+    for clave in ESTADISTICAS:
+        ESTADISTICAS[clave] = 0
+    _archivos.clear()
+    _contextos.clear()
+
+
+def _texto_respuesta():
+    repeticiones = CONFIG.longitud_respuesta // len(_TEXTO_BASE) + 1
+    return (_TEXTO_BASE * repeticiones)[:CONFIG.longitud_respuesta]
+
+
+def _chunk(texto, uso=None):
+    parte = types.SimpleNamespace(text=texto)
+    contenido = types.SimpleNamespace(parts=[parte])
+    chunk = types.SimpleNamespace(candidates=[types.SimpleNamespace(content=contenido)], text=texto)
+    chunk.usage_metadata = uso
+    return chunk
+
+
+def _uso(contents, texto):
+    entrada = sum(len(str(c)) for c in (contents if isinstance(contents, list) else [contents]))
+    return types.SimpleNamespace(prompt_token_count=entrada // 4, candidates_token_count=len(texto) // 4)
+
+
+class ResourceExhausted(Exception):
+    """Mismo mensaje que el 429 real de la API."""
+
+
+class GenerativeModel:
+    def __init__(self, model_name="gemini-2.5-flash", system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.cached_content = None
+
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        modelo = cls(model_name=cached_content.model, system_instruction=cached_content.system_instruction)
+        modelo.cached_content = cached_content
+        return modelo
+
+    def _quizas_429(self):
+        with _lock:
+            fallar = self.model_name in CONFIG.modelos_sin_cuota or CONFIG.errores_429 > 0
+            if fallar and self.model_name not in CONFIG.modelos_sin_cuota:
+                CONFIG.errores_429 -= 1
+        if fallar:
+            _contar("errores_429")
+            raise ResourceExhausted(
+                f"429 You exceeded your current quota. Please retry in {CONFIG.retry_delay}s"
+            )
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        _contar("generate_content")
+        # Igual que el SDK: con stream=True los errores saltan al hacer la llamada
+        self._quizas_429()
+        time.sleep(CONFIG.latencia_primer_chunk)
+        texto = _texto_respuesta()
+        uso = _uso(contents, texto)
+        if not stream:
+            return _chunk(texto, uso)
+
+        def generador():
+            paso = max(1, CONFIG.tamano_chunk)
+            for i in range(0, len(texto), paso):
+                if i:
+                    time.sleep(CONFIG.latencia_entre_chunks)
+                yield _chunk(texto[i:i + paso], uso if i + paso >= len(texto) else None)
+
+        return generador()
+
+
+def configure(**kwargs):
+    pass
+
+
+class CachedContent:
+    """Caché de contexto falsa: solo guarda lo que se le pasa y su expiración."""
+
+    def __init__(self, model, system_instruction, contents, ttl):
+        self.name = f"cachedContents/{len(_contextos)}"
+        self.model = model
+        self.system_instruction = system_instruction
+        self.contents = contents
+        self.expire_time = datetime.now(timezone.utc) + (ttl or timedelta(hours=1))
+
+    @classmethod
+    def create(cls, model, *, display_name=None, system_instruction=None, contents=None, ttl=None, **kwargs):
+        _contar("cached_content_create")
+        cache = cls(model, system_instruction, contents, ttl)
+        with _lock:
+            _contextos[cache.name] = cache
+        return cache
+
+    def update(self, *, ttl=None, expire_time=None):
+        self.expire_time = expire_time or datetime.now(timezone.utc) + (ttl or timedelta(hours=1))
+
+    def delete(self):
+        with _lock:
+            _contextos.pop(self.name, None)
+
+
+caching = types.SimpleNamespace(CachedContent=CachedContent)
+
+
+def _estado(archivo):
+    if time.monotonic() - archivo["_subido"] >= CONFIG.segundos_hasta_activo:
+        return "ACTIVE"
+    return "PROCESSING"
+
+
+def _file(archivo):
+    return types.SimpleNamespace(
+        name=archivo["name"],
+        display_name=archivo["display_name"],
+        mime_type=archivo["mime_type"],
+        size_bytes=archivo["size_bytes"],
+        expiration_time=archivo["expiration_time"],
+        state=types.SimpleNamespace(name=_estado(archivo)),
+        uri=f"https://falso.local/{archivo['name']}",
+    )
+
+
+def upload_file(path, *, mime_type=None, name=None, display_name=None, resumable=True):
+    _contar("upload_file")
+    if hasattr(path, "read"):
+        datos = path.read()
+    else:
+        with open(path, "rb") as f:
+            datos = f.read()
+    time.sleep(CONFIG.latencia_subida)
+    nombre = name or f"files/{hashlib.sha256(datos).hexdigest()[:12]}{len(_archivos)}"
+    archivo = {
+        "name": nombre,
+        "display_name": display_name or os.path.basename(str(path)),
+        "mime_type": mime_type or "application/octet-stream",
+        "size_bytes": len(datos),
+        "expiration_time": datetime.now(timezone.utc) + timedelta(hours=48),
+        "_subido": time.monotonic(),
+    }
+    with _lock:
+        _archivos[nombre] = archivo
+    return _file(archivo)
+
+
+def get_model(name):
+    """Metadatos del modelo (la app la usa para abrir la conexión al arrancar)."""
+    time.sleep(CONFIG.latencia_primer_chunk)
+    return types.SimpleNamespace(name=name, input_token_limit=1048576, output_token_limit=65536)
+
+
+def get_file(name):
+    with _lock:
+        archivo = _archivos.get(name)
+    if archivo is None:
+        raise KeyError(f"404 File {name} not found")
+    return _file(archivo)
+
+
+def delete_file(name):
+    _contar("delete_file")
+    with _lock:
+        _archivos.pop(name, None)
+
+
+def instalar():
+    """Registra este módulo como `google.generativeai` (y `google` si no existe)."""
+    modulo = sys.modules[__name__]
+    if "google" not in sys.modules:
+        if importlib.util.find_spec("google") is None:
+            paquete = types.ModuleType("google")
+            paquete.__path__ = []
+            sys.modules["google"] = paquete
+        else:
+            importlib.import_module("google")
+    sys.modules["google.generativeai"] = modulo
+    sys.modules["google"].generativeai = modulo
+    return modulo
@@ -0,0 +1,2803 @@
+"""
+Núcleo de AliadoDoc sin Streamlit: procesamiento de archivos, subidas a la API de
+Archivos, limitador de cuota, cachés, generación con Gemini, revisión de estructura,
+llenado de plantillas e índice de referencia.
+
+Lo usan la interfaz (app.py) y la revisión en lote (revision_lote.py). Importarlo no
+arranca ninguna interfaz ni crea archivos: los recursos compartidos se crean la
+primera vez que se piden y los avisos para el usuario pasan por `avisos`, que la
+app sustituye por su versión con Streamlit.
+"""
+
+import time
+import io
+import os
+import sys
+import importlib
+import inspect
+import functools
+from pathlib import Path
+import zipfile
+import re
+import hashlib
+import threading
+import random
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+import codecs
+import difflib
+import unicodedata
+import contextlib
+import mimetypes
+import math
+import heapq
+import tempfile
+import shutil
+import uuid
+import datetime
+import json
+import sqlite3
+from collections import Counter, OrderedDict, deque
+import logging
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+
+# --- SISTEMA DE CONDUCTA (TU GEM) ---
+# 🚨 PEGA TU PROMPT COMPLETO DE CONDUCTA AQUÍ 🚨
+SISTEMA_DE_CONDUCTA = os.environ.get("GEM_PROMPT", 'Actúa como un asistente experto en creación de documentos institucionales.')
+
+# Consulta del botón "Asesoría Rápida" (la misma que se pre-analiza)
+PROMPT_ASESORIA_RAPIDA = """
+        Cordial Saludo, deseo que me apoyes con los siguientes temas:
+        - Qué información falta según los campos obligatorios y cual de la informacion disponible podria ayudarme a completarla.
+        - Cómo completarla, con sugerencias, usuando el documento suministrado y apoyar con el orden del documento.
+        - hay algun estandar documental que podria tener en cuenta para mejorar el documento?
+        - Si no tengo nada o hay algo faltante, dame un ejemplo básico para orientarme en el tema faltante.
+        """
+
+
+# === Recursos compartidos por el proceso y avisos al usuario ===
+
+def recurso_del_proceso(funcion=None, *, max_entradas=None):
+    """
+    Equivalente de st.cache_resource sin Streamlit: guarda el resultado por argumentos
+    (los que empiezan por "_" no cuentan para la clave, como en Streamlit) y, si varios
+    hilos lo piden a la vez, lo crea uno solo mientras los demás esperan.
+    """
+    if funcion is None:
+        return lambda f: recurso_del_proceso(f, max_entradas=max_entradas)
+    parametros = list(inspect.signature(funcion).parameters)
+    lock = threading.Lock()
+    entradas = OrderedDict()  # clave -> resultado, del menos al más reciente
+    creando = {}              # clave -> lock de quien lo está creando
+
+    @functools.wraps(funcion)
+    def envoltura(*args, **kwargs):
+        valores = dict(zip(parametros, args), **kwargs)
+        clave = tuple((p, valores[p]) for p in parametros if p in valores and not p.startswith("_"))
+        with lock:
+            if clave in entradas:
+                entradas.move_to_end(clave)
+                return entradas[clave]
+            lock_clave = creando.setdefault(clave, threading.Lock())
+        with lock_clave:
+            with lock:
+                if clave in entradas:
+                    return entradas[clave]
+            try:
+                resultado = funcion(*args, **kwargs)
+            except BaseException:
+                with lock:
+                    creando.pop(clave, None)
+                raise
+            with lock:
+                entradas[clave] = resultado
+                creando.pop(clave, None)
+                if max_entradas is not None and len(entradas) > max_entradas:
+                    entradas.popitem(last=False)
+            return resultado
+
+    envoltura.clear = lambda: entradas.clear()
+    return envoltura
+
+
+class Avisos:
+    """
+    Avisos para quien usa el núcleo. Sin interfaz, los errores van a stderr y el resto
+    se omite; app.py instala una subclase que los muestra con Streamlit.
+    """
+
+    def error(self, texto):
+        print(texto, file=sys.stderr)
+
+    def notificar(self, texto):
+        """Aviso breve y prescindible (en la app, un toast)."""
+
+    def informar(self, texto):
+        """Aviso informativo dentro de la respuesta (p.ej. el paso de pro a flash)."""
+
+    def progreso(self, texto):
+        """Contexto mientras dura una espera (en la app, un spinner)."""
+        return contextlib.nullcontext()
+
+
+avisos = Avisos()
+
+
+# === Métricas de latencia, tokens y cuota ===
+
+# Archivo opcional para el log estructurado (JSON por línea); por defecto va a stderr
+METRICAS_LOG_ARCHIVO = os.environ.get("METRICAS_LOG_ARCHIVO", "")
+
+
+class Metricas:
+    """
+    Contadores y resúmenes (conteo/suma/máximo) etiquetados, compartidos por todas
+    las sesiones, más un registro de los últimos eventos. Cada evento se escribe
+    también como una línea JSON en el logger "aliadodoc".
+    """
+
+    def __init__(self, max_eventos=200):
+        self._lock = threading.Lock()
+        self._contadores = {}   # (nombre, etiquetas) -> valor
+        self._resumenes = {}    # (nombre, etiquetas) -> [conteo, suma, máximo]
+        self._eventos = deque(maxlen=max_eventos)
+        self._logger = logging.getLogger("aliadodoc")
+
+    def incrementar(self, nombre, valor=1, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        clave = (nombre, tuple(sorted(etiquetas.items())))
+        with self._lock:
+            resumen = self._resumenes.setdefault(clave, [0, 0.0, 0.0])
+            resumen[0] += 1
+            resumen[1] += valor
+            resumen[2] = max(resumen[2], valor)
+
+    def evento(self, tipo, **datos):
+        registro = {"ts": round(time.time(), 3), "evento": tipo, **datos}
+        with self._lock:
+            self._eventos.append(registro)
+        self._logger.info(json.dumps(registro, ensure_ascii=False, default=str))
+
+    def eventos_recientes(self) -> list:
+        with self._lock:
+            return list(self._eventos)
+
+    def tabla_resumenes(self) -> list:
+        """Filas {métrica, etiquetas, n, promedio, máximo} para el panel de administración."""
+        with self._lock:
+            return [
+                {
+                    "métrica": nombre,
+                    "etiquetas": ", ".join(f"{k}={v}" for k, v in etiquetas),
+                    "n": conteo,
+                    "promedio": round(suma / conteo, 3) if conteo else 0,
+                    "máximo": round(maximo, 3),
+                }
+                for (nombre, etiquetas), (conteo, suma, maximo) in sorted(self._resumenes.items())
+            ]
+
+    def tabla_contadores(self) -> list:
+        with self._lock:
+            return [
+                {"métrica": nombre, "etiquetas": ", ".join(f"{k}={v}" for k, v in etiquetas), "valor": valor}
+                for (nombre, etiquetas), valor in sorted(self._contadores.items())
+            ]
+
+    def texto_prometheus(self) -> str:
+        """Exposición en formato de texto de Prometheus (contadores y summaries sin cuantiles)."""
+        def etiquetas_prom(etiquetas):
+            if not etiquetas:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in etiquetas) + "}"
+
+        lineas = []
+        with self._lock:
+            for nombre in sorted({n for n, _ in self._contadores}):
+                lineas.append(f"# TYPE {nombre} counter")
+                for (n, etiquetas), valor in sorted(self._contadores.items()):
+                    if n == nombre:
+                        lineas.append(f"{nombre}{etiquetas_prom(etiquetas)} {valor}")
+            for nombre in sorted({n for n, _ in self._resumenes}):
+                lineas.append(f"# TYPE {nombre} summary")
+                for (n, etiquetas), (conteo, suma, _) in sorted(self._resumenes.items()):
+                    if n == nombre:
+                        lineas.append(f"{nombre}_count{etiquetas_prom(etiquetas)} {conteo}")
+                        lineas.append(f"{nombre}_sum{etiquetas_prom(etiquetas)} {suma}")
+        return "\n".join(lineas) + "\n"
+
+
+@recurso_del_proceso
+def obtener_metricas() -> Metricas:
+    """Instancia única de métricas del servidor; configura el log estructurado la primera vez."""
+    logger = logging.getLogger("aliadodoc")
+    if not logger.handlers:
+        handler = logging.FileHandler(METRICAS_LOG_ARCHIVO) if METRICAS_LOG_ARCHIVO else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return Metricas()
+
+
+def registrar_generacion(metricas, modelo, inicio, primer_chunk, fin, n_chunks, uso=None, origen="modelo"):
+    """Registra tiempos, velocidad y tokens de una respuesta en streaming."""
+    total = fin - inicio
+    datos = {"modelo": modelo, "origen": origen, "total_s": round(total, 3), "chunks": n_chunks}
+    metricas.observar("aliadodoc_respuesta_segundos", total, modelo=modelo, origen=origen)
+    if primer_chunk is not None:
+        ttfc = primer_chunk - inicio
+        datos["primer_chunk_s"] = round(ttfc, 3)
+        metricas.observar("aliadodoc_primer_chunk_segundos", ttfc, modelo=modelo, origen=origen)
+        duracion_stream = fin - primer_chunk
+        if duracion_stream > 0:
+            datos["chunks_por_s"] = round(n_chunks / duracion_stream, 2)
+            metricas.observar("aliadodoc_chunks_por_segundo", n_chunks / duracion_stream, modelo=modelo)
+    if uso is not None:
+        for campo, nombre in (("prompt_token_count", "entrada"), ("candidates_token_count", "salida")):
+            tokens = getattr(uso, campo, None)
+            if tokens:
+                datos[f"tokens_{nombre}"] = tokens
+                metricas.incrementar("aliadodoc_tokens_total", tokens, modelo=modelo, tipo=nombre)
+    metricas.incrementar("aliadodoc_respuestas_total", modelo=modelo, origen=origen)
+    metricas.evento("respuesta", **datos)
+    if origen != "cache":
+        # Desglose de la primera respuesta del proceso para el perfil de arranque
+        perfil = obtener_perfil_arranque()
+        if primer_chunk is not None:
+            perfil.registrar("primera respuesta: primer chunk", primer_chunk - inicio)
+        perfil.registrar("primera respuesta: total", total)
+
+
+# === Imports diferidos y perfil de arranque ===
+
+class PerfilArranque:
+    """
+    Duración de cada fase del arranque del proceso: imports, imports diferidos,
+    precalentamiento y primera ejecución y primera respuesta. Cada fase se anota una
+    sola vez; también se publica como métrica aliadodoc_arranque_segundos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fases = {}  # fase -> segundos, en orden de llegada
+
+    def registrar(self, fase, segundos) -> bool:
+        with self._lock:
+            if fase in self._fases:
+                return False
+            self._fases[fase] = segundos
+        obtener_metricas().observar("aliadodoc_arranque_segundos", segundos, fase=fase)
+        return True
+
+    @contextlib.contextmanager
+    def medir(self, fase):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.registrar(fase, time.perf_counter() - inicio)
+
+    def informe(self) -> list:
+        with self._lock:
+            return [{"fase": fase, "segundos": round(segundos, 3)} for fase, segundos in self._fases.items()]
+
+
+@recurso_del_proceso
+def obtener_perfil_arranque() -> PerfilArranque:
+    return PerfilArranque()
+
+
+class ModuloDiferido:
+    """
+    Importa un módulo pesado la primera vez que se usa uno de sus atributos, en lugar
+    de al importar este módulo. El tiempo del import queda en el perfil de arranque.
+    """
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+
+    def __getattr__(self, atributo):
+        modulo = sys.modules.get(self._nombre)
+        if modulo is None:
+            inicio = time.perf_counter()
+            modulo = importlib.import_module(self._nombre)
+            obtener_perfil_arranque().registrar(f"import {self._nombre}", time.perf_counter() - inicio)
+        return getattr(modulo, atributo)
+
+
+genai = ModuloDiferido("google.generativeai")
+Image = ModuloDiferido("PIL.Image")
+ImageOps = ModuloDiferido("PIL.ImageOps")
+
+
+# === Helpers para descargas de documentos del repositorio ===
+
+REPO_ROOT = Path(__file__).parent  # Carpeta donde está este archivo .py
+
+def crear_zip_documentos(archivos: dict) -> io.BytesIO:
+    """
+    Crea un ZIP en memoria con varios archivos.
+    archivos: dict {nombre_en_zip: bytes}
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for nombre_zip, contenido in archivos.items():
+            zf.writestr(nombre_zip, contenido)
+    buffer.seek(0)
+    return buffer
+
+
+# === Plantillas de docs/: se leen y empaquetan una sola vez por versión ===
+
+DOCS_DIR = REPO_ROOT / "docs"
+MIME_POR_EXTENSION = {
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".pdf": "application/pdf",
+}
+# Etiquetas con tilde para los botones; el resto se deriva del nombre del archivo
+ETIQUETAS_PLANTILLAS = {"Plantilla_Guia.docx": "Guía"}
+
+
+def firma_plantillas() -> tuple:
+    """
+    (nombre, tamaño, mtime) de cada archivo de docs/. Es un stat por archivo,
+    barato en cada rerun, y cambia en cuanto se agrega o modifica una plantilla.
+    """
+    if not DOCS_DIR.is_dir():
+        return ()
+    return tuple(sorted(
+        (entrada.name, entrada.stat().st_size, entrada.stat().st_mtime_ns)
+        for entrada in os.scandir(DOCS_DIR)
+        if entrada.is_file() and not entrada.name.startswith((".", "~$"))
+    ))
+
+
+@recurso_del_proceso(max_entradas=4)
+def _zip_plantillas(hash_conjunto: str, _archivos: tuple) -> bytes:
+    # Solo se reconstruye si cambia el contenido (no basta con que cambie el mtime)
+    return crear_zip_documentos({a["nombre"]: a["bytes"] for a in _archivos}).getvalue()
+
+
+@recurso_del_proceso(max_entradas=4)
+def catalogo_plantillas(firma: tuple) -> dict:
+    """
+    Lee todas las plantillas de docs/ y devuelve sus bytes, MIME y hash junto con el
+    ZIP de todas. Se guarda con cache_resource para servir siempre los mismos
+    objetos, sin copiar los bytes en cada rerun.
+    """
+    archivos = []
+    for nombre, _, _ in firma:
+        datos = (DOCS_DIR / nombre).read_bytes()
+        base = Path(nombre).stem
+        archivos.append({
+            "nombre": nombre,
+            "etiqueta": ETIQUETAS_PLANTILLAS.get(nombre, base.replace("Plantilla_", "").replace("_", " ")),
+            "clave": "dl_" + base.replace("Plantilla_", "").lower(),
+            "mime": MIME_POR_EXTENSION.get(Path(nombre).suffix.lower(), "application/octet-stream"),
+            "bytes": datos,
+            "hash": calcular_hash_contenido(datos),
+        })
+    archivos = tuple(archivos)
+    hash_conjunto = calcular_hash_contenido("".join(a["hash"] for a in archivos).encode())
+    return {"archivos": archivos, "zip": _zip_plantillas(hash_conjunto, archivos)}
+
+
+# === Cliente y modelos de Gemini compartidos por el proceso ===
+
+@recurso_del_proceso
+def configurar_genai(api_key: str) -> bool:
+    """
+    Configura el cliente global de google-generativeai una sola vez por clave.
+    Volver a llamar a genai.configure descarta los clientes (y sus conexiones HTTP),
+    así que todas las sesiones del servidor reutilizan esta configuración.
+    """
+    genai.configure(api_key=api_key)
+    return True
+
+
+@recurso_del_proceso
+def _modelo_en_cache(model_name: str, hash_instruccion: str, _system_instruction):
+    # El texto de la instrucción no se usa como clave (va con "_"); la clave es su hash
+    return genai.GenerativeModel(model_name=model_name, system_instruction=_system_instruction)
+
+
+def obtener_modelo(api_key, model_name, system_instruction=None):
+    """
+    Devuelve un GenerativeModel reutilizable para (modelo, instrucción de sistema).
+    Los modelos no guardan estado entre llamadas a generate_content, por lo que es
+    seguro compartirlos entre sesiones concurrentes.
+    """
+    if api_key:
+        configurar_genai(api_key)
+    hash_instruccion = calcular_hash_contenido((system_instruction or "").encode())
+    return _modelo_en_cache(model_name, hash_instruccion, system_instruction)
+
+
+# === Caché de archivos subidos a la API de Archivos de Gemini ===
+
+# La API de Archivos conserva cada archivo 48 horas. Dejamos un margen para no
+# reutilizar un archivo remoto que esté a punto de expirar.
+GEMINI_FILES_TTL_SEGUNDOS = 48 * 60 * 60
+GEMINI_FILES_MARGEN_SEGUNDOS = 10 * 60
+
+
+def calcular_hash_contenido(datos: bytes) -> str:
+    """Devuelve el hash SHA-256 (hex) de los bytes indicados."""
+    return hashlib.sha256(datos).hexdigest()
+
+
+def expiracion_archivo_gemini(file_obj) -> float:
+    """
+    Devuelve el instante (epoch) en que expira el archivo remoto.
+    Si el objeto no trae expiration_time, se asume la retención estándar.
+    """
+    expiracion = getattr(file_obj, "expiration_time", None)
+    try:
+        return expiracion.timestamp()
+    except Exception:
+        return time.time() + GEMINI_FILES_TTL_SEGUNDOS
+
+
+class CacheArchivosGemini:
+    """
+    Registro compartido entre sesiones: hash del contenido -> objeto File remoto.
+    Lleva la expiración de cada archivo y cuántas sesiones lo usan, para que
+    una sesión no borre un archivo que otra sigue utilizando.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entradas = {}  # clave -> {"file_obj", "expira", "refs"}
+
+    @staticmethod
+    def _vigente(entrada) -> bool:
+        return entrada["expira"] > time.time() + GEMINI_FILES_MARGEN_SEGUNDOS
+
+    def _purgar_expirados(self):
+        # Solo se olvidan los que nadie usa: los que siguen en uso se liberan (y borran) con `liberar`
+        for clave in [c for c, e in self._entradas.items() if e["refs"] <= 0 and not self._vigente(e)]:
+            del self._entradas[clave]
+
+    def obtener(self, clave):
+        """Devuelve el File vigente para la clave (sumando una referencia) o None."""
+        with self._lock:
+            self._purgar_expirados()
+            entrada = self._entradas.get(clave)
+            if entrada is None or not self._vigente(entrada):
+                return None
+            entrada["refs"] += 1
+            return entrada["file_obj"]
+
+    def registrar(self, clave, file_obj):
+        """
+        Registra un archivo recién subido con una referencia.
+        Si otra sesión registró el mismo contenido entretanto, devuelve ese File
+        (el llamador debe borrar el duplicado que acaba de subir). Una entrada a punto
+        de expirar se reemplaza; sus sesiones la dejan expirar en Gemini.
+        """
+        with self._lock:
+            self._purgar_expirados()
+            entrada = self._entradas.get(clave)
+            if entrada is not None and self._vigente(entrada):
+                entrada["refs"] += 1
+                return entrada["file_obj"]
+            self._entradas[clave] = {
+                "file_obj": file_obj,
+                "expira": expiracion_archivo_gemini(file_obj),
+                "refs": 1,
+            }
+            return file_obj
+
+    def clave_de(self, file_obj):
+        """Clave con la que está registrado el File (None si no está en el registro)."""
+        nombre = getattr(file_obj, "name", None)
+        with self._lock:
+            return next((c for c, e in self._entradas.items() if e["file_obj"].name == nombre), None)
+
+    def liberar(self, file_obj) -> bool:
+        """
+        Resta una referencia al archivo. Devuelve True si ya nadie lo usa y por tanto
+        puede borrarse en Gemini. Un archivo que el registro no conoce (reemplazado o
+        nunca registrado) no se borra: puede usarlo otra sesión y expira solo.
+        """
+        nombre = getattr(file_obj, "name", None)
+        with self._lock:
+            for clave, entrada in self._entradas.items():
+                if entrada["file_obj"].name == nombre:
+                    entrada["refs"] -= 1
+                    if entrada["refs"] > 0:
+                        return False
+                    del self._entradas[clave]
+                    return True
+            return False
+
+
+@recurso_del_proceso
+def obtener_cache_archivos_gemini() -> CacheArchivosGemini:
+    """Instancia única del caché de archivos, compartida por todas las sesiones del servidor."""
+    return CacheArchivosGemini()
+
+
+# --- Funciones Auxiliares para Archivos (Mantenidas) ---
+
+# === Archivos temporales: únicos por uso, escritos por bloques y con limpieza ===
+
+SPILL_DIR = Path(os.environ.get("SPILL_DIR", Path(tempfile.gettempdir()) / "aliadodoc_spill"))
+# Disco máximo que pueden ocupar los temporales; por encima se borran los huérfanos más antiguos
+SPILL_PRESUPUESTO_BYTES = int(os.environ.get("SPILL_PRESUPUESTO_MB", "1024")) * 1024 * 1024
+SPILL_TAMANO_BLOQUE = 1 << 20
+
+
+class GestorSpill:
+    """
+    Temporales del proceso: cada uso recibe un nombre único (dos usuarios con
+    "Procedimiento.docx" no se pisan), el contenido se copia por bloques sin duplicarlo
+    en memoria y el archivo se borra al salir del bloque `with`, aunque haya errores.
+    Si el directorio supera el presupuesto, se borran los archivos que no están en uso
+    (restos de procesos anteriores), del más antiguo al más reciente.
+    """
+
+    def __init__(self, directorio: Path, presupuesto_bytes: int):
+        self._dir = directorio
+        self._presupuesto = presupuesto_bytes
+        self._lock = threading.Lock()
+        self._en_uso = set()
+        self._dir.mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def archivo(self, origen, sufijo=""):
+        """Escribe `origen` (bytes, memoryview o file-like) en un temporal único y devuelve su ruta."""
+        ruta = self._dir / f"{uuid.uuid4().hex}{sufijo}"
+        with self._lock:
+            self._en_uso.add(ruta)
+        try:
+            with open(ruta, "wb") as f:
+                if isinstance(origen, (bytes, bytearray, memoryview)):
+                    f.write(origen)
+                else:
+                    origen.seek(0)
+                    shutil.copyfileobj(origen, f, SPILL_TAMANO_BLOQUE)
+            self.recoger_basura()
+            yield ruta
+        finally:
+            with self._lock:
+                self._en_uso.discard(ruta)
+            ruta.unlink(missing_ok=True)
+
+    def recoger_basura(self):
+        """Borra temporales que nadie usa hasta volver al presupuesto. Devuelve los bytes ocupados."""
+        archivos = []
+        for ruta in self._dir.iterdir():
+            try:
+                info = ruta.stat()
+            except FileNotFoundError:
+                continue
+            archivos.append((info.st_mtime, info.st_size, ruta))
+        total = sum(tamano for _, tamano, _ in archivos)
+        with self._lock:
+            en_uso = set(self._en_uso)
+        for _, tamano, ruta in sorted(archivos):
+            if total <= self._presupuesto:
+                break
+            if ruta not in en_uso:
+                ruta.unlink(missing_ok=True)
+                total -= tamano
+        if total > self._presupuesto:
+            print(f"Advertencia: Los temporales en uso ocupan {total / 1e6:.0f} MB, más que el presupuesto de spill.")
+        return total
+
+
+@recurso_del_proceso
+def obtener_gestor_spill() -> GestorSpill:
+    """Gestor único del proceso; al crearlo se recogen los restos de ejecuciones anteriores."""
+    gestor = GestorSpill(SPILL_DIR, SPILL_PRESUPUESTO_BYTES)
+    gestor.recoger_basura()
+    return gestor
+
+
+# === Subidas en segundo plano ===
+
+# Tiempo máximo esperando a que Gemini termine de procesar un archivo (estado ACTIVE)
+SUBIDA_TIMEOUT_ACTIVO_SEGUNDOS = float(os.environ.get("SUBIDA_TIMEOUT_ACTIVO", "120"))
+SUBIDA_INTERVALO_SONDEO_SEGUNDOS = 1.0
+
+
+@recurso_del_proceso
+def obtener_executor_subidas() -> ThreadPoolExecutor:
+    """Pool de hilos del proceso para las subidas a la API de Archivos."""
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("SUBIDAS_HILOS", "4")), thread_name_prefix="aliadodoc-subida")
+
+
+class SubidaEnSegundoPlano:
+    """
+    Subida a la API de Archivos en curso. Se guarda en la sesión en lugar del File
+    mientras tanto; `fase` informa del progreso (subiendo, procesando, activo, error).
+    """
+
+    def __init__(self, nombre, cache_archivos):
+        self.nombre = nombre
+        self.fase = "en cola"
+        self.inicio = time.monotonic()
+        self.futuro = None
+        self._cache_archivos = cache_archivos
+        self._cancelada = False
+
+    def terminada(self) -> bool:
+        return self.futuro is not None and self.futuro.done()
+
+    def segundos(self) -> float:
+        return time.monotonic() - self.inicio
+
+    def cancelar(self):
+        """Cancela la subida; si ya terminó o está en curso, el archivo remoto se libera al acabar."""
+        self._cancelada = True
+        # Sin futuro todavía, el hilo de subida verá la marca y no llegará a subir nada
+        if self.futuro is None or self.futuro.cancel():
+            return
+        self.futuro.add_done_callback(self._liberar_si_cancelada)
+
+    def _liberar_si_cancelada(self, futuro):
+        try:
+            file_obj = futuro.result()
+        except Exception:
+            return
+        if self._cache_archivos.liberar(file_obj):
+            try:
+                genai.delete_file(name=file_obj.name)
+            except Exception as e:
+                print(f"Advertencia: No se pudo eliminar el archivo de Gemini: {e}")
+
+
+def _subir_y_esperar_activo(subida, origen, display_name, mime_type, clave_cache, metricas):
+    """
+    Trabajo del hilo de subida: sube el archivo, espera a que Gemini lo deje en
+    estado ACTIVE y lo registra en la caché compartida. No usa Streamlit.
+    `origen` es un objeto tipo archivo; si el SDK solo acepta rutas, se vuelca a un
+    temporal único que se borra al terminar la subida.
+    """
+    if subida._cancelada:
+        raise CancelledError()
+    subida.fase = "subiendo"
+    inicio_subida = time.monotonic()
+    try:
+        try:
+            file_obj = genai.upload_file(path=origen, mime_type=mime_type, display_name=display_name)
+        except TypeError:
+            # SDK viejo: upload_file solo acepta rutas
+            with obtener_gestor_spill().archivo(origen, sufijo=Path(display_name).suffix) as ruta:
+                file_obj = genai.upload_file(path=ruta, mime_type=mime_type, display_name=display_name)
+    except BaseException:
+        subida.fase = "error"
+        raise
+    duracion_subida = time.monotonic() - inicio_subida
+
+    subida.fase = "procesando"
+    try:
+        limite = time.monotonic() + SUBIDA_TIMEOUT_ACTIVO_SEGUNDOS
+        estado = getattr(getattr(file_obj, "state", None), "name", "ACTIVE")
+        while estado == "PROCESSING":
+            if time.monotonic() > limite:
+                raise TimeoutError(f"Gemini no terminó de procesar '{display_name}' a tiempo.")
+            time.sleep(SUBIDA_INTERVALO_SONDEO_SEGUNDOS)
+            file_obj = genai.get_file(name=file_obj.name)
+            estado = getattr(getattr(file_obj, "state", None), "name", "ACTIVE")
+        if estado == "FAILED":
+            raise RuntimeError(f"Gemini no pudo procesar '{display_name}' (Unsupported format?).")
+    except BaseException:
+        # El archivo ya está en Gemini pero nadie lo va a usar: se borra para no dejarlo huérfano
+        subida.fase = "error"
+        try:
+            genai.delete_file(name=file_obj.name)
+        except Exception as e:
+            print(f"Advertencia: No se pudo eliminar el archivo de Gemini tras la subida fallida: {e}")
+        raise
+
+    metricas.observar("aliadodoc_subida_segundos", duracion_subida)
+    metricas.observar("aliadodoc_subida_hasta_activo_segundos", subida.segundos())
+    metricas.incrementar("aliadodoc_subidas_total", resultado="subida")
+    metricas.evento("subida", archivo=display_name, duracion_s=round(duracion_subida, 3),
+                    hasta_activo_s=round(subida.segundos(), 3))
+
+    file_registrado = subida._cache_archivos.registrar(clave_cache, file_obj)
+    if file_registrado is not file_obj:
+        # Otra sesión subió el mismo contenido mientras tanto: nos quedamos con el suyo
+        genai.delete_file(name=file_obj.name)
+    subida.fase = "activo"
+    return file_registrado
+
+
+def upload_file_to_gemini(api_key, uploaded_file):
+    """
+    Sube el archivo a la API de Archivos de Gemini usando google-generativeai.
+    Si el contenido ya está en Gemini devuelve directamente el File; si no, inicia la
+    subida en segundo plano y devuelve una SubidaEnSegundoPlano (ver esperar_subida).
+    """
+    if not api_key:
+        avisos.error("Error: La clave API no está configurada. No se puede subir el archivo binario.")
+        return None
+
+    # Si el mismo contenido ya se subió (en esta u otra sesión) y sigue vigente, se reutiliza
+    cache_archivos = obtener_cache_archivos_gemini()
+    clave_cache = f"{calcular_hash_contenido(api_key.encode())[:16]}:{calcular_hash_contenido(uploaded_file.getvalue())}"
+    metricas = obtener_metricas()
+    file_obj = cache_archivos.obtener(clave_cache)
+    if file_obj is not None:
+        metricas.incrementar("aliadodoc_subidas_total", resultado="reutilizada")
+        avisos.notificar(f"'{uploaded_file.name}' ya estaba en Gemini; se reutiliza sin volver a subirlo.")
+        return file_obj
+
+    try:
+        configurar_genai(api_key)
+
+        # Se sube desde memoria, sin copiar a /tmp: BytesIO comparte los bytes del archivo de Streamlit
+        # y tiene su propia posición de lectura para el hilo de subida
+        origen = io.BytesIO(uploaded_file.getvalue())
+        mime_type = (getattr(uploaded_file, "type", None) or mimetypes.guess_type(uploaded_file.name)[0]
+                     or "application/octet-stream")
+
+        subida = SubidaEnSegundoPlano(uploaded_file.name, cache_archivos)
+        subida.futuro = obtener_executor_subidas().submit(
+            _subir_y_esperar_activo, subida, origen, uploaded_file.name, mime_type, clave_cache, metricas
+        )
+        avisos.notificar(f"Subiendo '{uploaded_file.name}' a Gemini en segundo plano. Puedes seguir escribiendo.")
+        return subida
+
+    except Exception as e:
+        avisos.error(f"❌ Error general al preparar la subida del archivo binario: {e}.")
+        print(f"DEBUG: Error completo al preparar la subida a Gemini: {e}")
+        return None
+
+
+def esperar_subida(subida, timeout=None):
+    """
+    Espera a que termine una SubidaEnSegundoPlano y devuelve el File de Gemini,
+    o None (mostrando el error) si la subida falló.
+    """
+    try:
+        if not subida.terminada():
+            with avisos.progreso(f"Esperando a que termine la subida de '{subida.nombre}'..."):
+                file_obj = subida.futuro.result(timeout=timeout)
+        else:
+            file_obj = subida.futuro.result()
+        avisos.notificar("Archivo binario subido con éxito a la API de Archivos.")
+        return file_obj
+
+    except AttributeError as e:
+        # Aquí llegarías si tu versión es TAN vieja que ni siquiera tiene upload_file
+        error_msg = (
+            "❌ ERROR DE COMPATIBILIDAD DE LIBRERÍA: La funcionalidad de subida de "
+            "archivos binarios (PDF, DOCX, XLSX) **no está soportada** en la versión "
+            "de la biblioteca `google-generativeai` instalada. "
+            "Actualiza el paquete `google-generativeai` a una versión reciente."
+        )
+        subida.fase = "error"
+        avisos.error(error_msg)
+        print(f"DEBUG: Error completo de subida a Gemini (Incompatibilidad de Librería): {e}")
+        return None
+
+    except Exception as e:
+        subida.fase = "error"
+        error_msg = f"❌ Error general al subir archivo binario: {e}. "
+        if "API key not valid" in str(e) or "authentication" in str(e):
+            error_msg += (
+                "Por favor, **REVISA TU CLAVE API (GEMINI_API_KEY)**, la subida falló por autenticación."
+            )
+        elif "Unsupported" in str(e) or "format" in str(e):
+            error_msg += "El formato del archivo podría no estar soportado por la API de Archivos."
+        avisos.error(error_msg)
+        print(f"DEBUG: Error completo de subida a Gemini (General): {e}")
+        return None
+
+
+
+def delete_file_from_gemini(api_key, file_obj, avisar=True):
+    """
+    Elimina el archivo de la API de Archivos de Gemini (limpieza).
+    Solo se borra en remoto cuando ninguna otra sesión lo sigue usando.
+    avisar=False omite el toast (limpiezas de otras sesiones).
+    """
+    if not api_key or not file_obj:
+        return
+    if not obtener_cache_archivos_gemini().liberar(file_obj):
+        return
+    try:
+        configurar_genai(api_key)
+        # SDK viejo: delete_file(name=...)
+        genai.delete_file(name=file_obj.name)
+        if avisar:
+            avisos.notificar(f"Archivo de Gemini '{getattr(file_obj, 'display_name', file_obj.name)}' eliminado.")
+    except AttributeError:
+        # Si tampoco existe delete_file, ignoramos silenciosamente
+        pass
+    except Exception as e:
+        print(f"Advertencia: No se pudo eliminar el archivo de Gemini: {e}")
+        pass
+
+# === Limitador de cuota (429) compartido entre sesiones ===
+
+# Peticiones por minuto permitidas por modelo (plan gratuito por defecto)
+LIMITES_RPM = {
+    "gemini-2.5-pro": int(os.environ.get("GEMINI_RPM_PRO", "5")),
+    "gemini-2.5-flash": int(os.environ.get("GEMINI_RPM_FLASH", "10")),
+}
+# Tiempo máximo que una petición espera turno antes de darse por vencida (o pasar a flash)
+ESPERA_MAXIMA_CUOTA_SEGUNDOS = float(os.environ.get("GEMINI_ESPERA_MAXIMA", "20"))
+MAX_REINTENTOS_CUOTA = 2
+
+
+class CuotaNoDisponible(Exception):
+    """El limitador local estima que no habrá cupo para el modelo dentro de la espera máxima."""
+
+    def __init__(self, model_name, espera_segundos):
+        # Mismo formato que los 429 de la API para reutilizar su manejo
+        super().__init__(
+            f"429 Quota exceeded (limitador local) para {model_name}. "
+            f"Please retry in {espera_segundos:.1f}s"
+        )
+
+
+def es_error_de_cuota(msg: str) -> bool:
+    """Indica si el mensaje de error corresponde a un 429 / cuota agotada."""
+    return ("429" in msg or
+            "exceeded your current quota" in msg.lower() or
+            "quota exceeded" in msg.lower())
+
+
+def extraer_segundos_reintento(msg: str):
+    """Extrae el tiempo de reintento sugerido por la API, o None si no viene."""
+    # Caso A: "Please retry in 31.830795196s"
+    m = re.search(r"retry in ([0-9\.]+)s", msg)
+    if m:
+        try:
+            return float(m.group(1))
+        except ValueError:
+            pass
+
+    # Caso B: "retry_delay { seconds: 31 }"
+    m2 = re.search(r"retry_delay\s*\{\s*seconds:\s*([0-9]+)", msg)
+    if m2:
+        try:
+            return float(m2.group(1))
+        except ValueError:
+            pass
+    return None
+
+
+class LimitadorCuota:
+    """
+    Token bucket por (clave API, modelo) que aprende de los 429:
+    - cada 429 vacía el cubo, bloquea hasta el retry_delay indicado y reduce la tasa a la mitad;
+    - cada éxito recupera la tasa poco a poco hasta el límite configurado.
+    Las esperas llevan jitter para que las sesiones en cola no reintenten a la vez.
+    """
+
+    def __init__(self, peticiones_por_minuto: int):
+        self._lock = threading.Lock()
+        self._capacidad = max(1, peticiones_por_minuto)
+        self._tasa_base = self._capacidad / 60.0
+        self._tasa = self._tasa_base
+        self._tokens = float(self._capacidad)
+        self._actualizado = time.monotonic()
+        self._bloqueado_hasta = 0.0
+        self._errores_seguidos = 0
+
+    def _rellenar(self, ahora):
+        self._tokens = min(self._capacidad, self._tokens + (ahora - self._actualizado) * self._tasa)
+        self._actualizado = ahora
+
+    def _espera(self, ahora) -> float:
+        espera = max(0.0, self._bloqueado_hasta - ahora)
+        if self._tokens < 1:
+            espera = max(espera, (1 - self._tokens) / self._tasa)
+        return espera
+
+    def tiempo_espera(self) -> float:
+        """Segundos estimados hasta que haya cupo (0 si hay cupo ya)."""
+        with self._lock:
+            ahora = time.monotonic()
+            self._rellenar(ahora)
+            return self._espera(ahora)
+
+    def adquirir(self, espera_maxima: float) -> bool:
+        """Consume un cupo esperando como mucho `espera_maxima` segundos."""
+        limite = time.monotonic() + espera_maxima
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._rellenar(ahora)
+                espera = self._espera(ahora)
+                if espera <= 0:
+                    self._tokens -= 1
+                    return True
+            if ahora + espera > limite:
+                return False
+            time.sleep(min(espera + random.uniform(0, min(1.0, espera * 0.2)), max(0.0, limite - ahora)))
+
+    def registrar_exito(self):
+        with self._lock:
+            self._errores_seguidos = 0
+            self._tasa = min(self._tasa_base, self._tasa + self._tasa_base * 0.1)
+
+    def registrar_429(self, retry_seconds=None):
+        with self._lock:
+            self._errores_seguidos += 1
+            if retry_seconds is None:
+                # Sin indicación de la API: backoff exponencial con jitter
+                retry_seconds = min(60.0, 2 ** self._errores_seguidos) * random.uniform(0.5, 1.0)
+            self._tokens = 0.0
+            self._tasa = max(self._tasa_base * 0.1, self._tasa * 0.5)
+            self._bloqueado_hasta = max(self._bloqueado_hasta, time.monotonic() + retry_seconds)
+
+
+@recurso_del_proceso
+def _limitador_en_cache(hash_api_key: str, model_name: str) -> LimitadorCuota:
+    return LimitadorCuota(LIMITES_RPM.get(model_name, 10))
+
+
+def obtener_limitador(api_key, model_name) -> LimitadorCuota:
+    """Limitador compartido por todas las sesiones para esta clave API y modelo."""
+    return _limitador_en_cache(calcular_hash_contenido((api_key or "").encode())[:16], model_name)
+
+
+def generar_con_cuota(api_key, model_name, system_instruction, contents, stream=True, contexto_cacheado=None):
+    """
+    Llama a generate_content respetando el limitador del modelo.
+    Ante un 429 lo registra en el limitador y reintenta mientras la espera sugerida
+    quepa en ESPERA_MAXIMA_CUOTA_SEGUNDOS; si no, relanza el error.
+    Con `contexto_cacheado` el modelo se construye desde la caché de contexto.
+    """
+    if contexto_cacheado is not None:
+        model = genai.GenerativeModel.from_cached_content(cached_content=contexto_cacheado)
+    else:
+        model = obtener_modelo(api_key, model_name, system_instruction)
+    limitador = obtener_limitador(api_key, model_name)
+    return generar_con_limitador(model, limitador, model_name, contents, stream=stream, metricas=obtener_metricas())
+
+
+def generar_con_limitador(model, limitador, model_name, contents, stream=True, metricas=None):
+    """
+    Núcleo de generar_con_cuota con el modelo y el limitador ya resueltos.
+    No usa funciones de Streamlit, así que puede llamarse desde hilos de trabajo.
+    """
+    ultimo_error = None
+    for _ in range(MAX_REINTENTOS_CUOTA + 1):
+        if not limitador.adquirir(ESPERA_MAXIMA_CUOTA_SEGUNDOS):
+            if metricas:
+                metricas.incrementar("aliadodoc_rechazos_limitador_total", modelo=model_name)
+            raise ultimo_error or CuotaNoDisponible(model_name, limitador.tiempo_espera())
+        try:
+            response = model.generate_content(contents, stream=stream)
+        except Exception as e:
+            if not es_error_de_cuota(str(e)):
+                raise
+            if metricas:
+                metricas.incrementar("aliadodoc_errores_429_total", modelo=model_name)
+                metricas.evento("error_429", modelo=model_name, reintento_s=extraer_segundos_reintento(str(e)))
+            limitador.registrar_429(extraer_segundos_reintento(str(e)))
+            ultimo_error = e
+            continue
+        limitador.registrar_exito()
+        return response
+    raise ultimo_error
+
+
+# === Historial de conversación (modo multi-turno) ===
+
+# Presupuesto por defecto (en tokens) del historial que se reenvía al modelo.
+# 0 desactiva la memoria y cada mensaje se envía de forma aislada.
+HISTORIAL_PRESUPUESTO_TOKENS = int(os.environ.get("HISTORIAL_PRESUPUESTO_TOKENS", "8000"))
+# Aproximación local para no pagar una llamada a count_tokens en cada turno
+CARACTERES_POR_TOKEN = 4
+# Fracción del presupuesto que se reserva para el resumen de turnos antiguos
+FRACCION_RESUMEN = 0.25
+MODELO_RESUMEN = "gemini-2.5-flash"
+
+
+def estimar_tokens(texto: str) -> int:
+    """Estimación rápida del número de tokens de un texto."""
+    return len(texto or "") // CARACTERES_POR_TOKEN + 1
+
+
+def resumir_turnos(api_key, turnos, resumen_previo="", presupuesto_tokens=HISTORIAL_PRESUPUESTO_TOKENS):
+    """
+    Resume turnos antiguos de la conversación para conservar su contexto en pocos tokens.
+    Si el modelo falla, devuelve un recorte local de los mismos turnos.
+    """
+    transcripcion = "\n".join(
+        f"{'Usuario' if t['role'] == 'user' else 'Asistente'}: {t['content']}" for t in turnos
+    )
+    presupuesto_caracteres = int(presupuesto_tokens * FRACCION_RESUMEN) * CARACTERES_POR_TOKEN
+    try:
+        # El resumen es prescindible: si no hay cupo inmediato se usa el recorte local
+        if not obtener_limitador(api_key, MODELO_RESUMEN).adquirir(0):
+            raise CuotaNoDisponible(MODELO_RESUMEN, obtener_limitador(api_key, MODELO_RESUMEN).tiempo_espera())
+        modelo = obtener_modelo(api_key, MODELO_RESUMEN)
+        respuesta = modelo.generate_content(
+            "Resume de forma compacta esta conversación sobre documentos institucionales. "
+            "Conserva decisiones, datos del documento y pendientes; omite saludos.\n\n"
+            f"Resumen previo:\n{resumen_previo or '(ninguno)'}\n\nTurnos nuevos:\n{transcripcion}"
+        )
+        return respuesta.text.strip()[:presupuesto_caracteres]
+    except Exception as e:
+        print(f"Advertencia: No se pudo resumir el historial con el modelo: {e}")
+        return f"{resumen_previo}\n{transcripcion}".strip()[-presupuesto_caracteres:]
+
+
+def turnos_conversacion(mensajes) -> list:
+    """
+    Turnos que cuentan para el historial: con contenido y empezando por el usuario,
+    porque el historial de Gemini no puede empezar con el modelo (se omite la bienvenida).
+    """
+    turnos = [m for m in mensajes if m.get("content")]
+    while turnos and turnos[0]["role"] != "user":
+        turnos = turnos[1:]
+    return turnos
+
+
+def construir_historial(api_key, mensajes, presupuesto_tokens, resumen_previo=None, resumen_archivado=None):
+    """
+    Convierte los mensajes de la sesión al formato de historial de Gemini sin superar
+    el presupuesto de tokens. Los turnos más antiguos que no caben se resumen.
+
+    mensajes: turnos previos (sin el mensaje actual del usuario).
+    resumen_previo: dict {"turnos": n, "texto": str} devuelto en una llamada anterior.
+    resumen_archivado: resumen de los mensajes que ya salieron de memoria (ver
+    archivar_mensajes_antiguos); se antepone siempre al historial.
+    Devuelve (historial, resumen) para guardar el resumen en la sesión y reutilizarlo.
+    """
+    turnos = turnos_conversacion(mensajes)
+    if presupuesto_tokens <= 0 or not (turnos or resumen_archivado):
+        return [], resumen_previo
+
+    # Recorremos desde el turno más reciente hacia atrás hasta agotar el presupuesto
+    disponible = presupuesto_tokens * (1 - FRACCION_RESUMEN)
+    inicio = len(turnos)
+    for i in range(len(turnos) - 1, -1, -1):
+        disponible -= estimar_tokens(turnos[i]["content"])
+        if disponible < 0:
+            break
+        inicio = i
+    while inicio < len(turnos) and turnos[inicio]["role"] != "user":
+        inicio += 1
+
+    historial = []
+    resumen = resumen_previo
+    textos_resumen = [resumen_archivado] if resumen_archivado else []
+    if inicio > 0:
+        # Solo se resumen los turnos que no estaban cubiertos por el resumen anterior
+        ya_resumidos = resumen_previo["turnos"] if resumen_previo else 0
+        if ya_resumidos != inicio:
+            texto_previo = resumen_previo["texto"] if resumen_previo and ya_resumidos < inicio else ""
+            desde = ya_resumidos if texto_previo else 0
+            resumen = {
+                "turnos": inicio,
+                "texto": resumir_turnos(api_key, turnos[desde:inicio], texto_previo, presupuesto_tokens),
+            }
+        textos_resumen.append(resumen["texto"])
+    if textos_resumen:
+        texto_resumen = "\n\n".join(textos_resumen)
+        historial.append({"role": "user", "parts": [f"Resumen de la conversación anterior:\n{texto_resumen}"]})
+        historial.append({"role": "model", "parts": ["Entendido, tendré en cuenta ese contexto."]})
+
+    for turno in turnos[inicio:]:
+        historial.append({
+            "role": "user" if turno["role"] == "user" else "model",
+            "parts": [turno["content"]],
+        })
+    return historial, resumen
+
+
+# === Caché de respuestas para peticiones deterministas (p.ej. "Asesoría Rápida") ===
+
+CACHE_RESPUESTAS_TTL_SEGUNDOS = float(os.environ.get("CACHE_RESPUESTAS_TTL", str(24 * 60 * 60)))
+CACHE_RESPUESTAS_MAX_ENTRADAS = int(os.environ.get("CACHE_RESPUESTAS_MAX", "256"))
+# Ruta opcional de una base SQLite para conservar la caché entre reinicios del servidor
+CACHE_RESPUESTAS_SQLITE = os.environ.get("CACHE_RESPUESTAS_SQLITE", "")
+
+
+def hash_adjunto(contenido) -> str:
+    """Identificador estable del contenido de un adjunto (texto, blob de imagen o File de Gemini)."""
+    if isinstance(contenido, str):
+        return calcular_hash_contenido(contenido.encode("utf-8"))
+    if isinstance(contenido, dict) and "data" in contenido:
+        return calcular_hash_contenido(contenido["data"])
+    if hasattr(contenido, "name"):
+        # Los File de Gemini ya son direccionados por contenido (ver CacheArchivosGemini)
+        return f"file:{contenido.name}"
+    return calcular_hash_contenido(repr(contenido).encode("utf-8"))
+
+
+def clave_respuesta(model_name, system_instruction, user_prompt, content_files=None, history=None) -> str:
+    """Clave de caché: modelo, hash de la instrucción, prompt, historial y hashes de los adjuntos."""
+    h = hashlib.sha256()
+    for parte in (model_name, calcular_hash_contenido((system_instruction or "").encode()), user_prompt.strip()):
+        h.update(parte.encode("utf-8"))
+        h.update(b"\0")
+    for contenido in content_files or []:
+        if contenido is not None:
+            h.update(hash_adjunto(contenido).encode())
+            h.update(b"\0")
+    h.update(json.dumps(history or [], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class CacheRespuestas:
+    """
+    Caché LRU + TTL de respuestas completas, compartida por todas las sesiones.
+    Con `ruta_sqlite` las entradas también se guardan en disco y sobreviven a reinicios.
+    """
+
+    def __init__(self, max_entradas, ttl_segundos, ruta_sqlite=""):
+        self._lock = threading.Lock()
+        self._entradas = OrderedDict()  # clave -> (instante de creación, texto)
+        self._max = max_entradas
+        self._ttl = ttl_segundos
+        self._db = None
+        if ruta_sqlite:
+            self._db = sqlite3.connect(ruta_sqlite, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS respuestas (clave TEXT PRIMARY KEY, creada REAL, texto TEXT)"
+            )
+            self._db.commit()
+
+    def obtener(self, clave):
+        """Devuelve el texto guardado para la clave o None si no existe o expiró."""
+        if self._ttl <= 0:
+            return None
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None and self._db is not None:
+                fila = self._db.execute(
+                    "SELECT creada, texto FROM respuestas WHERE clave = ?", (clave,)
+                ).fetchone()
+                if fila is not None:
+                    entrada = self._entradas[clave] = (fila[0], fila[1])
+            if entrada is None:
+                return None
+            if ahora - entrada[0] > self._ttl:
+                self._entradas.pop(clave, None)
+                return None
+            self._entradas.move_to_end(clave)
+            self._recortar()
+            return entrada[1]
+
+    def guardar(self, clave, texto):
+        if self._ttl <= 0 or not texto:
+            return
+        ahora = time.time()
+        with self._lock:
+            self._entradas[clave] = (ahora, texto)
+            self._entradas.move_to_end(clave)
+            self._recortar()
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO respuestas (clave, creada, texto) VALUES (?, ?, ?)",
+                    (clave, ahora, texto),
+                )
+                self._db.execute("DELETE FROM respuestas WHERE creada < ?", (ahora - self._ttl,))
+                self._db.commit()
+
+    def _recortar(self):
+        while len(self._entradas) > self._max:
+            self._entradas.popitem(last=False)
+
+
+@recurso_del_proceso
+def obtener_cache_respuestas() -> CacheRespuestas:
+    """Instancia única de la caché de respuestas del servidor."""
+    return CacheRespuestas(CACHE_RESPUESTAS_MAX_ENTRADAS, CACHE_RESPUESTAS_TTL_SEGUNDOS, CACHE_RESPUESTAS_SQLITE)
+
+
+# === Caché de contexto de Gemini (instrucción de sistema + adjuntos fijados) ===
+
+# Modo por defecto; se puede cambiar por sesión desde la barra lateral
+CONTEXTO_CACHE_ACTIVO = os.environ.get("CONTEXTO_CACHE", "").lower() in ("1", "true", "si", "sí")
+CONTEXTO_CACHE_TTL_SEGUNDOS = int(os.environ.get("CONTEXTO_CACHE_TTL", "3600"))
+# La API rechaza cachés por debajo de un mínimo de tokens; por debajo no compensa intentarlo
+CONTEXTO_CACHE_MIN_TOKENS = int(os.environ.get("CONTEXTO_CACHE_MIN_TOKENS", "1024"))
+CONTEXTO_CACHE_MARGEN_SEGUNDOS = 5 * 60
+# Tras un fallo al crear la caché (p.ej. contenido demasiado pequeño) no se reintenta durante este tiempo
+CONTEXTO_CACHE_REINTENTO_SEGUNDOS = 10 * 60
+
+
+class CacheContextos:
+    """
+    Registro compartido de cachés de contexto de Gemini: clave -> CachedContent y su
+    expiración. Las entradas se renuevan (update de TTL) cuando se usan cerca de
+    expirar; los fallos al crear se recuerdan para no repetirlos en cada turno.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entradas = {}  # clave -> {"cache": CachedContent o None, "expira": epoch}
+
+    def obtener(self, clave, crear):
+        """Devuelve el CachedContent vigente para la clave, creándolo con `crear()` si hace falta."""
+        with self._lock:
+            ahora = time.time()
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada["expira"] > ahora:
+                if entrada["cache"] is None:
+                    return None
+                if entrada["expira"] - ahora < CONTEXTO_CACHE_MARGEN_SEGUNDOS:
+                    try:
+                        entrada["cache"].update(ttl=datetime.timedelta(seconds=CONTEXTO_CACHE_TTL_SEGUNDOS))
+                        entrada["expira"] = ahora + CONTEXTO_CACHE_TTL_SEGUNDOS
+                    except Exception as e:
+                        print(f"Advertencia: No se pudo renovar la caché de contexto: {e}")
+                        entrada["expira"] = ahora
+                        return None
+                return entrada["cache"]
+            try:
+                cache = crear()
+            except Exception as e:
+                print(f"Advertencia: No se pudo crear la caché de contexto: {e}")
+                self._entradas[clave] = {"cache": None, "expira": ahora + CONTEXTO_CACHE_REINTENTO_SEGUNDOS}
+                return None
+            self._entradas[clave] = {"cache": cache, "expira": ahora + CONTEXTO_CACHE_TTL_SEGUNDOS}
+            return cache
+
+
+@recurso_del_proceso
+def obtener_cache_contextos() -> CacheContextos:
+    """Instancia única del registro de cachés de contexto del servidor."""
+    return CacheContextos()
+
+
+def obtener_contexto_cacheado(api_key, model_name, system_instruction, adjuntos):
+    """
+    Devuelve un CachedContent con la instrucción de sistema y los adjuntos (partes ya
+    preparadas), o None si el SDK no lo soporta o el contexto es demasiado pequeño.
+    Las peticiones que lo usen solo envían el historial y el prompt.
+    """
+    if not hasattr(genai, "caching"):
+        return None
+    # Los textos cuentan por su tamaño; imágenes y archivos de Gemini siempre superan el mínimo
+    tokens = estimar_tokens(system_instruction or "")
+    for parte in adjuntos:
+        tokens += estimar_tokens(parte) if isinstance(parte, str) else CONTEXTO_CACHE_MIN_TOKENS
+    if tokens < CONTEXTO_CACHE_MIN_TOKENS:
+        return None
+
+    if api_key:
+        configurar_genai(api_key)
+    clave = "|".join(
+        [calcular_hash_contenido((api_key or "").encode())[:16], model_name,
+         calcular_hash_contenido((system_instruction or "").encode())]
+        + [hash_adjunto(parte) for parte in adjuntos]
+    )
+
+    def crear():
+        return genai.caching.CachedContent.create(
+            model=model_name,
+            display_name="aliadodoc-contexto",
+            system_instruction=system_instruction,
+            contents=[{"role": "user", "parts": list(adjuntos)}] if adjuntos else None,
+            ttl=datetime.timedelta(seconds=CONTEXTO_CACHE_TTL_SEGUNDOS),
+        )
+
+    contexto = obtener_cache_contextos().obtener(clave, crear)
+    obtener_metricas().incrementar("aliadodoc_contexto_cache_total", modelo=model_name,
+                                   resultado="usado" if contexto is not None else "no_disponible")
+    return contexto
+
+
+def get_gemini_response(api_key, model_name, user_prompt, system_instruction, content_files=None, history=None,
+                        contexto_cacheado=None, referencias=None):
+    """
+    Función para interactuar con la API de Gemini con:
+    - Limitador de cuota compartido por modelo: espera acotada y reintentos ante 429
+    - Fallback automático de gemini-2.5-pro -> gemini-2.5-flash (una vez), también
+      de forma preventiva si el limitador indica que pro no tiene cupo
+    - Historial opcional de turnos previos (ver construir_historial); los archivos
+      adjuntos se envían siempre en el turno actual
+    - contexto_cacheado opcional (ver obtener_contexto_cacheado): si se indica, la
+      instrucción y los adjuntos ya están en la caché de `model_name` y solo se envía
+      el prompt; el fallback a flash vuelve a enviarlo todo
+    - referencias opcionales (ver pasajes_de_referencia): pasajes del corpus
+      institucional que acompañan al prompt en el turno actual
+    """
+    parts_prompt = [user_prompt] + ([referencias] if referencias else [])
+    generation_parts = list(parts_prompt)
+    if content_files:
+        valid_content = [c for c in content_files if c is not None]
+        generation_parts.extend(valid_content)
+    contents = list(history or []) + [{"role": "user", "parts": generation_parts}]
+    contents_con_cache = list(history or []) + [{"role": "user", "parts": parts_prompt}]
+
+    try:
+        # Si ya sabemos que pro no tendrá cupo a tiempo, no gastamos una petición que fallará
+        espera_estimada = obtener_limitador(api_key, model_name).tiempo_espera()
+        if model_name == "gemini-2.5-pro" and espera_estimada > ESPERA_MAXIMA_CUOTA_SEGUNDOS:
+            raise CuotaNoDisponible(model_name, espera_estimada)
+
+        with avisos.progreso("Generando respuesta..."):
+            if contexto_cacheado is not None:
+                response = generar_con_cuota(api_key, model_name, system_instruction, contents_con_cache,
+                                             contexto_cacheado=contexto_cacheado)
+            else:
+                response = generar_con_cuota(api_key, model_name, system_instruction, contents)
+        return response
+
+    except Exception as e:
+        msg = str(e)
+
+        # ==========================
+        # 1) Manejo de cuota / 429
+        # ==========================
+        if es_error_de_cuota(msg):
+            
+            # Tiempo recomendado de reintento según la API (o el limitador local)
+            retry_seconds = extraer_segundos_reintento(msg)
+
+            # Armamos texto de tiempo amigable
+            tiempo_str = None
+            if retry_seconds is not None:
+                minutos = int(retry_seconds // 60)
+                segundos = int(round(retry_seconds % 60))
+                if minutos > 0:
+                    tiempo_str = f"**{minutos} min {segundos} s**"
+                else:
+                    tiempo_str = f"**{segundos} s**"
+
+            # Si el modelo actual es PRO, intentamos un fallback automático a FLASH una sola vez
+            if model_name == "gemini-2.5-pro":
+                try:
+                    avisos.informar(
+                        "⚠️ Se alcanzó la cuota de `gemini-2.5-pro`. "
+                        "Intentando continuar automáticamente con `gemini-2.5-flash`..."
+                    )
+                    with avisos.progreso("Generando respuesta con gemini-2.5-flash..."):
+                        response = generar_con_cuota(api_key, "gemini-2.5-flash", system_instruction, contents)
+                    obtener_metricas().incrementar("aliadodoc_fallback_total", desde=model_name, hacia="gemini-2.5-flash")
+                    obtener_metricas().evento("fallback", desde=model_name, hacia="gemini-2.5-flash")
+                    return response
+
+                except Exception as e2:
+                    # Si también falla flash, mostramos mensaje bonito
+                    msg2 = str(e2)
+                    base_msg = (
+                        "⚠️ **Has alcanzado el límite de uso de la API para este modelo "
+                        "y no fue posible usar el modelo de respaldo (`gemini-2.5-flash`).**\n\n"
+                        f"Modelo actual: `{model_name}`.\n"
+                    )
+                    if tiempo_str:
+                        base_msg += f"\n⏱️ La API indica que podrás volver a intentar aproximadamente en {tiempo_str}.\n"
+                    base_msg += (
+                        "\n💡 Recomendaciones:\n"
+                        "- Cambia manualmente al modelo `gemini-2.5-flash` en la barra lateral.\n"
+                        "- Revisa tu plan y facturación si necesitas más capacidad con `pro`.\n"
+                        f"\nDetalles técnicos del error original:\n```text\n{msg}\n```\n"
+                        f"Error del fallback:\n```text\n{msg2}\n```"
+                    )
+                    return base_msg
+
+            # Si NO es pro, solo mostramos el mensaje de cuota
+            base_msg = (
+                "⚠️ **Has alcanzado el límite de uso de la API para este modelo.**\n\n"
+                f"Modelo: `{model_name}`.\n"
+            )
+            if tiempo_str:
+                base_msg += f"\n⏱️ La API indica que podrás volver a intentar aproximadamente en {tiempo_str}.\n"
+            base_msg += (
+                "\n💡 Recomendaciones:\n"
+                "- Si estás en el plan gratuito, reduce la frecuencia de las solicitudes.\n"
+                "- Considera cambiar temporalmente a `gemini-2.5-flash` si aplica.\n"
+                "- Revisa tu plan y facturación en la consola de Google si necesitas más cuota.\n"
+                f"\nDetalles técnicos:\n```text\n{msg}\n```"
+            )
+            return base_msg
+
+        # ==========================
+        # 2) Manejo de clave API inválida
+        # ==========================
+        if "API key not valid" in msg:
+            return (
+                "⚠️ **Error de Clave API**: La clave proporcionada (GEMINI_API_KEY) "
+                "no es válida o no tiene permisos. Revisa tu configuración."
+            )
+
+        # ==========================
+        # 3) Otros errores genéricos
+        # ==========================
+        return f"❌ Error: {msg}"
+
+
+# === Archivos de texto grandes: lectura por bloques y análisis por fragmentos ===
+
+# A partir de este tamaño el texto adjunto no se envía entero: se analiza por fragmentos
+TEXTO_MAX_CARACTERES = int(os.environ.get("TEXTO_MAX_CARACTERES", "120000"))
+FRAGMENTO_MAX_CARACTERES = int(os.environ.get("FRAGMENTO_MAX_CARACTERES", "40000"))
+FILAS_POR_LOTE_CSV = 500
+MAX_HILOS_FRAGMENTOS = 4
+# El análisis de cada fragmento (map) usa flash; la síntesis final usa el modelo elegido
+MODELO_FRAGMENTOS = "gemini-2.5-flash"
+
+
+def leer_texto_por_bloques(archivo, tamano_bloque=1 << 16) -> str:
+    """
+    Decodifica un archivo UTF-8 leyéndolo por bloques, sin una copia completa de los
+    bytes además del archivo. El texto se devuelve entero: quien lo necesite en trozos
+    lo divide después (ver _segmentos_estructurales).
+    Lanza UnicodeDecodeError si el contenido no es UTF-8 válido.
+    """
+    archivo.seek(0)
+    decodificador = codecs.getincrementaldecoder("utf-8")()
+    partes = []
+    while True:
+        bloque = archivo.read(tamano_bloque)
+        if not bloque:
+            break
+        partes.append(decodificador.decode(bloque))
+    partes.append(decodificador.decode(b"", final=True))
+    return "".join(partes)
+
+
+def _segmentos_estructurales(texto: str, nombre_archivo: str):
+    """Divide el texto en segmentos según su estructura: títulos markdown, lotes de filas CSV o párrafos."""
+    nombre = (nombre_archivo or "").lower()
+    lineas = texto.splitlines(keepends=True)
+
+    if nombre.endswith(".csv") and lineas:
+        # Cada lote repite la cabecera para que el fragmento se entienda por sí solo
+        cabecera, filas = lineas[0], lineas[1:]
+        for i in range(0, len(filas), FILAS_POR_LOTE_CSV):
+            yield cabecera + "".join(filas[i:i + FILAS_POR_LOTE_CSV])
+        return
+
+    actual = []
+    for linea in lineas:
+        es_titulo = linea.startswith("#")
+        es_separador = not nombre.endswith(".md") and not linea.strip()
+        if actual and (es_titulo or es_separador):
+            yield "".join(actual)
+            actual = []
+        actual.append(linea)
+    if actual:
+        yield "".join(actual)
+
+
+def dividir_en_fragmentos(texto: str, nombre_archivo: str, max_caracteres=FRAGMENTO_MAX_CARACTERES) -> list:
+    """
+    Agrupa los segmentos estructurales en fragmentos de hasta max_caracteres.
+    Un segmento más largo que el máximo se corta por líneas (o por caracteres si hace falta).
+    """
+    fragmentos = []
+    actual, tamano = [], 0
+    for segmento in _segmentos_estructurales(texto, nombre_archivo):
+        piezas = [segmento]
+        if len(segmento) > max_caracteres:
+            piezas, pieza = [], ""
+            for linea in segmento.splitlines(keepends=True):
+                if pieza and len(pieza) + len(linea) > max_caracteres:
+                    piezas.append(pieza)
+                    pieza = ""
+                # Una sola línea más larga que el máximo se corta por caracteres
+                while len(linea) > max_caracteres:
+                    piezas.append(linea[:max_caracteres])
+                    linea = linea[max_caracteres:]
+                pieza += linea
+            piezas.append(pieza)
+        for pieza in piezas:
+            if actual and tamano + len(pieza) > max_caracteres:
+                fragmentos.append("".join(actual))
+                actual, tamano = [], 0
+            actual.append(pieza)
+            tamano += len(pieza)
+    if actual:
+        fragmentos.append("".join(actual))
+    return fragmentos
+
+
+def analizar_por_fragmentos(api_key, user_prompt, system_instruction, texto, nombre_archivo, progreso=None) -> str:
+    """
+    Map-reduce sobre un texto grande: analiza cada fragmento en paralelo con
+    MODELO_FRAGMENTOS y devuelve las notas combinadas, que sustituyen al texto
+    completo en la petición final. `progreso(hechos, total)` se llama en el hilo principal.
+    """
+    fragmentos = dividir_en_fragmentos(texto, nombre_archivo)
+    total = len(fragmentos)
+    # Se resuelven aquí, en el hilo de Streamlit; los hilos de trabajo solo llaman a la API
+    modelo = obtener_modelo(api_key, MODELO_FRAGMENTOS, system_instruction)
+    limitador = obtener_limitador(api_key, MODELO_FRAGMENTOS)
+    metricas = obtener_metricas()
+
+    def analizar(indice, fragmento):
+        instruccion = (
+            f"Este es el fragmento {indice + 1} de {total} del archivo '{nombre_archivo}'. "
+            "Extrae de forma concisa la información relevante para la solicitud del usuario "
+            "(secciones presentes, datos clave, faltantes o problemas). No respondas aún la solicitud completa.\n\n"
+            f"Solicitud del usuario:\n{user_prompt}\n\nFragmento:\n{fragmento}"
+        )
+        respuesta = generar_con_limitador(modelo, limitador, MODELO_FRAGMENTOS, instruccion, stream=False, metricas=metricas)
+        return respuesta.text
+
+    notas = [None] * total
+    with ThreadPoolExecutor(max_workers=MAX_HILOS_FRAGMENTOS) as executor:
+        futuros = {executor.submit(analizar, i, f): i for i, f in enumerate(fragmentos)}
+        for hechos, futuro in enumerate(as_completed(futuros), start=1):
+            i = futuros[futuro]
+            try:
+                notas[i] = futuro.result()
+            except Exception as e:
+                notas[i] = f"(No se pudo analizar este fragmento: {e})"
+            if progreso:
+                progreso(hechos, total)
+
+    return (
+        f"El archivo '{nombre_archivo}' es demasiado grande para enviarlo completo; "
+        f"estas son las notas de su análisis en {total} fragmentos, en orden:\n\n"
+        + "\n\n".join(f"### Fragmento {i + 1}\n{nota}" for i, nota in enumerate(notas))
+    )
+
+
+# === Preprocesamiento de imágenes antes de enviarlas al modelo ===
+
+# Gemini divide las imágenes en teselas de 768 px: 1536 px de lado máximo conserva
+# legible el texto de una foto de un documento sin enviar megapíxeles de más.
+IMAGEN_MAX_LADO = int(os.environ.get("IMAGEN_MAX_LADO", "1536"))
+IMAGEN_FORMATO = os.environ.get("IMAGEN_FORMATO", "JPEG").upper()  # JPEG o WEBP
+IMAGEN_CALIDAD = 85
+MINIATURA_MAX_LADO = 320
+
+
+def _abrir_imagen_reducida(datos: bytes, max_lado: int):
+    """Abre la imagen decodificando a escala reducida cuando el formato lo permite (JPEG)."""
+    imagen = Image.open(io.BytesIO(datos))
+    imagen.draft("RGB", (max_lado, max_lado))
+    return ImageOps.exif_transpose(imagen)
+
+
+def _a_rgb(imagen):
+    """Convierte a RGB; las transparencias se componen sobre fondo blanco."""
+    if imagen.mode in ("RGBA", "LA", "P"):
+        imagen = imagen.convert("RGBA")
+        fondo = Image.new("RGB", imagen.size, (255, 255, 255))
+        fondo.paste(imagen, mask=imagen.split()[-1])
+        return fondo
+    return imagen.convert("RGB")
+
+
+def preprocesar_imagen(datos: bytes, mime_original: str) -> dict:
+    """
+    Corrige la orientación EXIF, reduce la imagen a IMAGEN_MAX_LADO y la recodifica.
+    Devuelve un blob {"mime_type", "data"} que se envía tal cual al modelo.
+    Se cachea por el hash del contenido, así que los reruns no repiten el trabajo.
+    """
+    return _imagen_preprocesada(calcular_hash_contenido(datos), mime_original, datos)
+
+
+@recurso_del_proceso(max_entradas=64)
+def _imagen_preprocesada(hash_datos: str, mime_original: str, _datos: bytes) -> dict:
+    datos = _datos
+    imagen = _abrir_imagen_reducida(datos, IMAGEN_MAX_LADO)
+    imagen.thumbnail((IMAGEN_MAX_LADO, IMAGEN_MAX_LADO), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    _a_rgb(imagen).save(buffer, format=IMAGEN_FORMATO, quality=IMAGEN_CALIDAD, optimize=True)
+    recodificada = buffer.getvalue()
+
+    # Si la imagen ya era pequeña y la recodificación no ahorra nada, se envía la original
+    if len(recodificada) >= len(datos) and imagen.size == Image.open(io.BytesIO(datos)).size:
+        return {"mime_type": mime_original, "data": datos}
+    return {"mime_type": f"image/{IMAGEN_FORMATO.lower()}", "data": recodificada}
+
+
+def generar_miniatura(datos: bytes) -> bytes:
+    """Miniatura JPEG pequeña para la previsualización de la barra lateral (cacheada por contenido)."""
+    return _miniatura(calcular_hash_contenido(datos), datos)
+
+
+@recurso_del_proceso(max_entradas=64)
+def _miniatura(hash_datos: str, _datos: bytes) -> bytes:
+    imagen = _abrir_imagen_reducida(_datos, MINIATURA_MAX_LADO)
+    imagen.thumbnail((MINIATURA_MAX_LADO, MINIATURA_MAX_LADO))
+    buffer = io.BytesIO()
+    _a_rgb(imagen).save(buffer, format="JPEG", quality=80)
+    return buffer.getvalue()
+
+
+def es_blob_imagen(contenido) -> bool:
+    """Indica si el contenido procesado es una imagen preprocesada (blob)."""
+    return isinstance(contenido, dict) and str(contenido.get("mime_type", "")).startswith("image")
+
+
+# === Extracción local de texto de documentos Office (DOCX / XLSX) ===
+
+NS_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+NS_SS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+NS_REL = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+NS_PKG_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# Si el texto extraído es menor que esto (p.ej. un DOCX con solo imágenes), se sube el archivo
+MIN_CARACTERES_EXTRAIDOS = 40
+MAX_FILAS_POR_HOJA = int(os.environ.get("MAX_FILAS_POR_HOJA", "2000"))
+
+
+def _tabla_markdown(filas) -> str:
+    """Convierte una lista de filas (listas de celdas de texto) en una tabla markdown."""
+    filas = [f for f in filas if any(c.strip() for c in f)]
+    if not filas:
+        return ""
+    ancho = max(len(f) for f in filas)
+    lineas = []
+    for i, fila in enumerate(filas):
+        celdas = [c.replace("|", "\\|").replace("\n", "<br>") for c in fila] + [""] * (ancho - len(fila))
+        lineas.append("| " + " | ".join(celdas) + " |")
+        if i == 0:
+            lineas.append("|" + " --- |" * ancho)
+    return "\n".join(lineas)
+
+
+def _estilos_docx(zf) -> dict:
+    """Devuelve {styleId: nombre del estilo en minúsculas} de word/styles.xml."""
+    estilos = {}
+    if "word/styles.xml" not in zf.namelist():
+        return estilos
+    for _, elem in ET.iterparse(zf.open("word/styles.xml")):
+        if elem.tag == NS_W + "style":
+            nombre = elem.find(NS_W + "name")
+            if nombre is not None:
+                estilos[elem.get(NS_W + "styleId")] = (nombre.get(NS_W + "val") or "").lower()
+            elem.clear()
+    return estilos
+
+
+def _nivel_titulo(nombre_estilo):
+    """Nivel de encabezado markdown para un estilo de Word (None si no es un título)."""
+    if not nombre_estilo:
+        return None
+    if nombre_estilo in ("title", "título", "titulo"):
+        return 1
+    m = re.match(r"(?:heading|t[ií]tulo)\s*(\d)", nombre_estilo)
+    return min(int(m.group(1)), 6) if m else None
+
+
+def docx_a_markdown(zf) -> str:
+    """
+    Recorre word/document.xml con un parser incremental y genera markdown compacto:
+    títulos según el estilo del párrafo, viñetas para párrafos numerados y tablas.
+    """
+    estilos = _estilos_docx(zf)
+    bloques = []
+    tablas = []          # Pila de tablas abiertas: tabla -> filas -> celdas -> párrafos
+    texto = []
+    estilo = None
+    es_lista = False
+
+    for evento, elem in ET.iterparse(zf.open("word/document.xml"), events=("start", "end")):
+        tag = elem.tag
+        if evento == "start":
+            if tag == NS_W + "tbl":
+                tablas.append([])
+            elif tag == NS_W + "tr" and tablas:
+                tablas[-1].append([])
+            elif tag == NS_W + "tc" and tablas:
+                tablas[-1][-1].append([])
+            continue
+
+        if tag == NS_W + "t":
+            texto.append(elem.text or "")
+        elif tag in (NS_W + "tab", NS_W + "br", NS_W + "cr"):
+            texto.append(" ")
+        elif tag == NS_W + "pStyle":
+            estilo = elem.get(NS_W + "val")
+        elif tag == NS_W + "numPr":
+            es_lista = True
+        elif tag == NS_W + "p":
+            contenido = "".join(texto).strip()
+            if tablas:
+                if contenido:
+                    tablas[-1][-1][-1].append(contenido)
+            elif contenido:
+                nivel = _nivel_titulo(estilos.get(estilo, (estilo or "").lower()))
+                if nivel:
+                    bloques.append("#" * nivel + " " + contenido)
+                elif es_lista:
+                    bloques.append("- " + contenido)
+                else:
+                    bloques.append(contenido)
+            texto, estilo, es_lista = [], None, False
+            elem.clear()
+        elif tag == NS_W + "tbl":
+            filas = [["\n".join(celda) for celda in fila] for fila in tablas.pop()]
+            if tablas:
+                # Tabla anidada: se aplana como texto dentro de la celda que la contiene
+                tablas[-1][-1][-1].extend(" / ".join(c for c in f if c) for f in filas)
+            else:
+                md = _tabla_markdown(filas)
+                if md:
+                    bloques.append(md)
+            elem.clear()
+
+    return "\n\n".join(bloques)
+
+
+def _columna_de_celda(ref: str) -> int:
+    """Índice (0-based) de la columna de una referencia tipo 'AB12'."""
+    indice = 0
+    for letra in ref:
+        if not letra.isalpha():
+            break
+        indice = indice * 26 + (ord(letra.upper()) - ord("A") + 1)
+    return indice - 1
+
+
+def xlsx_a_markdown(zf) -> str:
+    """
+    Convierte cada hoja de un XLSX en una tabla markdown leyendo sharedStrings y las
+    hojas de forma incremental. Las hojas muy largas se recortan a MAX_FILAS_POR_HOJA.
+    """
+    nombres = set(zf.namelist())
+
+    compartidas = []
+    if "xl/sharedStrings.xml" in nombres:
+        for _, elem in ET.iterparse(zf.open("xl/sharedStrings.xml")):
+            if elem.tag == NS_SS + "si":
+                compartidas.append("".join(t.text or "" for t in elem.iter(NS_SS + "t")))
+                elem.clear()
+
+    destinos = {}
+    for _, elem in ET.iterparse(zf.open("xl/_rels/workbook.xml.rels")):
+        if elem.tag == NS_PKG_REL + "Relationship":
+            destino = elem.get("Target", "")
+            destinos[elem.get("Id")] = destino.lstrip("/") if destino.startswith("/") else "xl/" + destino
+
+    hojas = []
+    for _, elem in ET.iterparse(zf.open("xl/workbook.xml")):
+        if elem.tag == NS_SS + "sheet":
+            hojas.append((elem.get("name"), destinos.get(elem.get(NS_REL + "id"))))
+
+    bloques = []
+    for nombre_hoja, ruta in hojas:
+        if ruta not in nombres:
+            continue
+        filas = []
+        fila = {}
+        recortada = False
+        for _, elem in ET.iterparse(zf.open(ruta)):
+            if elem.tag == NS_SS + "c":
+                tipo = elem.get("t")
+                if tipo == "inlineStr":
+                    valor = "".join(t.text or "" for t in elem.iter(NS_SS + "t"))
+                else:
+                    v = elem.find(NS_SS + "v")
+                    valor = v.text if v is not None and v.text else ""
+                    if tipo == "s" and valor:
+                        valor = compartidas[int(valor)]
+                columna = _columna_de_celda(elem.get("r", "")) if elem.get("r") else len(fila)
+                fila[columna] = valor
+            elif elem.tag == NS_SS + "row":
+                if any(v.strip() for v in fila.values()):
+                    filas.append([fila.get(i, "") for i in range(max(fila) + 1)])
+                fila = {}
+                elem.clear()
+                if len(filas) >= MAX_FILAS_POR_HOJA:
+                    recortada = True
+                    break
+        md = _tabla_markdown(filas)
+        if md:
+            bloque = f"## Hoja: {nombre_hoja}\n\n{md}"
+            if recortada:
+                bloque += f"\n\n_(Hoja recortada a las primeras {MAX_FILAS_POR_HOJA} filas)_"
+            bloques.append(bloque)
+
+    return "\n\n".join(bloques)
+
+
+def extraer_texto_office(uploaded_file):
+    """
+    Extrae localmente el contenido de un DOCX o XLSX como markdown.
+    Devuelve None si el formato no aplica o si el texto es insuficiente, para que
+    el archivo se suba a la API de Archivos como antes.
+    """
+    nombre = uploaded_file.name.lower()
+    if not nombre.endswith((".docx", ".xlsx")):
+        return None
+    try:
+        uploaded_file.seek(0)
+        with zipfile.ZipFile(uploaded_file) as zf:
+            contenido = docx_a_markdown(zf) if nombre.endswith(".docx") else xlsx_a_markdown(zf)
+    except Exception as e:
+        print(f"Advertencia: No se pudo extraer el texto de '{uploaded_file.name}' localmente: {e}")
+        return None
+    finally:
+        uploaded_file.seek(0)
+    if len(contenido.strip()) < MIN_CARACTERES_EXTRAIDOS:
+        return None
+    return f"Contenido del archivo '{uploaded_file.name}' (extraído a markdown):\n\n{contenido}"
+
+
+def process_uploaded_file(api_key, uploaded_file):
+    """
+    Procesa el archivo subido: lo convierte a imagen preprocesada (blob), texto (str) o lo sube a Gemini (File object).
+    Los DOCX/XLSX se convierten a texto localmente siempre que sea posible.
+    """
+    if uploaded_file is None: return None
+    mime_type = uploaded_file.type
+    
+    # 1. Archivos de imagen (reducidas y recodificadas, ver preprocesar_imagen)
+    if mime_type.startswith('image'):
+        try:
+            return preprocesar_imagen(uploaded_file.getvalue(), mime_type)
+        except Exception as e: 
+            avisos.error(f"Error al procesar la imagen: {e}")
+            return None
+            
+    # Lista de extensiones que Gemini requiere subir a su API de Archivos (Binarios)
+    binary_extensions = ('.doc', '.docx', '.pdf', '.xls', '.xlsx')
+    
+    # 2. Archivos Binarios (PDF, Word, Excel)
+    if uploaded_file.name.lower().endswith(binary_extensions) or mime_type in [
+        'application/pdf', 
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', # XLSX
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document', # DOCX
+        'application/msword', # DOC
+        'application/vnd.ms-excel' # XLS
+        ]:
+        
+        # DOCX / XLSX con texto: se extrae localmente y se evita la subida
+        texto_extraido = extraer_texto_office(uploaded_file)
+        if texto_extraido is not None:
+            return texto_extraido
+
+        # Subir el archivo binario a la API de Archivos de Gemini (PDF, DOC, XLS o sin texto extraíble)
+        return upload_file_to_gemini(api_key, uploaded_file)
+            
+    # 3. Archivos de Texto (String) - (txt, py, md, csv, json, etc.)
+    elif mime_type.startswith('text') or uploaded_file.name.endswith(('.py', '.md', '.csv', '.txt', '.json')):
+        try:
+            return leer_texto_por_bloques(uploaded_file)
+        except Exception as e: 
+            avisos.error(f"Error al leer el archivo de texto: {e}. Asegúrese de que es texto plano.")
+            return None
+            
+    avisos.error(f"Tipo de archivo no soportado o formato inválido: {mime_type}")
+    return None
+
+
+# === Revisión local de estructura: secciones presentes, vacías y faltantes ===
+
+# Similitud mínima (0-1) entre un título del documento y el de la plantilla
+SIMILITUD_MINIMA_TITULO = 0.8
+# Letras mínimas para considerar que una sección tiene contenido
+LETRAS_MINIMAS_SECCION = 15
+# Caracteres que se envían de cada sección presente en la Asesoría Rápida
+SECCION_MAX_CARACTERES = 3000
+# Nombres alternativos habituales de las secciones de las plantillas (ya normalizados)
+SINONIMOS_SECCION = {
+    "contenido": ("desarrollo", "pasos", "actividades", "descripcion de actividades"),
+    "pasos": ("contenido", "desarrollo", "actividades", "instrucciones"),
+    "definiciones": ("glosario", "terminos", "terminos y definiciones"),
+    "historial de cambios": ("control de cambios", "control de versiones"),
+}
+
+
+def normalizar_titulo(texto: str) -> str:
+    """Minúsculas, sin tildes, sin viñetas ni numeración y sin signos."""
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode().lower()
+    texto = re.sub(r"^[\s#>*\-\d.)]+", "", texto)
+    return " ".join(re.sub(r"[^a-z ]+", " ", texto).split())
+
+
+def _titulos_coinciden(candidato: str, seccion: str) -> bool:
+    if not candidato:
+        return False
+    if candidato == seccion or candidato in SINONIMOS_SECCION.get(seccion, ()):
+        return True
+    # "definiciones pertinentes" ~ "definiciones", "objetivos" ~ "objetivo"
+    if min(len(candidato), len(seccion)) >= 5 and (candidato.startswith(seccion) or seccion.startswith(candidato)):
+        return True
+    return difflib.SequenceMatcher(None, candidato, seccion).ratio() >= SIMILITUD_MINIMA_TITULO
+
+
+def _celdas(linea: str) -> list:
+    return [c.strip().replace("\\|", "|") for c in re.split(r"(?<!\\)\|", linea.strip().strip("|"))]
+
+
+def _tablas_markdown(texto: str) -> list:
+    """Tablas markdown del texto como listas de filas (sin la fila separadora)."""
+    tablas, actual = [], []
+    for linea in texto.splitlines() + [""]:
+        if linea.lstrip().startswith("|"):
+            if not re.fullmatch(r"[\s|:\-]+", linea):
+                actual.append(_celdas(linea))
+        elif actual:
+            tablas.append(actual)
+            actual = []
+    return tablas
+
+
+def _es_mayusculas(texto: str) -> bool:
+    letras = [c for c in texto if c.isalpha()]
+    return len(letras) >= 3 and all(c.isupper() for c in letras)
+
+
+def _esquema_de_plantilla(nombre: str, markdown: str) -> dict:
+    """
+    Deriva el esquema de una plantilla: tipo de documento, secciones (líneas en
+    mayúsculas), campos del encabezado ("Código:", "Versión:") y tablas con sus columnas.
+    """
+    tablas = _tablas_markdown(markdown)
+    encabezado = tablas[0] if tablas else []
+    tipo = Path(nombre).stem.replace("Plantilla_", "").replace("_", " ")
+    campos = [c.rstrip(":").strip() for fila in encabezado for c in fila if c.endswith(":")]
+
+    secciones = []
+    for linea in markdown.splitlines():
+        if linea.lstrip().startswith("|"):
+            continue
+        titulo = re.sub(r"^[\s\-*#]+", "", linea).rstrip(": ").strip()
+        if titulo and _es_mayusculas(titulo):
+            secciones.append({"nombre": titulo.capitalize(), "clave": normalizar_titulo(titulo)})
+
+    columnas_tablas = []
+    for filas in tablas[1:]:
+        columnas = [c for c in filas[0] if c]
+        if columnas and all(_es_mayusculas(c) for c in columnas):
+            columnas_tablas.append(columnas)
+    # Rótulos y textos de ejemplo de la plantilla: no cuentan como contenido del documento
+    textos = {normalizar_titulo(c) for filas in tablas for fila in filas for c in fila}
+    textos |= {normalizar_titulo(linea) for linea in markdown.splitlines() if not linea.lstrip().startswith("|")}
+    textos.discard("")
+    return {"tipo": tipo, "plantilla": nombre, "secciones": secciones, "campos": campos, "tablas": columnas_tablas,
+            "textos_plantilla": frozenset(textos)}
+
+
+@recurso_del_proceso(max_entradas=4)
+def esquemas_plantillas(firma: tuple) -> tuple:
+    """Esquemas de todas las plantillas DOCX de docs/, derivados una vez por versión."""
+    esquemas = []
+    for plantilla in catalogo_plantillas(firma)["archivos"]:
+        if not plantilla["nombre"].lower().endswith(".docx"):
+            continue
+        with zipfile.ZipFile(io.BytesIO(plantilla["bytes"])) as zf:
+            esquemas.append(_esquema_de_plantilla(plantilla["nombre"], docx_a_markdown(zf)))
+    return tuple(esquemas)
+
+
+def _titulos_del_documento(lineas: list) -> list:
+    """(índice de línea, título normalizado, texto tras ':' en la misma línea, es título fuerte)."""
+    titulos = []
+    for i, linea in enumerate(lineas):
+        texto = linea.strip()
+        if not texto or texto.startswith("|"):
+            continue
+        fuerte = texto.startswith("#")
+        prefijo, dos_puntos, resto = texto.partition(":")
+        if dos_puntos and len(prefijo.split()) <= 6:
+            titulos.append((i, normalizar_titulo(prefijo), resto.strip(), fuerte or _es_mayusculas(prefijo)))
+        elif fuerte or (_es_mayusculas(texto) and len(texto.split()) <= 6):
+            titulos.append((i, normalizar_titulo(texto), "", True))
+        elif re.match(r"^\d+(\.\d+)*[.)]?\s+\S", texto) and len(texto.split()) <= 6:
+            # "2. Alcance": solo delimita una sección si coincide con la plantilla
+            titulos.append((i, normalizar_titulo(texto), "", False))
+    return titulos
+
+
+def _analizar_tabla(columnas_esquema: list, tablas: list):
+    """Busca en el documento la tabla con esas columnas y cuenta filas y celdas vacías por columna."""
+    claves = [normalizar_titulo(c) for c in columnas_esquema]
+    for filas in tablas:
+        cabecera = [normalizar_titulo(c) for c in filas[0]]
+        indices = {c: next((j for j, h in enumerate(cabecera) if _titulos_coinciden(h, c)), None) for c in claves}
+        if sum(j is not None for j in indices.values()) * 2 < len(claves):
+            continue
+        # Filas con algún dato además de la numeración o del rótulo ("Nombre:", "3…")
+        datos = [f for f in filas[1:] if any(re.sub(r"^[^:]*:|[\d.…\s]+", "", c) for c in f[1:])]
+        vacias = {}
+        for columna, clave in zip(columnas_esquema, claves):
+            j = indices[clave]
+            n = sum(1 for f in datos if j is None or j >= len(f) or not re.sub(r"^[^:]*:", "", f[j]).strip())
+            if n:
+                vacias[columna.capitalize()] = n
+        return {"filas": len(datos), "vacias": vacias}
+    return None
+
+
+def _letras_de_contenido(contenido: str, textos_plantilla: frozenset) -> int:
+    """Letras escritas por el autor: sin rótulos ("Nombre:") ni textos copiados de la plantilla."""
+    letras = 0
+    for linea in contenido.splitlines():
+        partes = _celdas(linea) if linea.lstrip().startswith("|") else [linea]
+        for parte in partes:
+            if normalizar_titulo(parte) in textos_plantilla:
+                continue
+            parte = re.sub(r"^[^:]{0,40}:", "", parte)
+            if normalizar_titulo(parte) not in textos_plantilla:
+                letras += sum(c.isalpha() for c in parte)
+    return letras
+
+
+def titulo_de_celda(celda: str, tipo: str):
+    """
+    Título del documento a partir de la línea o celda que nombra el tipo ("# Procedimiento
+    de Compras"): sin marcas de markdown, sin un rótulo inicial ("Título:", "Nombre:") ni
+    el "(Nombre)" de la plantilla. None si solo queda el tipo (plantilla sin llenar).
+    """
+    titulo = re.sub(r"^[\s#>*_\-]+", "", celda)
+    titulo = re.sub(r"^(?:t[ií]tulo|nombre)\s*:?\s*", "", titulo, flags=re.I)
+    titulo = re.sub(r"\(\s*nombre\s*\)", "", titulo, flags=re.I).strip(" :-*_")
+    if normalizar_titulo(titulo) == normalizar_titulo(tipo):
+        return None
+    return titulo or None
+
+
+def recortar_seccion(texto: str) -> str:
+    """Recorta a SECCION_MAX_CARACTERES dejando constancia para el modelo de que falta texto."""
+    if len(texto) <= SECCION_MAX_CARACTERES:
+        return texto
+    return (texto[:SECCION_MAX_CARACTERES]
+            + f"\n[… sección recortada: se incluyen {SECCION_MAX_CARACTERES} de {len(texto)} caracteres]")
+
+
+def analizar_brechas(texto: str, plantilla=None):
+    """
+    Compara un documento (texto o DOCX ya extraído a markdown) con el esquema de la
+    plantilla que mejor le corresponde, o con la indicada en `plantilla` (nombre del
+    archivo). Devuelve un dict con el tipo detectado, el estado de cada sección
+    (completa, vacia o faltante) con su texto, los campos del encabezado y las
+    tablas, o None si no hay plantillas.
+    """
+    esquemas = esquemas_plantillas(firma_plantillas())
+    if plantilla is not None:
+        esquemas = tuple(e for e in esquemas if e["plantilla"] == plantilla)
+    if not esquemas or not isinstance(texto, str):
+        return None
+    lineas = texto.splitlines()
+    titulos = _titulos_del_documento(lineas)
+
+    def localizar(esquema):
+        encontradas = {}
+        for seccion in esquema["secciones"]:
+            for posicion, (i, candidato, resto, _) in enumerate(titulos):
+                if seccion["clave"] not in encontradas and _titulos_coinciden(candidato, seccion["clave"]):
+                    encontradas[seccion["clave"]] = posicion
+                    break
+        return encontradas
+
+    # Tipo: el que se nombra al inicio del documento o, si no, el que más secciones comparte
+    inicio = normalizar_titulo(texto[:1000])
+    candidatos = [(normalizar_titulo(e["tipo"]) in inicio, len(localizar(e)), -n, e) for n, e in enumerate(esquemas)]
+    _, _, _, esquema = max(candidatos, key=lambda c: c[:3])
+    encontradas = localizar(esquema)
+
+    # Límites de cada sección: el siguiente título que coincide con la plantilla o es título fuerte
+    limites = sorted({titulos[p][0] for p in encontradas.values()} | {i for i, _, _, fuerte in titulos if fuerte})
+    secciones = []
+    for seccion in esquema["secciones"]:
+        posicion = encontradas.get(seccion["clave"])
+        if posicion is None:
+            secciones.append({"nombre": seccion["nombre"], "clave": seccion["clave"], "estado": "faltante", "texto": ""})
+            continue
+        i, _, resto, _ = titulos[posicion]
+        fin = next((l for l in limites if l > i), len(lineas))
+        contenido = "\n".join([resto] + lineas[i + 1:fin]).strip()
+        letras = _letras_de_contenido(contenido, esquema["textos_plantilla"])
+        estado = "completa" if letras >= LETRAS_MINIMAS_SECCION else "vacia"
+        secciones.append({"nombre": seccion["nombre"], "clave": seccion["clave"], "estado": estado, "texto": contenido})
+
+    # Encabezado: lo que hay antes de la primera sección; el título acompaña al tipo ("Procedimiento X")
+    primera = min((titulos[p][0] for p in encontradas.values()), default=0)
+    encabezado = "\n".join(lineas[:primera])
+    tipo_normalizado = normalizar_titulo(esquema["tipo"])
+    titulo = None
+    for linea in (encabezado or "\n".join(lineas[:10])).splitlines():
+        for celda in _celdas(linea) if linea.lstrip().startswith("|") else [linea]:
+            if normalizar_titulo(celda).startswith(tipo_normalizado):
+                titulo = titulo_de_celda(celda, esquema["tipo"])
+                break
+        if titulo is not None:
+            break
+
+    campos = [{"nombre": "Título", "valor": titulo or None}]
+    for campo in esquema["campos"]:
+        valor = re.search(rf"{re.escape(campo)}\s*:\s*([^|\n]*)", texto, flags=re.I)
+        campos.append({"nombre": campo, "valor": valor.group(1).strip() if valor else None})
+
+    tablas_documento = _tablas_markdown(texto)
+    tablas = [{"columnas": columnas, "resultado": _analizar_tabla(columnas, tablas_documento)}
+              for columnas in esquema["tablas"]]
+    return {"tipo": esquema["tipo"], "plantilla": esquema["plantilla"], "secciones": secciones,
+            "campos": campos, "tablas": tablas, "secciones_encontradas": len(encontradas),
+            "encabezado": recortar_seccion(encabezado)}
+
+
+def informe_brechas_markdown(informe: dict) -> str:
+    """Resumen compacto del análisis de brechas para el modelo y la barra lateral."""
+    por_estado = {estado: [s["nombre"] for s in informe["secciones"] if s["estado"] == estado]
+                  for estado in ("completa", "vacia", "faltante")}
+    lineas = [
+        f"Tipo de documento detectado: {informe['tipo']} (plantilla {informe['plantilla']})",
+        f"Secciones completas: {', '.join(por_estado['completa']) or 'ninguna'}",
+        f"Secciones vacías: {', '.join(por_estado['vacia']) or 'ninguna'}",
+        f"Secciones faltantes: {', '.join(por_estado['faltante']) or 'ninguna'}",
+    ]
+    if informe["campos"]:
+        lineas.append("Campos del encabezado: " + ", ".join(
+            f"{c['nombre']}: {c['valor'] or 'sin diligenciar'}" for c in informe["campos"]
+        ))
+    for tabla in informe["tablas"]:
+        nombre = " / ".join(c.capitalize() for c in tabla["columnas"])
+        resultado = tabla["resultado"]
+        if resultado is None:
+            lineas.append(f"Tabla ({nombre}): no encontrada")
+        else:
+            vacias = ", ".join(f"{columna} vacía en {n}" for columna, n in resultado["vacias"].items())
+            lineas.append(f"Tabla ({nombre}): {resultado['filas']} fila(s) con datos" + (f"; {vacias}" if vacias else ""))
+    return "\n".join(lineas)
+
+
+def contenido_para_asesoria(texto: str, informe: dict) -> str:
+    """
+    Lo que se envía del documento en la Asesoría Rápida: el informe de brechas y solo
+    las secciones con contenido (recortadas, con una marca, si son muy largas). Si el
+    documento casi no sigue la plantilla, se envía completo junto al informe para que
+    el modelo pueda proponer cómo ordenarlo.
+    """
+    partes = ["Revisión local de estructura frente a la plantilla:", informe_brechas_markdown(informe)]
+    if informe["secciones_encontradas"] < 2:
+        return "\n".join(partes + ["", "Documento completo:", texto])
+    if informe["encabezado"].strip():
+        partes += ["", "Encabezado del documento:", informe["encabezado"].strip()]
+    for seccion in informe["secciones"]:
+        if seccion["estado"] == "completa":
+            partes += ["", f"Sección {seccion['nombre']}:", recortar_seccion(seccion["texto"])]
+    return "\n".join(partes)
+
+
+# === Llenado de plantillas: borradores por sección volcados en los DOCX de docs/ ===
+
+# Secciones que la plantilla trae resueltas (tabla de versiones) y no se redactan
+SECCIONES_SIN_REDACTAR = ("historial de cambios",)
+PPR_CONTENIDO = '<w:pPr><w:ind w:left="720"/></w:pPr>'
+PPR_VINETA = '<w:pPr><w:ind w:left="1080" w:hanging="360"/></w:pPr>'
+MIME_DOCX = MIME_POR_EXTENSION[".docx"]
+
+PROMPT_LLENAR_PLANTILLA = (
+    "Redacta el contenido de un(a) {tipo} institucional a partir del material de abajo. "
+    "Devuelve solo markdown, sin comentarios, con esta forma:\n"
+    "# {tipo} <título del documento>\n"
+    "Código: <si se conoce>\n"
+    "Versión: <si se conoce>\n"
+    "y después un encabezado '## <NOMBRE>' por cada sección, en este orden: {secciones}. "
+    "Usa listas con '- ' cuando ayuden a la lectura.{tablas}\n\n"
+    "Material:\n{fuente}"
+)
+PROMPT_REHACER_SECCION = (
+    "Estás editando la sección '{seccion}' de un(a) {tipo} titulado '{titulo}'.\n\n"
+    "Texto actual de la sección:\n{actual}\n\n"
+    "Instrucción: {instruccion}\n\n"
+    "Devuelve solo el nuevo contenido de la sección en markdown, sin su título ni comentarios.{tablas}"
+)
+
+_ETIQUETA_XML = re.compile(r"<(/?)w:(p|tbl|sectPr)\b[^>]*?(/?)>")
+
+
+def _elementos_del_cuerpo(cuerpo: str) -> list:
+    """Elementos de primer nivel de <w:body> como (tipo, xml); lo que hay entre ellos va como ("otro", xml)."""
+    elementos, inicio, tipo, profundidad, ultimo = [], 0, None, 0, 0
+    for m in _ETIQUETA_XML.finditer(cuerpo):
+        cierre, etiqueta, autocierre = m.groups()
+        if profundidad == 0:
+            if cierre:
+                continue
+            if m.start() > ultimo:
+                elementos.append(("otro", cuerpo[ultimo:m.start()]))
+            inicio, tipo = m.start(), etiqueta
+            if autocierre:
+                elementos.append((tipo, cuerpo[inicio:m.end()]))
+                ultimo = m.end()
+            else:
+                profundidad = 1
+        elif etiqueta == tipo and not autocierre:
+            profundidad += -1 if cierre else 1
+            if profundidad == 0:
+                elementos.append((tipo, cuerpo[inicio:m.end()]))
+                ultimo = m.end()
+    if ultimo < len(cuerpo):
+        elementos.append(("otro", cuerpo[ultimo:]))
+    return elementos
+
+
+def _texto_xml(xml: str) -> str:
+    return "".join(re.findall(r"<w:t(?:\s[^>]*)?>([^<]*)</w:t>", xml))
+
+
+def _esqueleto_de_plantilla(nombre: str, datos: bytes, esquema: dict) -> dict:
+    """
+    Separa el document.xml de una plantilla en partes fijas y huecos: el encabezado
+    (título, código y versión), un punto de inserción tras el título de cada sección
+    con el estilo de párrafo de su marcador vacío, y las tablas propias de una sección
+    (p.ej. las actividades del procedimiento), que se rellenan fila a fila.
+    """
+    with zipfile.ZipFile(io.BytesIO(datos)) as zf:
+        entradas = {info.filename: zf.read(info) for info in zf.infolist()}
+    documento = entradas.pop("word/document.xml").decode("utf-8")
+    apertura = documento.index("<w:body>") + len("<w:body>")
+    cierre = documento.rindex("</w:body>")
+    claves = {s["clave"]: s for s in esquema["secciones"]}
+
+    partes, secciones, actual = [], [], None
+    for tipo, xml in _elementos_del_cuerpo(documento[apertura:cierre]):
+        clave = normalizar_titulo(_texto_xml(xml)) if tipo == "p" else ""
+        if clave in claves:
+            actual = {"nombre": claves[clave]["nombre"], "clave": clave, "ppr": PPR_CONTENIDO, "columnas": None}
+            secciones.append(actual)
+            partes.extend([("xml", xml), ("seccion", clave)])
+            continue
+        if tipo == "tbl" and not secciones and not any(p[0] == "encabezado" for p in partes):
+            partes.append(("encabezado", xml))
+        elif tipo == "tbl" and actual is not None and actual["columnas"] is None \
+                and actual["clave"] not in SECCIONES_SIN_REDACTAR:
+            filas = re.findall(r"<w:tr\b.*?</w:tr>", xml, flags=re.S)
+            actual["columnas"] = [_texto_xml(c).strip() for c in re.findall(r"<w:tc>.*?</w:tc>", filas[0], flags=re.S)]
+            partes.append(("tabla", actual["clave"], xml))
+        else:
+            # El primer párrafo vacío tras el título marca el estilo del contenido de la sección
+            ppr = re.search(r"<w:pPr>.*?</w:pPr>", xml, flags=re.S) if tipo == "p" and not _texto_xml(xml).strip() else None
+            if actual is not None and ppr and actual["ppr"] == PPR_CONTENIDO:
+                ppr = re.sub(r"<w:rPr>.*?</w:rPr>|<w:numPr>.*?</w:numPr>", "", ppr.group(0), flags=re.S)
+                actual["ppr"] = ppr if ppr != "<w:pPr></w:pPr>" else PPR_CONTENIDO
+            partes.append(("xml", xml))
+    return {
+        "plantilla": nombre, "tipo": esquema["tipo"], "campos": list(esquema["campos"]), "entradas": entradas,
+        "inicio": documento[:apertura], "fin": documento[cierre:], "partes": partes,
+        "secciones": [s for s in secciones if s["clave"] not in SECCIONES_SIN_REDACTAR],
+    }
+
+
+@recurso_del_proceso(max_entradas=4)
+def esqueletos_plantillas(firma: tuple) -> dict:
+    """Esqueletos de las plantillas DOCX de docs/ por nombre, analizados una vez por versión."""
+    esquemas = {e["plantilla"]: e for e in esquemas_plantillas(firma)}
+    esqueletos = {}
+    for plantilla in catalogo_plantillas(firma)["archivos"]:
+        if plantilla["nombre"] in esquemas:
+            try:
+                esqueletos[plantilla["nombre"]] = _esqueleto_de_plantilla(
+                    plantilla["nombre"], plantilla["bytes"], esquemas[plantilla["nombre"]]
+                )
+            except (ValueError, KeyError, zipfile.BadZipFile) as e:
+                print(f"Advertencia: No se pudo preparar la plantilla '{plantilla['nombre']}' para llenarla: {e}")
+    return esqueletos
+
+
+def _runs_xml(texto: str, negrita=False) -> str:
+    """Runs de Word para una línea de markdown: los tramos **así** van en negrita."""
+    runs = []
+    for i, tramo in enumerate(re.split(r"\*\*(.+?)\*\*", texto)):
+        if tramo:
+            rpr = "<w:rPr><w:b/><w:bCs/></w:rPr>" if negrita or i % 2 else ""
+            runs.append(f'<w:r>{rpr}<w:t xml:space="preserve">{escape(tramo)}</w:t></w:r>')
+    return "".join(runs)
+
+
+def _tabla_xml(filas: list) -> str:
+    """Tabla sencilla con el estilo de cuadrícula de las plantillas; la primera fila en negrita."""
+    ancho = max(len(f) for f in filas)
+    rejilla = "".join(f'<w:gridCol w:w="{9000 // ancho}"/>' for _ in range(ancho))
+    xml_filas = "".join(
+        "<w:tr>" + "".join(
+            f'<w:tc><w:tcPr><w:tcW w:w="{9000 // ancho}" w:type="dxa"/></w:tcPr><w:p>{_runs_xml(c, negrita=i == 0)}</w:p></w:tc>'
+            for c in fila + [""] * (ancho - len(fila))
+        ) + "</w:tr>"
+        for i, fila in enumerate(filas)
+    )
+    return (f'<w:tbl><w:tblPr><w:tblStyle w:val="Tablaconcuadrcula"/><w:tblW w:w="0" w:type="auto"/></w:tblPr>'
+            f"<w:tblGrid>{rejilla}</w:tblGrid>{xml_filas}</w:tbl><w:p/>")
+
+
+def _rellenar_tabla(tabla: str, filas: list) -> str:
+    """Sustituye las filas de ejemplo de una tabla de la plantilla por `filas`, con el formato de la primera."""
+    filas_plantilla = re.findall(r"<w:tr\b.*?</w:tr>", tabla, flags=re.S)
+    if len(filas_plantilla) < 2 or not filas:
+        return tabla
+    modelo = filas_plantilla[1]
+    celdas = re.findall(r"<w:tc>.*?</w:tc>", modelo, flags=re.S)
+    nuevas = []
+    for fila in filas:
+        fila = fila + [""] * (len(celdas) - len(fila))
+        xml = modelo
+        for celda, valor in zip(celdas, fila):
+            # Cada celda conserva sus propiedades y las del primer párrafo; el texto se reemplaza
+            tcpr = re.search(r"<w:tcPr>.*?</w:tcPr>", celda, flags=re.S)
+            ppr = re.search(r"<w:pPr>.*?</w:pPr>", celda, flags=re.S)
+            xml = xml.replace(celda, "<w:tc>" + (tcpr.group(0) if tcpr else "")
+                              + f"<w:p>{ppr.group(0) if ppr else ''}{_runs_xml(valor)}</w:p></w:tc>", 1)
+        nuevas.append(xml)
+    inicio = tabla.index(filas_plantilla[1])
+    fin = tabla.index(filas_plantilla[-1]) + len(filas_plantilla[-1])
+    return tabla[:inicio] + "".join(nuevas) + tabla[fin:]
+
+
+def _xml_de_seccion(texto: str, ppr: str, tabla_plantilla=None) -> tuple:
+    """
+    Párrafos de Word para el markdown de una sección y, si la sección tiene tabla en la
+    plantilla, esa tabla con las filas de la primera tabla del texto. Devuelve (párrafos, tabla).
+    """
+    parrafos, tabla, bloque = [], tabla_plantilla, []
+    for linea in texto.splitlines() + [""]:
+        if linea.lstrip().startswith("|"):
+            bloque.append(linea)
+            continue
+        if bloque:
+            filas = [_celdas(l) for l in bloque if not re.fullmatch(r"[\s|:\-]+", l)]
+            if tabla_plantilla is not None and tabla is tabla_plantilla:
+                tabla = _rellenar_tabla(tabla_plantilla, filas[1:])
+            elif filas:
+                parrafos.append(_tabla_xml(filas))
+            bloque = []
+        linea = linea.strip()
+        if not linea:
+            continue
+        vineta = re.match(r"^[-*•]\s+(.*)", linea)
+        titulo = re.match(r"^#+\s*(.*)", linea)
+        if vineta:
+            parrafos.append(f"<w:p>{PPR_VINETA}{_runs_xml('• ' + vineta.group(1))}</w:p>")
+        elif titulo:
+            parrafos.append(f"<w:p>{ppr}{_runs_xml(titulo.group(1).strip('* '), negrita=True)}</w:p>")
+        else:
+            parrafos.append(f"<w:p>{ppr}{_runs_xml(linea)}</w:p>")
+    return "".join(parrafos), tabla
+
+
+def _rellenar_encabezado(xml: str, campos: dict, tipo: str) -> str:
+    """
+    Pone el título en lugar de "(Nombre)" y el valor tras cada rótulo ("Código:") del
+    encabezado. La plantilla ya trae el tipo ("Procedimiento (Nombre)"), así que si el
+    título empieza por él no se repite.
+    """
+    titulo = campos.get("Título")
+    if titulo:
+        primera, _, resto = titulo.partition(" ")
+        if normalizar_titulo(primera) == normalizar_titulo(tipo) and resto.strip():
+            titulo = resto.strip()
+        xml = xml.replace("(Nombre)", escape(titulo), 1)
+    for nombre, valor in campos.items():
+        if nombre != "Título" and valor:
+            xml = re.sub(
+                rf"<w:t(?:\s[^>]*)?>({re.escape(escape(nombre))}:)\s*</w:t>",
+                lambda m: f'<w:t xml:space="preserve">{m.group(1)} {escape(valor)}</w:t>', xml, count=1,
+            )
+    return xml
+
+
+@recurso_del_proceso(max_entradas=256)
+def _xml_de_seccion_en_cache(huella: str, ppr: str, tabla, _texto: str) -> tuple:
+    return _xml_de_seccion(_texto, ppr, tabla)
+
+
+def construir_docx(esqueleto: dict, borrador: dict) -> bytes:
+    """
+    DOCX en memoria con el contenido del borrador en la plantilla. El XML de cada
+    sección queda en caché por el hash de su texto, de modo que solo se vuelven a
+    convertir las secciones que cambiaron. No modifica `borrador`: puede llamarse
+    desde el hilo de la descarga.
+    """
+    tablas = {p[1]: p[2] for p in esqueleto["partes"] if p[0] == "tabla"}
+    renderizado = {}
+    for seccion in esqueleto["secciones"]:
+        texto = borrador["secciones"].get(seccion["clave"], "")
+        renderizado[seccion["clave"]] = _xml_de_seccion_en_cache(
+            calcular_hash_contenido(texto.encode("utf-8")), seccion["ppr"], tablas.get(seccion["clave"]), texto
+        )
+
+    cuerpo = []
+    for parte in esqueleto["partes"]:
+        if parte[0] == "encabezado":
+            cuerpo.append(_rellenar_encabezado(parte[1], borrador.get("campos", {}), esqueleto["tipo"]))
+        elif parte[0] == "seccion":
+            cuerpo.append(renderizado[parte[1]][0] if parte[1] in renderizado else "")
+        elif parte[0] == "tabla":
+            cuerpo.append(renderizado[parte[1]][1] if parte[1] in renderizado else parte[2])
+        else:
+            cuerpo.append(parte[1])
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        # [Content_Types].xml debe ser la primera entrada del paquete
+        for nombre, datos in esqueleto["entradas"].items():
+            zf.writestr(nombre, datos)
+            if nombre == "[Content_Types].xml":
+                zf.writestr("word/document.xml", esqueleto["inicio"] + "".join(cuerpo) + esqueleto["fin"])
+    return buffer.getvalue()
+
+
+def borrador_desde_texto(esqueleto: dict, texto: str) -> dict:
+    """Reparte un markdown en las secciones de la plantilla (ver analizar_brechas) sin llamar al modelo."""
+    informe = analizar_brechas(texto, plantilla=esqueleto["plantilla"])
+    claves = {s["clave"] for s in esqueleto["secciones"]}
+    secciones = {s["clave"]: s["texto"] for s in informe["secciones"] if s["clave"] in claves and s["estado"] == "completa"}
+    campos = {c["nombre"]: c["valor"] for c in informe["campos"] if c["valor"]}
+    return {"plantilla": esqueleto["plantilla"], "campos": campos, "secciones": secciones}
+
+
+def _indicacion_tablas(esqueleto: dict, secciones=None) -> str:
+    return "".join(
+        f" La sección {s['nombre']} va en una tabla markdown con las columnas: {' | '.join(s['columnas'])}."
+        for s in esqueleto["secciones"] if s["columnas"] and (secciones is None or s["clave"] in secciones)
+    )
+
+
+def _texto_del_modelo(api_key, model_name, prompt):
+    """Respuesta completa de get_gemini_response (con su limitador y fallback) o (None, error)."""
+    respuesta = get_gemini_response(api_key, model_name, prompt, SISTEMA_DE_CONDUCTA)
+    if isinstance(respuesta, str):
+        return None, respuesta
+    texto = "".join(extraer_texto_de_chunk(chunk) for chunk in respuesta).strip()
+    return (texto, None) if texto else (None, "⚠️ El modelo no devolvió texto.")
+
+
+def generar_borrador(api_key, model_name, esqueleto: dict, fuente: str):
+    """
+    Borrador de la plantilla a partir de `fuente` (p.ej. la última respuesta del chat).
+    Si la fuente ya trae al menos dos secciones de la plantilla, se reparte localmente;
+    si no, una sola llamada al modelo la reescribe por secciones. Devuelve (borrador, error).
+    """
+    borrador = borrador_desde_texto(esqueleto, fuente)
+    if len(borrador["secciones"]) >= 2:
+        return borrador, None
+    prompt = PROMPT_LLENAR_PLANTILLA.format(
+        tipo=esqueleto["tipo"], secciones=", ".join(s["nombre"].upper() for s in esqueleto["secciones"]),
+        tablas=_indicacion_tablas(esqueleto), fuente=fuente,
+    )
+    texto, error = _texto_del_modelo(api_key, model_name, prompt)
+    if error:
+        return None, error
+    return borrador_desde_texto(esqueleto, texto), None
+
+
+def rehacer_seccion(api_key, model_name, esqueleto: dict, borrador: dict, clave: str, instruccion: str):
+    """Llamada pequeña que reescribe solo una sección según la instrucción. Devuelve (texto, error)."""
+    seccion = next(s for s in esqueleto["secciones"] if s["clave"] == clave)
+    prompt = PROMPT_REHACER_SECCION.format(
+        seccion=seccion["nombre"], tipo=esqueleto["tipo"],
+        titulo=borrador.get("campos", {}).get("Título") or "(sin título)",
+        actual=borrador["secciones"].get(clave) or "(vacía)", instruccion=instruccion,
+        tablas=_indicacion_tablas(esqueleto, {clave}),
+    )
+    texto, error = _texto_del_modelo(api_key, model_name, prompt)
+    if texto:
+        # Si el modelo repite el título de la sección, se quita
+        texto = re.sub(rf"^#*\s*\**{re.escape(seccion['nombre'])}\**:?\s*\n", "", texto, flags=re.I)
+    return texto, error
+
+
+# === Recuperación local: índice BM25 de plantillas y documentos aprobados ===
+
+# Carpeta con procedimientos y guías aprobados que se suman a las plantillas de docs/
+CORPUS_DIR = os.environ.get("CORPUS_DIR", "")
+# Ruta del índice persistente (se reconstruye si falta); vacía desactiva la recuperación
+INDICE_SQLITE = os.environ.get("INDICE_SQLITE", str(Path(tempfile.gettempdir()) / "aliadodoc_indice_corpus.db"))
+# Segundos entre revisiones de las plantillas y CORPUS_DIR en busca de cambios (0: en cada consulta)
+CORPUS_REVISION_SEGUNDOS = float(os.environ.get("CORPUS_REVISION_SEGUNDOS", "60"))
+RECUPERACION_TOP_K = int(os.environ.get("RECUPERACION_TOP_K", "4"))
+PASAJE_MAX_CARACTERES = 1200
+EXTENSIONES_CORPUS = (".docx", ".xlsx", ".md", ".txt")
+BM25_K1, BM25_B = 1.5, 0.75
+PALABRAS_VACIAS = frozenset(
+    "que los las del por con para una uno unos unas como mas pero sus este esta estos estas ese esa "
+    "son ser fue han hay sin sobre entre cual cuales cuando donde debe deben cada todo todos todas "
+    "otro otra otros otras muy tambien desde hasta segun the and".split()
+)
+
+
+def terminos_de(texto: str) -> list:
+    """Palabras normalizadas (sin tildes, minúsculas, sin plural simple) útiles para buscar."""
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode().lower()
+    terminos = []
+    for palabra in re.findall(r"[a-z0-9]{3,}", texto):
+        if palabra in PALABRAS_VACIAS:
+            continue
+        # "responsables" ~ "responsable", "actividades" ~ "actividad"
+        if len(palabra) > 5 and palabra.endswith("es"):
+            palabra = palabra[:-2]
+        elif len(palabra) > 4 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        terminos.append(palabra)
+    return terminos
+
+
+def pasajes_de_texto(texto: str) -> list:
+    """
+    Divide un markdown en pasajes (título de sección, texto) de hasta
+    PASAJE_MAX_CARACTERES, cortando por párrafos dentro de cada sección. Un documento
+    corto (p.ej. una plantilla vacía) es un solo pasaje: su valor está en la estructura.
+    """
+    if len(texto) <= PASAJE_MAX_CARACTERES:
+        return [("", texto.strip())] if sum(c.isalpha() for c in texto) >= LETRAS_MINIMAS_SECCION else []
+    pasajes, titulo, bloque = [], "", []
+
+    def cerrar():
+        contenido = "\n".join(bloque).strip()
+        if sum(c.isalpha() for c in contenido) >= LETRAS_MINIMAS_SECCION:
+            pasajes.append((titulo, contenido))
+        bloque.clear()
+
+    for linea in texto.splitlines():
+        limpia = re.sub(r"^[\s#*\-]+", "", linea).rstrip(": ").strip()
+        es_tabla = linea.lstrip().startswith("|")
+        if linea.lstrip().startswith("#") or (not es_tabla and limpia and len(limpia) <= 80 and _es_mayusculas(limpia)):
+            cerrar()
+            titulo = limpia
+            continue
+        # Un párrafo nuevo que no cabe abre otro pasaje de la misma sección
+        if linea.strip() and bloque and not bloque[-1].strip() and \
+                sum(len(l) + 1 for l in bloque) + len(linea) > PASAJE_MAX_CARACTERES:
+            cerrar()
+        bloque.append(linea)
+    cerrar()
+    return pasajes
+
+
+def texto_de_documento_corpus(ruta: Path, datos: bytes) -> str:
+    """Markdown de un documento del corpus con la misma extracción que los adjuntos."""
+    if ruta.suffix.lower() in (".docx", ".xlsx"):
+        with zipfile.ZipFile(io.BytesIO(datos)) as zf:
+            return docx_a_markdown(zf) if ruta.suffix.lower() == ".docx" else xlsx_a_markdown(zf)
+    return codecs.decode(datos, "utf-8", errors="replace")
+
+
+def fuentes_del_corpus() -> dict:
+    """Documentos a indexar: {clave: (ruta, tamaño, mtime)} de las plantillas y de CORPUS_DIR."""
+    fuentes = {}
+    for nombre, tamano, mtime in firma_plantillas():
+        if nombre.startswith("Plantilla_") and nombre.lower().endswith(".docx"):
+            fuentes[f"docs/{nombre}"] = (DOCS_DIR / nombre, tamano, mtime)
+    if CORPUS_DIR and os.path.isdir(CORPUS_DIR):
+        raiz = Path(CORPUS_DIR)
+        for ruta in raiz.rglob("*"):
+            if ruta.suffix.lower() in EXTENSIONES_CORPUS and ruta.is_file() and not ruta.name.startswith((".", "~$")):
+                stat = ruta.stat()
+                fuentes[f"corpus/{ruta.relative_to(raiz).as_posix()}"] = (ruta, stat.st_size, stat.st_mtime_ns)
+    return fuentes
+
+
+class IndiceCorpus:
+    """
+    Índice invertido BM25 en SQLite: documentos (con su tamaño, mtime y hash),
+    pasajes y frecuencia de cada término por pasaje. Solo se reindexan los
+    documentos cuyo contenido cambió y se quitan los que ya no existen.
+    """
+
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.executescript("""
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS documentos (clave TEXT PRIMARY KEY, tamano INTEGER, mtime INTEGER, hash TEXT);
+            CREATE TABLE IF NOT EXISTS pasajes (
+                id INTEGER PRIMARY KEY, documento TEXT, titulo TEXT, texto TEXT, longitud INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS pasajes_por_documento ON pasajes (documento);
+            CREATE TABLE IF NOT EXISTS terminos (
+                termino TEXT, pasaje INTEGER, frecuencia INTEGER, PRIMARY KEY (termino, pasaje)
+            ) WITHOUT ROWID;
+        """)
+        self._db.commit()
+        self._estadisticas = None  # (número de pasajes, longitud media)
+
+    def actualizar(self, fuentes: dict) -> dict:
+        """Sincroniza el índice con `fuentes` (ver fuentes_del_corpus); devuelve cuántos documentos cambiaron."""
+        with self._lock:
+            conocidos = {c: (t, m, h) for c, t, m, h in self._db.execute("SELECT clave, tamano, mtime, hash FROM documentos")}
+        cambios = {"indexados": 0, "eliminados": 0}
+        for clave, (ruta, tamano, mtime) in fuentes.items():
+            previo = conocidos.get(clave)
+            if previo and previo[:2] == (tamano, mtime):
+                continue
+            try:
+                datos = ruta.read_bytes()
+                hash_documento = calcular_hash_contenido(datos)
+                # Mismo contenido con otro mtime (p.ej. copiado de nuevo): solo se actualiza la firma
+                pasajes = None if previo and previo[2] == hash_documento else pasajes_de_texto(texto_de_documento_corpus(ruta, datos))
+            except Exception as e:
+                print(f"Advertencia: No se pudo indexar '{clave}': {e}")
+                continue
+            with self._lock:
+                if pasajes is not None:
+                    self._borrar_documento(clave)
+                    for titulo, texto in pasajes:
+                        terminos = terminos_de(f"{titulo}\n{texto}")
+                        cursor = self._db.execute(
+                            "INSERT INTO pasajes (documento, titulo, texto, longitud) VALUES (?, ?, ?, ?)",
+                            (clave, titulo, texto, len(terminos)),
+                        )
+                        self._db.executemany(
+                            "INSERT INTO terminos (termino, pasaje, frecuencia) VALUES (?, ?, ?)",
+                            [(t, cursor.lastrowid, n) for t, n in Counter(terminos).items()],
+                        )
+                    cambios["indexados"] += 1
+                self._db.execute(
+                    "INSERT OR REPLACE INTO documentos (clave, tamano, mtime, hash) VALUES (?, ?, ?, ?)",
+                    (clave, tamano, mtime, hash_documento),
+                )
+                self._db.commit()
+        with self._lock:
+            for clave in set(conocidos) - set(fuentes):
+                self._borrar_documento(clave)
+                self._db.execute("DELETE FROM documentos WHERE clave = ?", (clave,))
+                cambios["eliminados"] += 1
+            self._db.commit()
+            if cambios["indexados"] or cambios["eliminados"]:
+                self._estadisticas = None
+        return cambios
+
+    def _borrar_documento(self, clave):
+        self._db.execute("DELETE FROM terminos WHERE pasaje IN (SELECT id FROM pasajes WHERE documento = ?)", (clave,))
+        self._db.execute("DELETE FROM pasajes WHERE documento = ?", (clave,))
+
+    def buscar(self, consulta: str, k=RECUPERACION_TOP_K) -> list:
+        """Los `k` pasajes con mayor puntuación BM25 para la consulta (dicts con documento, titulo, texto, puntuacion)."""
+        terminos = set(terminos_de(consulta))
+        if not terminos or k <= 0:
+            return []
+        with self._lock:
+            if self._estadisticas is None:
+                n, media = self._db.execute("SELECT COUNT(*), AVG(longitud) FROM pasajes").fetchone()
+                self._estadisticas = (n, media or 1.0)
+            total, longitud_media = self._estadisticas
+            puntuaciones = {}
+            for termino in terminos:
+                apariciones = self._db.execute(
+                    "SELECT t.pasaje, t.frecuencia, p.longitud FROM terminos t JOIN pasajes p ON p.id = t.pasaje "
+                    "WHERE t.termino = ?", (termino,)
+                ).fetchall()
+                if not apariciones:
+                    continue
+                idf = math.log(1 + (total - len(apariciones) + 0.5) / (len(apariciones) + 0.5))
+                for pasaje, frecuencia, longitud in apariciones:
+                    normalizacion = BM25_K1 * (1 - BM25_B + BM25_B * longitud / longitud_media)
+                    puntuaciones[pasaje] = puntuaciones.get(pasaje, 0.0) + idf * frecuencia * (BM25_K1 + 1) / (frecuencia + normalizacion)
+            mejores = heapq.nlargest(k, puntuaciones.items(), key=lambda item: item[1])
+            resultados = []
+            for pasaje, puntuacion in mejores:
+                documento, titulo, texto = self._db.execute(
+                    "SELECT documento, titulo, texto FROM pasajes WHERE id = ?", (pasaje,)
+                ).fetchone()
+                resultados.append({"documento": documento, "titulo": titulo, "texto": texto, "puntuacion": round(puntuacion, 3)})
+        return resultados
+
+    def informe(self) -> dict:
+        with self._lock:
+            documentos = self._db.execute("SELECT COUNT(*) FROM documentos").fetchone()[0]
+            pasajes = self._db.execute("SELECT COUNT(*) FROM pasajes").fetchone()[0]
+        return {"documentos": documentos, "pasajes": pasajes}
+
+
+@recurso_del_proceso
+def obtener_indice_corpus():
+    """Índice único del servidor, o None si está desactivado o no hay acceso a la ruta."""
+    if not INDICE_SQLITE:
+        return None
+    try:
+        return IndiceCorpus(INDICE_SQLITE)
+    except sqlite3.Error as e:
+        print(f"Advertencia: No se pudo abrir el índice de documentos '{INDICE_SQLITE}': {e}")
+        return None
+
+
+@recurso_del_proceso(max_entradas=1)
+def _fuentes_de_la_ventana(ventana: int) -> dict:
+    # Recorrer CORPUS_DIR es un stat por archivo: se hace una vez por ventana de tiempo
+    return fuentes_del_corpus()
+
+
+def fuentes_vigentes(forzar=False) -> dict:
+    """
+    fuentes_del_corpus() reutilizadas durante CORPUS_REVISION_SEGUNDOS; con `forzar`
+    (p.ej. desde el panel de administración) se vuelven a recorrer en el acto.
+    """
+    if CORPUS_REVISION_SEGUNDOS <= 0:
+        return fuentes_del_corpus()
+    if forzar:
+        _fuentes_de_la_ventana.clear()
+    return _fuentes_de_la_ventana(int(time.monotonic() // CORPUS_REVISION_SEGUNDOS))
+
+
+@recurso_del_proceso(max_entradas=1)
+def _indice_sincronizado(firma: tuple, _fuentes: dict):
+    # Solo se vuelve a sincronizar cuando cambia algún archivo (la firma es un stat por archivo)
+    indice = obtener_indice_corpus()
+    if indice is not None:
+        cambios = indice.actualizar(_fuentes)
+        if cambios["indexados"] or cambios["eliminados"]:
+            obtener_metricas().evento("indice_corpus", **cambios, **indice.informe())
+    return indice
+
+
+def indice_corpus(forzar=False):
+    """
+    Índice al día con las plantillas y CORPUS_DIR (con un retraso de hasta
+    CORPUS_REVISION_SEGUNDOS, salvo con `forzar`), o None si la recuperación está desactivada.
+    """
+    if not INDICE_SQLITE:
+        return None
+    fuentes = fuentes_vigentes(forzar)
+    return _indice_sincronizado(tuple(sorted((clave, t, m) for clave, (_, t, m) in fuentes.items())), fuentes)
+
+
+def pasajes_de_referencia(consulta: str) -> tuple:
+    """
+    Busca en el índice los pasajes más relevantes para la consulta y los devuelve
+    como (texto listo para el modelo, lista de fuentes). Sin índice o sin
+    coincidencias devuelve ("", []).
+    """
+    indice = indice_corpus()
+    resultados = indice.buscar(consulta) if indice is not None else []
+    obtener_metricas().incrementar("aliadodoc_recuperacion_total", resultado="con_pasajes" if resultados else "sin_pasajes")
+    if not resultados:
+        return "", []
+    bloques = [
+        f"[{i}] {r['documento']}" + (f" — {r['titulo']}" if r["titulo"] else "") + f"\n{r['texto']}"
+        for i, r in enumerate(resultados, 1)
+    ]
+    texto = (
+        "Pasajes de referencia de documentos institucionales aprobados (úsalos como modelo de "
+        "estructura y redacción; no forman parte del documento del usuario):\n\n" + "\n\n".join(bloques)
+    )
+    return texto, [f"{r['documento']}" + (f" › {r['titulo']}" if r["titulo"] else "") for r in resultados]
+
+
+# === Partes que se envían al modelo y texto de sus respuestas ===
+
+def extraer_texto_de_chunk(chunk) -> str:
+    """
+    Extrae texto de un chunk de respuesta de Gemini de forma segura,
+    sin usar chunk.text para evitar errores cuando no hay Parts válidos.
+    """
+    try:
+        candidates = getattr(chunk, "candidates", None)
+        if not candidates:
+            return ""
+
+        cand = candidates[0]
+        content = getattr(cand, "content", None)
+        if not content:
+            return ""
+
+        parts = getattr(content, "parts", None)
+        if not parts:
+            return ""
+
+        textos = []
+        for part in parts:
+            t = getattr(part, "text", None)
+            if t:
+                textos.append(t)
+
+        return "".join(textos)
+    except Exception:
+        # Si la estructura no es la esperada, devolvemos vacío y ya
+        return ""
+
+
+def preparar_contenidos(api_key, user_prompt, adjuntos, progreso=None) -> list:
+    """
+    Lista de partes para el modelo: cada adjunto precedido de su nombre. Los textos
+    demasiado grandes se analizan por fragmentos y se envían solo sus notas;
+    `progreso(nombre, hechos, total)` informa de ese análisis. En la Asesoría Rápida
+    los documentos de texto se reducen al informe de analizar_brechas.
+    """
+    content_list = []
+    for nombre, contenido in adjuntos:
+        content_list.append(f"Archivo adjunto: {nombre}")
+        informe = analizar_brechas(contenido) if user_prompt == PROMPT_ASESORIA_RAPIDA else None
+        if informe is not None:
+            # La Asesoría Rápida recibe el informe local de brechas y las secciones con contenido
+            contenido = contenido_para_asesoria(contenido, informe)
+        if isinstance(contenido, str) and len(contenido) > TEXTO_MAX_CARACTERES:
+            content_list.append(analizar_por_fragmentos(
+                api_key, user_prompt, SISTEMA_DE_CONDUCTA, contenido, nombre,
+                progreso=(lambda hechos, total, nombre=nombre: progreso(nombre, hechos, total)) if progreso else None,
+            ))
+        else:
+            content_list.append(contenido)
+    return content_list
@@ -0,0 +1,190 @@
+"""
+Revisión en lote, sin interfaz, de carpetas completas de documentos.
+
+Usa el mismo núcleo que la app (nucleo.py, sin Streamlit): process_uploaded_file
+para decidir cómo se procesa cada tipo de archivo, preparar_contenidos y
+get_gemini_response con su limitador de cuota y el fallback de pro a flash. Los documentos se revisan con un
+número acotado de hilos y cada resultado se añade como una línea JSON al archivo de
+salida, que sirve también de punto de control: al volver a ejecutar, los documentos
+ya revisados (mismo contenido) se omiten.
+
+Uso:
+    python revision_lote.py procedimientos/ -o revision.jsonl
+    python revision_lote.py procedimientos/ -o revision.jsonl -m gemini-2.5-pro -j 8
+    python revision_lote.py procedimientos/ -o revision.jsonl --prompt-archivo prompt.txt
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+EXTENSIONES = (".docx", ".xlsx", ".doc", ".xls", ".pdf", ".txt", ".md", ".csv", ".json", ".jpg", ".png")
+# Veces que se reintenta un documento cuando la API responde sin cuota
+REINTENTOS_CUOTA = 3
+
+
+class ArchivoLocal(io.BytesIO):
+    """Archivo del disco con la interfaz del UploadedFile de Streamlit (name, type y size)."""
+
+    def __init__(self, ruta: Path):
+        datos = ruta.read_bytes()
+        super().__init__(datos)
+        self.name = ruta.name
+        self.type = mimetypes.guess_type(ruta.name)[0] or "application/octet-stream"
+        self.size = len(datos)
+
+
+def cargar_nucleo():
+    """
+    Importa el núcleo de la app (nucleo.py), que no depende de Streamlit. En un lote se
+    puede esperar más por cupo que en el chat, así que la espera máxima del limitador
+    sube salvo que se haya configurado.
+    """
+    os.environ.setdefault("GEMINI_ESPERA_MAXIMA", "300")
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import nucleo
+    return nucleo
+
+
+def documentos_de(carpeta: Path, extensiones) -> list:
+    return sorted(
+        p for p in carpeta.rglob("*")
+        if p.is_file() and p.suffix.lower() in extensiones and not p.name.startswith(("~$", "."))
+    )
+
+
+def leer_punto_de_control(salida: Path) -> set:
+    """(ruta relativa, hash) de los documentos que ya tienen un resultado correcto."""
+    hechos = set()
+    if not salida.exists():
+        return hechos
+    with open(salida, encoding="utf-8") as f:
+        for linea in f:
+            try:
+                resultado = json.loads(linea)
+            except json.JSONDecodeError:
+                # Última línea a medias si el proceso se cortó mientras escribía
+                continue
+            if resultado.get("estado") == "ok":
+                hechos.add((resultado["ruta"], resultado["hash"]))
+    return hechos
+
+
+def revisar_documento(nucleo, api_key, ruta: Path, relativa: str, hash_archivo: str, modelo: str, prompt: str,
+                      referencias: str = "") -> dict:
+    """Procesa y revisa un documento; devuelve el resultado listo para el JSONL."""
+    inicio = time.monotonic()
+    resultado = {"ruta": relativa, "hash": hash_archivo, "modelo": modelo}
+    contenido = nucleo.process_uploaded_file(api_key, ArchivoLocal(ruta))
+    if isinstance(contenido, nucleo.SubidaEnSegundoPlano):
+        contenido = contenido.futuro.result()
+    if contenido is None:
+        return dict(resultado, estado="error", error="No se pudo procesar el archivo (tipo no soportado o ilegible).")
+
+    try:
+        adjuntos = [(ruta.name, contenido)]
+        if isinstance(contenido, str):
+            informe = nucleo.analizar_brechas(contenido)
+            if informe is not None:
+                resultado["brechas"] = nucleo.informe_brechas_markdown(informe)
+
+        # La misma consulta sobre el mismo documento ya respondida (en este lote o en la app)
+        cache_respuestas = nucleo.obtener_cache_respuestas()
+        clave = nucleo.clave_respuesta(modelo, nucleo.SISTEMA_DE_CONDUCTA, prompt,
+                                    [c for a in adjuntos for c in a] + ([referencias] if referencias else []))
+        texto = cache_respuestas.obtener(clave)
+        origen = "cache"
+
+        for intento in range(REINTENTOS_CUOTA + 1):
+            if texto is not None:
+                break
+            origen = "modelo"
+            respuesta = nucleo.get_gemini_response(
+                api_key, modelo, prompt, nucleo.SISTEMA_DE_CONDUCTA,
+                nucleo.preparar_contenidos(api_key, prompt, adjuntos), referencias=referencias,
+            )
+            if not isinstance(respuesta, str):
+                texto = "".join(nucleo.extraer_texto_de_chunk(chunk) for chunk in respuesta)
+                if texto.strip():
+                    cache_respuestas.guardar(clave, texto)
+                break
+            if not nucleo.es_error_de_cuota(respuesta) or intento == REINTENTOS_CUOTA:
+                return dict(resultado, estado="error", error=respuesta, segundos=round(time.monotonic() - inicio, 2))
+            # Sin cupo incluso tras la espera del limitador: se deja pasar la ventana y se reintenta
+            time.sleep(nucleo.extraer_segundos_reintento(respuesta) or 60)
+
+        if not texto.strip():
+            return dict(resultado, estado="error", error="El modelo no devolvió texto.",
+                        segundos=round(time.monotonic() - inicio, 2))
+        return dict(resultado, estado="ok", origen=origen, respuesta=texto, segundos=round(time.monotonic() - inicio, 2))
+    finally:
+        if hasattr(contenido, "name") and not isinstance(contenido, (str, dict)):
+            nucleo.delete_file_from_gemini(api_key, contenido, avisar=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("carpeta", type=Path, help="Carpeta con los documentos (se recorre con subcarpetas)")
+    parser.add_argument("-o", "--salida", type=Path, required=True, help="Archivo JSONL de resultados y punto de control")
+    parser.add_argument("-m", "--modelo", default="gemini-2.5-flash", choices=["gemini-2.5-flash", "gemini-2.5-pro"])
+    parser.add_argument("-j", "--hilos", type=int, default=4, help="Documentos en paralelo (el limitador de cuota se respeta)")
+    parser.add_argument("--prompt-archivo", type=Path, help="Consulta a usar en lugar de la Asesoría Rápida")
+    parser.add_argument("--extensiones", nargs="*", default=list(EXTENSIONES))
+    args = parser.parse_args(argv)
+
+    api_key = os.environ.get("GEMINI_API_KEY", "")
+    if not api_key:
+        parser.error("Define GEMINI_API_KEY en el entorno.")
+
+    nucleo = cargar_nucleo()
+    prompt = args.prompt_archivo.read_text(encoding="utf-8") if args.prompt_archivo else nucleo.PROMPT_ASESORIA_RAPIDA
+    # Como en el chat: la Asesoría Rápida usa el informe de brechas y el resto, los pasajes del corpus
+    referencias = "" if prompt == nucleo.PROMPT_ASESORIA_RAPIDA else nucleo.pasajes_de_referencia(prompt)[0]
+    extensiones = {e.lower() if e.startswith(".") else f".{e.lower()}" for e in args.extensiones}
+
+    hechos = leer_punto_de_control(args.salida)
+    pendientes = []
+    for ruta in documentos_de(args.carpeta, extensiones):
+        relativa = ruta.relative_to(args.carpeta).as_posix()
+        hash_archivo = hashlib.sha256(ruta.read_bytes()).hexdigest()
+        if (relativa, hash_archivo) not in hechos:
+            pendientes.append((ruta, relativa, hash_archivo))
+    print(f"{len(pendientes)} documento(s) por revisar; {len(hechos)} ya revisado(s).", file=sys.stderr)
+
+    lock_salida = threading.Lock()
+    errores = 0
+    args.salida.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.salida, "a", encoding="utf-8") as salida, \
+            ThreadPoolExecutor(max_workers=max(1, args.hilos)) as executor:
+        futuros = {
+            executor.submit(revisar_documento, nucleo, api_key, ruta, relativa, hash_archivo, args.modelo, prompt, referencias): relativa
+            for ruta, relativa, hash_archivo in pendientes
+        }
+        for n, futuro in enumerate(as_completed(futuros), 1):
+            relativa = futuros[futuro]
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                resultado = {"ruta": relativa, "estado": "error", "error": str(e)}
+            errores += resultado["estado"] != "ok"
+            with lock_salida:
+                # Una línea completa por documento: si el proceso se corta, se reanuda desde aquí
+                salida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+                salida.flush()
+            print(f"[{n}/{len(pendientes)}] {resultado['estado']:<5} {relativa} ({resultado.get('segundos', 0)} s)",
+                  file=sys.stderr)
+
+    print(f"Terminado: {len(pendientes) - errores} correcto(s), {errores} con error.", file=sys.stderr)
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+"""Pruebas del análisis de brechas frente a las plantillas de docs/ (nucleo.py)."""
+
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import nucleo  # noqa: E402
+
+PROCEDIMIENTO = """# Procedimiento de Compras
+
+Código: PR-COM-01
+
+## 1. Objetivo
+
+Establecer los pasos para adquirir bienes y servicios de la entidad con criterios de transparencia.
+
+## 2. Alcance
+
+Aplica a todas las dependencias que soliciten compras con recursos propios de la entidad.
+"""
+
+
+def campo(informe, nombre):
+    return next(c["valor"] for c in informe["campos"] if c["nombre"] == nombre)
+
+
+class PruebasTituloDelDocumento(unittest.TestCase):
+
+    def test_el_titulo_conserva_el_nombre_completo(self):
+        informe = nucleo.analizar_brechas(PROCEDIMIENTO)
+        self.assertEqual(informe["tipo"], "Procedimiento")
+        self.assertEqual(campo(informe, "Título"), "Procedimiento de Compras")
+
+    def test_rotulos_y_marcas(self):
+        self.assertEqual(nucleo.titulo_de_celda("Título: Guía de Archivo", "Guia"), "Guía de Archivo")
+        self.assertEqual(nucleo.titulo_de_celda("**Instructivo de Radicación**", "Instructivo"),
+                         "Instructivo de Radicación")
+        self.assertEqual(nucleo.titulo_de_celda("Procedimiento (Nombre)", "Procedimiento"), None)
+
+    def test_el_encabezado_no_repite_el_tipo(self):
+        xml = "<w:t>Procedimiento (Nombre)</w:t>"
+        self.assertEqual(
+            nucleo._rellenar_encabezado(xml, {"Título": "Procedimiento de Compras"}, "Procedimiento"),
+            "<w:t>Procedimiento de Compras</w:t>",
+        )
+        self.assertEqual(nucleo._rellenar_encabezado(xml, {"Título": "Compras"}, "Procedimiento"),
+                         "<w:t>Procedimiento Compras</w:t>")
+
+
+class PruebasContenidoParaAsesoria(unittest.TestCase):
+
+    def test_las_secciones_recortadas_llevan_una_marca(self):
+        largo = "Detalle de la actividad de compra. " * 200
+        informe = nucleo.analizar_brechas(PROCEDIMIENTO.replace("## 2. Alcance", largo + "\n\n## 2. Alcance"))
+        contenido = nucleo.contenido_para_asesoria(PROCEDIMIENTO, informe)
+        self.assertIn(f"sección recortada: se incluyen {nucleo.SECCION_MAX_CARACTERES} de", contenido)
+        self.assertNotIn(largo, contenido)
+
+    def test_las_secciones_cortas_van_completas(self):
+        informe = nucleo.analizar_brechas(PROCEDIMIENTO)
+        contenido = nucleo.contenido_para_asesoria(PROCEDIMIENTO, informe)
+        self.assertIn("Aplica a todas las dependencias", contenido)
+        self.assertNotIn("recortada", contenido)
+
+
+if __name__ == "__main__":
+    unittest.main()
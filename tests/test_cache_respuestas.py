@@ -0,0 +1,60 @@
+"""Pruebas de la caché de respuestas completas (CacheRespuestas de nucleo.py)."""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+import nucleo  # noqa: E402
+
+
+class PruebasCacheRespuestas(unittest.TestCase):
+
+    def test_descarta_la_menos_usada_al_llenarse(self):
+        cache = nucleo.CacheRespuestas(max_entradas=2, ttl_segundos=60)
+        cache.guardar("a", "respuesta a")
+        cache.guardar("b", "respuesta b")
+        cache.obtener("a")
+        cache.guardar("c", "respuesta c")
+        self.assertIsNone(cache.obtener("b"))
+        self.assertEqual(cache.obtener("a"), "respuesta a")
+        self.assertEqual(cache.obtener("c"), "respuesta c")
+
+    def test_las_entradas_expiran(self):
+        cache = nucleo.CacheRespuestas(max_entradas=2, ttl_segundos=60)
+        with mock.patch.object(nucleo.time, "time", return_value=1000.0):
+            cache.guardar("a", "respuesta a")
+        with mock.patch.object(nucleo.time, "time", return_value=1061.0):
+            self.assertIsNone(cache.obtener("a"))
+
+    def test_ttl_cero_desactiva_la_cache(self):
+        cache = nucleo.CacheRespuestas(max_entradas=2, ttl_segundos=0)
+        cache.guardar("a", "respuesta a")
+        self.assertIsNone(cache.obtener("a"))
+
+    def test_con_sqlite_sobrevive_a_un_reinicio(self):
+        with tempfile.TemporaryDirectory() as directorio:
+            ruta = os.path.join(directorio, "respuestas.db")
+            antes = nucleo.CacheRespuestas(max_entradas=2, ttl_segundos=60, ruta_sqlite=ruta)
+            antes.guardar("a", "respuesta a")
+            antes._db.close()
+            despues = nucleo.CacheRespuestas(max_entradas=2, ttl_segundos=60, ruta_sqlite=ruta)
+            self.assertEqual(despues.obtener("a"), "respuesta a")
+            despues._db.close()
+
+    def test_la_clave_cambia_con_el_modelo_y_el_historial(self):
+        def clave(modelo="gemini-2.5-flash", historial=None):
+            return nucleo.clave_respuesta(modelo, "Eres un asesor.", "Revisa el documento", [], historial)
+
+        self.assertEqual(clave(), clave())
+        self.assertNotEqual(clave(), clave(modelo="gemini-2.5-pro"))
+        self.assertNotEqual(clave(), clave(historial=[{"role": "user", "parts": ["Hola"]}]))
+
+
+if __name__ == "__main__":
+    unittest.main()
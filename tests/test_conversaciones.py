@@ -0,0 +1,50 @@
+"""Pruebas de quién puede retomar una conversación guardada (puede_reanudar de app.py)."""
+
+import os
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# app.py se importa en modo bare: sin precalentamiento ni archivos SQLite
+os.environ["PRECALENTAR"] = "0"
+os.environ["CONVERSACIONES_SQLITE"] = ""
+os.environ["INDICE_SQLITE"] = ""
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+from streamlit import logger  # noqa: E402
+
+logger.set_log_level("error")
+import app  # noqa: E402
+
+ANA, LUIS = "ana@entidad.gov.co", "luis@entidad.gov.co"
+
+
+def puede_reanudar(creador, usuario, con_login):
+    with mock.patch.object(app, "login_configurado", return_value=con_login), \
+            mock.patch.object(app, "usuario_actual", return_value=usuario):
+        return app.puede_reanudar(creador)
+
+
+class PruebasPuedeReanudar(unittest.TestCase):
+
+    def test_con_login_solo_quien_la_creo(self):
+        self.assertTrue(puede_reanudar(ANA, ANA, con_login=True))
+        self.assertFalse(puede_reanudar(ANA, LUIS, con_login=True))
+
+    def test_con_login_nadie_retoma_una_conversacion_anonima(self):
+        # Ni sin identificarse ni identificado: quien tuviera el enlace vería la conversación de otro
+        self.assertFalse(puede_reanudar(app.USUARIO_ANONIMO, app.USUARIO_ANONIMO, con_login=True))
+        self.assertFalse(puede_reanudar(app.USUARIO_ANONIMO, ANA, con_login=True))
+
+    def test_sin_login_las_anonimas_se_retoman_con_el_enlace(self):
+        self.assertTrue(puede_reanudar(app.USUARIO_ANONIMO, app.USUARIO_ANONIMO, con_login=False))
+
+    def test_sin_login_no_se_retoma_la_de_un_usuario_identificado(self):
+        self.assertFalse(puede_reanudar(ANA, app.USUARIO_ANONIMO, con_login=False))
+        self.assertTrue(puede_reanudar(ANA, ANA, con_login=False))
+
+
+if __name__ == "__main__":
+    unittest.main()
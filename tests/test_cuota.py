@@ -0,0 +1,92 @@
+"""Pruebas del limitador de cuota compartido y los reintentos ante 429 (nucleo.py)."""
+
+import os
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+import nucleo  # noqa: E402
+
+
+class ModeloFalso:
+    """Responde con los errores indicados, en orden, y después con "ok"."""
+
+    def __init__(self, *errores):
+        self.errores = list(errores)
+        self.llamadas = 0
+
+    def generate_content(self, contents, stream=True):
+        self.llamadas += 1
+        if self.errores:
+            raise self.errores.pop(0)
+        return "ok"
+
+
+class PruebasLimitadorCuota(unittest.TestCase):
+
+    def test_sin_cupo_no_espera_mas_de_lo_permitido(self):
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=2)
+        self.assertTrue(limitador.adquirir(0))
+        self.assertTrue(limitador.adquirir(0))
+        self.assertFalse(limitador.adquirir(0))
+        self.assertGreater(limitador.tiempo_espera(), 0)
+
+    def test_un_429_bloquea_durante_el_retraso_indicado_y_reduce_la_tasa(self):
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=60)
+        limitador.registrar_429(retry_seconds=30)
+        self.assertGreaterEqual(limitador.tiempo_espera(), 29)
+        self.assertFalse(limitador.adquirir(0))
+        self.assertEqual(limitador._tasa, 0.5)
+
+    def test_los_exitos_recuperan_la_tasa_sin_pasar_del_limite(self):
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=60)
+        limitador.registrar_429(retry_seconds=0)
+        for _ in range(20):
+            limitador.registrar_exito()
+        self.assertEqual(limitador._tasa, 1.0)
+
+
+class PruebasGenerarConLimitador(unittest.TestCase):
+
+    def setUp(self):
+        parche = mock.patch.object(nucleo, "ESPERA_MAXIMA_CUOTA_SEGUNDOS", 1)
+        parche.start()
+        self.addCleanup(parche.stop)
+
+    def test_reintenta_un_429_con_retraso_corto(self):
+        modelo = ModeloFalso(RuntimeError("429 Quota exceeded. Please retry in 0.01s"))
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=600)
+        self.assertEqual(nucleo.generar_con_limitador(modelo, limitador, "gemini-2.5-flash", []), "ok")
+        self.assertEqual(modelo.llamadas, 2)
+
+    def test_si_el_retraso_no_cabe_en_la_espera_relanza_el_429(self):
+        error = RuntimeError("429 Quota exceeded. Please retry in 30s")
+        modelo = ModeloFalso(error)
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=600)
+        with self.assertRaises(RuntimeError) as contexto:
+            nucleo.generar_con_limitador(modelo, limitador, "gemini-2.5-flash", [])
+        self.assertIs(contexto.exception, error)
+        self.assertEqual(modelo.llamadas, 1)
+
+    def test_otros_errores_no_se_reintentan(self):
+        modelo = ModeloFalso(ValueError("400 Invalid argument"))
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=600)
+        with self.assertRaises(ValueError):
+            nucleo.generar_con_limitador(modelo, limitador, "gemini-2.5-flash", [])
+        self.assertEqual(modelo.llamadas, 1)
+
+    def test_sin_cupo_local_no_llama_al_modelo(self):
+        modelo = ModeloFalso()
+        limitador = nucleo.LimitadorCuota(peticiones_por_minuto=1)
+        limitador.registrar_429(retry_seconds=30)
+        with self.assertRaises(nucleo.CuotaNoDisponible):
+            nucleo.generar_con_limitador(modelo, limitador, "gemini-2.5-flash", [])
+        self.assertEqual(modelo.llamadas, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
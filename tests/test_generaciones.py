@@ -0,0 +1,157 @@
+"""Pruebas de las generaciones compartidas (GeneracionEnCurso y RegistroGeneraciones de app.py)."""
+
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import Future
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# app.py se importa en modo bare: sin precalentamiento ni archivos SQLite
+os.environ["PRECALENTAR"] = "0"
+os.environ["CONVERSACIONES_SQLITE"] = ""
+os.environ["INDICE_SQLITE"] = ""
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+from streamlit import logger  # noqa: E402
+
+logger.set_log_level("error")
+import app  # noqa: E402
+from test_renderizador import Hueco  # noqa: E402
+
+ESPERA = 5
+
+
+def seguir(generacion):
+    """Suscribe un lector en otro hilo; devuelve (hilo, lista donde deja el texto leído)."""
+    leido = []
+    hilo = threading.Thread(target=lambda: leido.append("".join(generacion.suscribir())), daemon=True)
+    hilo.start()
+    return hilo, leido
+
+
+class PruebasGeneracionEnCurso(unittest.TestCase):
+
+    def test_quien_sigue_una_generacion_completa_recibe_todo_el_texto(self):
+        generacion = app.GeneracionEnCurso()
+        continuar = threading.Event()
+
+        def producir():
+            yield "Primera parte. "
+            continuar.wait(ESPERA)
+            yield "Segunda parte."
+
+        generacion.iniciar(producir)
+        hilo, leido = seguir(generacion)
+        continuar.set()
+        hilo.join(ESPERA)
+        self.assertEqual(leido, ["Primera parte. Segunda parte."])
+        self.assertTrue(generacion.terminada)
+        self.assertIsNone(generacion.error)
+        self.assertFalse(generacion.cancelada)
+
+    def test_cancelar_termina_con_error_para_quien_la_sigue(self):
+        generacion = app.GeneracionEnCurso()
+        primer_trozo, continuar = threading.Event(), threading.Event()
+
+        def producir():
+            yield "Texto a medias "
+            primer_trozo.set()
+            continuar.wait(ESPERA)
+            yield "que no debe llegar."
+
+        generacion.iniciar(producir)
+        primer_trozo.wait(ESPERA)
+        hilo, leido = seguir(generacion)
+        generacion.cancelar()
+        continuar.set()
+        hilo.join(ESPERA)
+        generacion.futuro.result(ESPERA)
+        self.assertFalse(hilo.is_alive())
+        self.assertTrue(generacion.terminada)
+        self.assertTrue(generacion.cancelada)
+        self.assertEqual(generacion.error, app.GeneracionEnCurso.MENSAJE_CANCELADA)
+        self.assertNotIn("no debe llegar", leido[0])
+
+    def test_cancelar_antes_de_empezar_no_deja_esperando_a_nadie(self):
+        generacion = app.GeneracionEnCurso()
+        generacion.futuro = Future()  # En cola, aún sin hilo
+        hilo, leido = seguir(generacion)
+        generacion.cancelar()
+        hilo.join(ESPERA)
+        self.assertFalse(hilo.is_alive())
+        self.assertEqual(leido, [""])
+        self.assertEqual(generacion.error, app.GeneracionEnCurso.MENSAJE_CANCELADA)
+
+    def test_un_error_del_modelo_llega_a_quien_la_sigue(self):
+        generacion = app.GeneracionEnCurso()
+
+        def producir():
+            yield "Algo "
+            raise RuntimeError("429 Quota exceeded")
+
+        generacion.iniciar(producir)
+        hilo, _ = seguir(generacion)
+        hilo.join(ESPERA)
+        generacion.futuro.result(ESPERA)
+        self.assertEqual(generacion.error, "429 Quota exceeded")
+        self.assertFalse(generacion.cancelada)
+
+
+class PruebasSeguirGeneracion(unittest.TestCase):
+    """Lo que la sesión que sigue una generación pinta y guarda en su historial."""
+
+    def seguir_en_pantalla(self, generacion):
+        huecos = []
+        placeholder = Hueco(huecos)
+        texto, completa = app.seguir_generacion(placeholder, generacion)
+        # placeholder.markdown reemplaza todo lo que el renderizador pintó dentro
+        en_pantalla = placeholder.texto if placeholder.texto is not None else "".join(h.texto or "" for h in huecos)
+        return texto, completa, en_pantalla
+
+    def test_generacion_completa(self):
+        generacion = app.GeneracionEnCurso()
+        generacion.publicar("Respuesta ")
+        generacion.publicar("completa.")
+        generacion.terminar()
+        self.assertEqual(self.seguir_en_pantalla(generacion), ("Respuesta completa.", True, "Respuesta completa."))
+
+    def test_generacion_cancelada_no_se_toma_por_respuesta(self):
+        generacion = app.GeneracionEnCurso()
+        generacion.publicar("Respuesta a me")
+        generacion.cancelar()
+        generacion.terminar()  # Sin error explícito, como hacía _ejecutar antes
+        texto, completa, en_pantalla = self.seguir_en_pantalla(generacion)
+        self.assertFalse(completa)
+        self.assertEqual(texto, app.GeneracionEnCurso.MENSAJE_CANCELADA)
+        self.assertEqual(en_pantalla, app.GeneracionEnCurso.MENSAJE_CANCELADA)
+
+    def test_generacion_con_error(self):
+        generacion = app.GeneracionEnCurso()
+        generacion.publicar("Algo")
+        generacion.terminar("❌ Error: fallo del servidor")
+        self.assertEqual(self.seguir_en_pantalla(generacion)[:2], ("❌ Error: fallo del servidor", False))
+
+
+class PruebasRegistroGeneraciones(unittest.TestCase):
+
+    def test_la_segunda_consulta_identica_sigue_a_la_primera(self):
+        registro = app.RegistroGeneraciones()
+        primera, segunda = app.GeneracionEnCurso(origen="chat"), app.GeneracionEnCurso(origen="chat")
+        self.assertIsNone(registro.registrar_o_seguir("clave", primera))
+        self.assertIs(registro.registrar_o_seguir("clave", segunda), primera)
+        self.assertFalse(registro.registrar("clave", segunda))
+
+    def test_quitar_solo_retira_la_generacion_registrada(self):
+        registro = app.RegistroGeneraciones()
+        primera, otra = app.GeneracionEnCurso(), app.GeneracionEnCurso()
+        registro.registrar("clave", primera)
+        registro.quitar("clave", otra)
+        self.assertIs(registro.obtener("clave"), primera)
+        registro.quitar("clave", primera)
+        self.assertIsNone(registro.obtener("clave"))
+
+
+if __name__ == "__main__":
+    unittest.main()
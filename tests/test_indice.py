@@ -0,0 +1,98 @@
+"""Pruebas del índice BM25 del corpus: sincronización con los archivos y revisión periódica (nucleo.py)."""
+
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+import nucleo  # noqa: E402
+
+COMPRAS = "# Compras\n\nProcedimiento para adquirir bienes con cotizaciones de proveedores."
+ARCHIVO = "# Archivo\n\nInstructivo para transferir expedientes al archivo central."
+
+
+class PruebasIndiceCorpus(unittest.TestCase):
+
+    def setUp(self):
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        self.dir = Path(directorio.name)
+        self.indice = nucleo.IndiceCorpus(str(self.dir / "indice.db"))
+        self.addCleanup(self.indice._db.close)
+
+    def escribir(self, nombre, texto, mtime=None):
+        ruta = self.dir / nombre
+        ruta.write_text(texto, encoding="utf-8")
+        if mtime is not None:
+            os.utime(ruta, ns=(mtime, mtime))
+        return ruta
+
+    def fuentes(self, *rutas):
+        return {f"corpus/{r.name}": (r, r.stat().st_size, r.stat().st_mtime_ns) for r in rutas}
+
+    def documentos(self, consulta):
+        return [r["documento"] for r in self.indice.buscar(consulta)]
+
+    def test_indexa_y_encuentra_el_documento_relevante(self):
+        compras, archivo = self.escribir("compras.md", COMPRAS), self.escribir("archivo.md", ARCHIVO)
+        self.assertEqual(self.indice.actualizar(self.fuentes(compras, archivo)), {"indexados": 2, "eliminados": 0})
+        self.assertEqual(self.documentos("cotizaciones de proveedores"), ["corpus/compras.md"])
+
+    def test_sin_cambios_no_se_reindexa_nada(self):
+        compras = self.escribir("compras.md", COMPRAS)
+        self.indice.actualizar(self.fuentes(compras))
+        self.assertEqual(self.indice.actualizar(self.fuentes(compras)), {"indexados": 0, "eliminados": 0})
+
+    def test_mismo_contenido_con_otro_mtime_solo_actualiza_la_firma(self):
+        compras = self.escribir("compras.md", COMPRAS, mtime=1_000_000_000)
+        self.indice.actualizar(self.fuentes(compras))
+        os.utime(compras, ns=(2_000_000_000, 2_000_000_000))
+        self.assertEqual(self.indice.actualizar(self.fuentes(compras)), {"indexados": 0, "eliminados": 0})
+        self.assertEqual(self.indice.informe(), {"documentos": 1, "pasajes": 1})
+
+    def test_un_documento_modificado_se_reindexa(self):
+        compras = self.escribir("compras.md", COMPRAS)
+        self.indice.actualizar(self.fuentes(compras))
+        self.escribir("compras.md", COMPRAS.replace("cotizaciones", "licitaciones"), mtime=3_000_000_000)
+        self.assertEqual(self.indice.actualizar(self.fuentes(compras))["indexados"], 1)
+        self.assertEqual(self.documentos("cotizaciones"), [])
+        self.assertEqual(self.documentos("licitaciones"), ["corpus/compras.md"])
+
+    def test_un_documento_borrado_sale_del_indice(self):
+        compras, archivo = self.escribir("compras.md", COMPRAS), self.escribir("archivo.md", ARCHIVO)
+        self.indice.actualizar(self.fuentes(compras, archivo))
+        self.assertEqual(self.indice.actualizar(self.fuentes(archivo)), {"indexados": 0, "eliminados": 1})
+        self.assertEqual(self.documentos("cotizaciones de proveedores"), [])
+        self.assertEqual(self.indice.informe(), {"documentos": 1, "pasajes": 1})
+
+
+class PruebasFuentesVigentes(unittest.TestCase):
+
+    def setUp(self):
+        nucleo._fuentes_de_la_ventana.clear()
+        self.addCleanup(nucleo._fuentes_de_la_ventana.clear)
+
+    def test_el_corpus_se_recorre_una_vez_por_ventana_salvo_al_forzar(self):
+        with mock.patch.object(nucleo, "CORPUS_REVISION_SEGUNDOS", 3600), \
+                mock.patch.object(nucleo, "fuentes_del_corpus", return_value={}) as recorrer:
+            nucleo.fuentes_vigentes()
+            nucleo.fuentes_vigentes()
+            self.assertEqual(recorrer.call_count, 1)
+            nucleo.fuentes_vigentes(forzar=True)
+            self.assertEqual(recorrer.call_count, 2)
+
+    def test_sin_ventana_se_recorre_siempre(self):
+        with mock.patch.object(nucleo, "CORPUS_REVISION_SEGUNDOS", 0), \
+                mock.patch.object(nucleo, "fuentes_del_corpus", return_value={}) as recorrer:
+            nucleo.fuentes_vigentes()
+            nucleo.fuentes_vigentes()
+            self.assertEqual(recorrer.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
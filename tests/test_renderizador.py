@@ -0,0 +1,98 @@
+"""Pruebas del renderizado incremental de respuestas (RenderizadorStream de app.py)."""
+
+import os
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# app.py se importa en modo bare: sin precalentamiento ni archivos SQLite
+os.environ["PRECALENTAR"] = "0"
+os.environ["CONVERSACIONES_SQLITE"] = ""
+os.environ["INDICE_SQLITE"] = ""
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+from streamlit import logger  # noqa: E402
+
+logger.set_log_level("error")
+import app  # noqa: E402
+
+
+class Hueco:
+    """Imita el st.empty() de Streamlit: guarda el último markdown pintado."""
+
+    def __init__(self, huecos):
+        self._huecos = huecos
+        self.texto = None
+
+    def markdown(self, texto):
+        self.texto = texto
+
+    def empty(self):
+        hueco = Hueco(self._huecos)
+        self._huecos.append(hueco)
+        return hueco
+
+    def container(self):
+        return self
+
+
+def bloques_pintados(texto, tamano_trozo):
+    """Transmite `texto` en trozos y devuelve los bloques en el orden en que quedan pintados."""
+    huecos = []
+    renderizador = app.RenderizadorStream(Hueco(huecos), intervalo_segundos=0)
+    for i in range(0, len(texto), tamano_trozo):
+        renderizador.agregar(texto[i:i + tamano_trozo])
+    assert renderizador.finalizar() == texto
+    return [h.texto for h in huecos if h.texto]
+
+
+class PruebasRenderizadorStream(unittest.TestCase):
+
+    def comprobar(self, texto, esperados):
+        for tamano_trozo in (1, 3, 7):
+            with self.subTest(tamano_trozo=tamano_trozo):
+                self.assertEqual(bloques_pintados(texto, tamano_trozo), esperados)
+        # En un solo chunk todo lo cerrado se pinta junto, pero sin partir ningún bloque
+        bloques = bloques_pintados(texto, len(texto))
+        for esperado in esperados:
+            self.assertTrue(any(esperado in bloque for bloque in bloques), esperado)
+
+    def test_parrafos_se_cierran_en_la_linea_en_blanco(self):
+        self.comprobar("# Título\n\nPrimer párrafo.\n\nSegundo párrafo.\n",
+                       ["# Título\n\n", "Primer párrafo.\n\n", "Segundo párrafo.\n"])
+
+    def test_lista_suelta_con_detalle_sangrado_queda_en_un_bloque(self):
+        lista = "1. Paso uno\n\n   Detalle del paso uno.\n\n2. Paso dos\n\n   - Sub punto\n\n"
+        self.comprobar(lista + "Texto final.\n", [lista, "Texto final.\n"])
+
+    def test_lista_de_vinetas_separadas_por_blancos(self):
+        lista = "- Objetivo\n\n- Alcance\n\n* Definiciones\n\n"
+        self.comprobar("Faltan:\n\n" + lista + "Fin.\n", ["Faltan:\n\n", lista, "Fin.\n"])
+
+    def test_cita_con_lineas_en_blanco(self):
+        cita = "> Primera parte.\n>\n> Segunda parte.\n\n> Tercera parte.\n\n"
+        self.comprobar(cita + "Después.\n", [cita, "Después.\n"])
+
+    def test_bloque_de_codigo_con_lineas_en_blanco(self):
+        codigo = "```python\nx = 1\n\n\ny = 2\n```\n\n"
+        self.comprobar("Código:\n\n" + codigo + "Listo.\n", ["Código:\n\n", codigo, "Listo.\n"])
+
+    def test_tabla(self):
+        tabla = "| ORD | ACTIVIDAD |\n| --- | --- |\n| 1 | Radicar |\n| 2 | Revisar |\n\n"
+        self.comprobar("## Contenido\n\n" + tabla + "Nota.\n", ["## Contenido\n\n", tabla, "Nota.\n"])
+
+    def test_no_se_cierra_antes_de_conocer_la_linea_siguiente(self):
+        huecos = []
+        renderizador = app.RenderizadorStream(Hueco(huecos), intervalo_segundos=0)
+        renderizador.agregar("1. Paso uno\n\n")
+        renderizador.agregar("   Det")
+        renderizador.agregar("alle.\n")
+        # Solo existe el hueco del bloque abierto: nada se ha pintado de forma definitiva
+        self.assertEqual(len(huecos), 1)
+        self.assertEqual(renderizador.finalizar(), "1. Paso uno\n\n   Detalle.\n")
+        self.assertEqual(huecos[0].texto, "1. Paso uno\n\n   Detalle.\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
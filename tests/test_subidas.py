@@ -0,0 +1,129 @@
+"""Pruebas de las subidas a la API de Archivos y su caché compartida (nucleo.py), con el backend falso de bench/."""
+
+import io
+import os
+import sys
+import types
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+sys.path.insert(0, str(RAIZ / "bench"))
+os.environ.setdefault("METRICAS_LOG_ARCHIVO", os.devnull)
+
+import fake_genai  # noqa: E402
+import nucleo  # noqa: E402
+
+ESPERA = 5
+
+
+def archivo_remoto(nombre, expira_en_segundos=48 * 60 * 60):
+    return types.SimpleNamespace(
+        name=nombre, expiration_time=datetime.now(timezone.utc) + timedelta(seconds=expira_en_segundos))
+
+
+class PruebasCacheArchivosGemini(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = nucleo.CacheArchivosGemini()
+
+    def test_solo_se_borra_cuando_la_ultima_sesion_lo_libera(self):
+        file_obj = archivo_remoto("files/a")
+        self.cache.registrar("clave", file_obj)
+        self.assertIs(self.cache.obtener("clave"), file_obj)  # Segunda sesión
+        self.assertFalse(self.cache.liberar(file_obj))
+        self.assertTrue(self.cache.liberar(file_obj))
+        self.assertIsNone(self.cache.obtener("clave"))
+
+    def test_un_archivo_que_no_esta_en_el_registro_no_se_borra(self):
+        self.assertFalse(self.cache.liberar(archivo_remoto("files/desconocido")))
+
+    def test_un_archivo_en_uso_que_expira_no_se_reutiliza_pero_sigue_registrado(self):
+        file_obj = archivo_remoto("files/a", expira_en_segundos=60)
+        self.cache.registrar("clave", file_obj)
+        self.assertIsNone(self.cache.obtener("clave"))
+        self.assertEqual(self.cache.clave_de(file_obj), "clave")
+        self.assertTrue(self.cache.liberar(file_obj))
+
+    def test_la_purga_olvida_los_expirados_que_nadie_usa(self):
+        file_obj = archivo_remoto("files/a", expira_en_segundos=60)
+        self.cache.registrar("clave", file_obj)
+        self.cache._entradas["clave"]["refs"] = 0
+        self.assertIsNone(self.cache.obtener("clave"))
+        self.assertIsNone(self.cache.clave_de(file_obj))
+
+    def test_una_subida_nueva_reemplaza_a_la_que_expira(self):
+        viejo, nuevo = archivo_remoto("files/viejo", expira_en_segundos=60), archivo_remoto("files/nuevo")
+        self.cache.registrar("clave", viejo)
+        self.assertIs(self.cache.registrar("clave", nuevo), nuevo)
+        self.assertIs(self.cache.obtener("clave"), nuevo)
+        # La sesión que aún usaba el viejo lo deja expirar en Gemini
+        self.assertFalse(self.cache.liberar(viejo))
+
+
+class PruebasSubidaEnSegundoPlano(unittest.TestCase):
+
+    def setUp(self):
+        fake_genai.reiniciar()
+        fake_genai.CONFIG.latencia_subida = 0.0
+        # nucleo.genai resuelve google.generativeai en cada uso: basta con cambiarlo en sys.modules
+        parche = mock.patch.dict(sys.modules, {"google.generativeai": fake_genai})
+        parche.start()
+        self.addCleanup(parche.stop)
+        self.cache = nucleo.CacheArchivosGemini()
+
+    def subir(self, subida):
+        return nucleo._subir_y_esperar_activo(subida, io.BytesIO(b"contenido"), "Guia.pdf", "application/pdf",
+                                             "clave", nucleo.obtener_metricas())
+
+    def test_subida_que_llega_a_activo(self):
+        subida = nucleo.SubidaEnSegundoPlano("Guia.pdf", self.cache)
+        file_obj = self.subir(subida)
+        self.assertEqual(subida.fase, "activo")
+        self.assertEqual(self.cache.clave_de(file_obj), "clave")
+        self.assertEqual(fake_genai.ESTADISTICAS["delete_file"], 0)
+
+    def test_si_nunca_queda_activo_se_borra_el_archivo_remoto(self):
+        fake_genai.CONFIG.segundos_hasta_activo = 60
+        subida = nucleo.SubidaEnSegundoPlano("Guia.pdf", self.cache)
+        with mock.patch.object(nucleo, "SUBIDA_TIMEOUT_ACTIVO_SEGUNDOS", 0.05), \
+                mock.patch.object(nucleo, "SUBIDA_INTERVALO_SONDEO_SEGUNDOS", 0.01):
+            with self.assertRaises(TimeoutError):
+                self.subir(subida)
+        self.assertEqual(subida.fase, "error")
+        self.assertEqual(fake_genai.ESTADISTICAS["delete_file"], 1)
+        self.assertEqual(fake_genai._archivos, {})
+        self.assertIsNone(self.cache.obtener("clave"))
+
+    def test_si_gemini_no_puede_procesarlo_se_borra_el_archivo_remoto(self):
+        fallido = mock.Mock()
+        fallido.name = "files/fallido"
+        fallido.state.name = "FAILED"
+        subida = nucleo.SubidaEnSegundoPlano("Guia.pdf", self.cache)
+        with mock.patch.object(fake_genai, "upload_file", return_value=fallido):
+            with self.assertRaises(RuntimeError):
+                self.subir(subida)
+        self.assertEqual(subida.fase, "error")
+        self.assertEqual(fake_genai.ESTADISTICAS["delete_file"], 1)
+
+    def test_cancelar_antes_de_enviarla_al_pool(self):
+        subida = nucleo.SubidaEnSegundoPlano("Guia.pdf", self.cache)
+        subida.cancelar()  # Aún sin futuro
+        with self.assertRaises(nucleo.CancelledError):
+            self.subir(subida)
+        self.assertEqual(fake_genai.ESTADISTICAS["upload_file"], 0)
+
+    def test_cancelar_una_subida_terminada_libera_el_archivo(self):
+        subida = nucleo.SubidaEnSegundoPlano("Guia.pdf", self.cache)
+        subida.futuro = nucleo.obtener_executor_subidas().submit(self.subir, subida)
+        file_obj = subida.futuro.result(ESPERA)
+        subida.cancelar()
+        self.assertIsNone(self.cache.clave_de(file_obj))
+        self.assertEqual(fake_genai.ESTADISTICAS["delete_file"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()